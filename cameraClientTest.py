@@ -7,6 +7,7 @@ Author: Damon Hutley
 Date: 22nd November 2016
 '''
 
+import socket
 import cameraLibClient
 
 # Initialise the camera module server
@@ -18,7 +19,13 @@ try:
 
 	# Continuously ask for commands to send to the Raspberry Pi from the terminal.
 	while True:
-		command = camCommand.sendCommand(0)
+		try:
+			command = camCommand.sendCommand(0)
+		except socket.error as e:
+			# Resume the session on a new connection, or quit if the Pi is gone
+			if camCommand.reconnect(e):
+				continue
+			break
 		
 		# Exit program if quit command called
 		if command == "Q":
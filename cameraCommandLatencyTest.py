@@ -0,0 +1,120 @@
+'''
+Command latency test for the camera server. Run on the remote computer while
+cameraServerTest.py runs on the Raspberry Pi.
+
+Each setter command is replayed with the messages the client sends for it,
+setting every parameter to its current value, and timed over several repeats.
+The round trip of the network is measured with a "hello" request, which does
+no work on the Pi. A command bounded by the network takes about one network
+round trip per exchange of messages, so its time per exchange is close to the
+network round trip, apart from the time the camera takes to apply a setting.
+
+	python cameraCommandLatencyTest.py [Repeats]
+'''
+
+import sys
+import time
+import json
+import cameraLibClient
+
+REPEATS = 20
+
+# Setter commands, and the parameters they exchange with the Pi
+SETTERS = [("B", ["Brightness"]), ("C", ["Contrast"]), ("F", ["Framerate"]), ("G", ["Gain"]),
+	("S", ["Sharpness"]), ("U", ["Saturation"]), ("X", ["Exposure time"]),
+	("R", ["Width", "Height"]), ("Z", ["ROI x", "ROI y", "ROI width", "ROI height"])]
+
+
+def queries(cam, method, count):
+	'''
+	Send several requests of the versioned protocol at once. The requests are
+	pipelined, so they take a single exchange with the Pi.
+	'''
+
+	cam.query([(method, {})]*count)
+	return 1
+
+
+def setter(cam, letter, count):
+	'''
+	Replay a setter command with the current value of each parameter. Returns
+	the number of exchanges with the Pi.
+	'''
+
+	cam.send_msg(cam.client_socket, letter)
+	for i in range(count):
+		default = cam.recv_msg(cam.client_socket)
+		cam.recv_msg(cam.client_socket)
+		cam.recv_msg(cam.client_socket)
+
+		# Convert default fractions into decimal
+		if "/" in default:
+			num, den = default.split('/')
+			default = str(float(num)/float(den))
+
+		cam.send_msg(cam.client_socket, default)
+		cam.recv_msg(cam.client_socket)
+
+	return count + 1
+
+
+def batch(cam):
+	'''
+	Replay a batched parameter command which changes nothing.
+	'''
+
+	cam.send_msg(cam.client_socket, "M")
+	cam.send_msg(cam.client_socket, json.dumps({}))
+	cam.recv_msg(cam.client_socket)
+	return 1
+
+
+def timeCommand(name, function, repeats, network):
+	'''
+	Time a command over several repeats, and print its mean round trip, and
+	its mean time per exchange compared with the network round trip. Returns
+	the mean round trip.
+	'''
+
+	times = []
+	for i in range(repeats):
+		start = time.time()
+		exchanges = function()
+		times.append(time.time() - start)
+
+	mean = sum(times) / len(times)
+	line = "%-10s mean %7.2f ms, min %7.2f ms, max %7.2f ms, %d exchanges" % (name, mean*1000, min(times)*1000, max(times)*1000, exchanges)
+	if network is not None:
+		line += ", %.1fx network per exchange" % (mean / exchanges / network)
+	print(line)
+	return mean
+
+
+def main(argv):
+
+	repeats = int(argv[1]) if len(argv) > 1 else REPEATS
+
+	cam = cameraLibClient.cameraModuleClient()
+	try:
+		# Round trip of the network, with no work on the Pi
+		network = timeCommand("hello", lambda: queries(cam, "hello", 1), repeats, None)
+
+		# Queries, one at a time and pipelined
+		timeCommand("stats", lambda: queries(cam, "stats", 1), repeats, network)
+		timeCommand("settings", lambda: queries(cam, "settings", 1), repeats, network)
+		timeCommand("10 stats", lambda: queries(cam, "stats", 10), repeats, network)
+
+		# Setter commands
+		for letter, parameters in SETTERS:
+			timeCommand(letter, lambda: setter(cam, letter, len(parameters)), repeats, network)
+		timeCommand("M", lambda: batch(cam), repeats, network)
+
+		cam.send_msg(cam.client_socket, "Q")
+	finally:
+		cam.closeServer()
+
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
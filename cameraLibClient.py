@@ -13,28 +13,70 @@ import struct
 import os
 import sys
 import tempfile
-import glob
+import threading
+import io
+import traceback
+import json
+import Queue
+from collections import OrderedDict, deque
 from multiprocessing import Process, Value
-from Tkinter import Tk, Text, BOTH, W, N, E, S, RAISED, Frame, Message, LEFT, TOP, BOTTOM, DISABLED, NORMAL, PhotoImage, StringVar, Toplevel
-from ttk import Button, Style, Label, Entry, Notebook
+from Tkinter import Tk, Text, BOTH, W, N, E, S, RAISED, SUNKEN, Frame, Message, LEFT, TOP, BOTTOM, DISABLED, NORMAL, PhotoImage, StringVar, Toplevel, Canvas
+from ttk import Button, Style, Label, Entry, Notebook, Combobox, Checkbutton
 from tkFileDialog import askopenfilename
 from PIL import Image, ImageTk
 from datetime import datetime
+from cameraLibTiming import timed, timer, dump as dumpTimings
+from cameraLibProtocol import PROTOCOL_VERSION, KIND_REQUEST, KIND_ERROR, KIND_DATA, KIND_CLOSE, CHANNEL_STREAM, CHANNEL_FILE, isMessage, packMessage, unpackMessage
 
 # Returns the current time in milliseconds, in a date format. Used for default file names.
 current_milli_time = lambda: datetime.utcnow().strftime('%y%m%d-%H%M%S.%f')[:-3]
 
 IMAGE_TYPES = ['jpeg', 'jpg', 'gif', 'bmp'] # png causes crashing, gif isnt supported by ImageTk at the moment due to bug
+DISPLAY_TYPES = [type for type in IMAGE_TYPES if type != 'gif'] # Image types that can be shown in the image tab
+RAW_TYPES = ['npy', 'tif', 'tiff'] # 16-bit raw Bayer captures, which aren't shown in the image tab
 VIDEO_TYPES = ['mp3', 'mp4', 'm4v']
+IMAGE_FOLDER = "Images/"
+PAGE_SIZE = 50 # Number of images fetched from the image library at a time when browsing
 DEFAULT_IMAGE_TYPE = ".jpg"
 DEFAULT_VIDEO_TYPE = ".m4v"
 DEFAULT_DISP_IMG = "Resources/placeholder.bmp"
+DISP_IMG_WIDTH = 348 # Size of the image shown in the image tab
+DISP_IMG_HEIGHT = 240
+THUMB_CACHE = 64 # Number of display sized thumbnails kept in memory
+PREVIEW_PORT = 5001 # Network port of the live preview
+PREVIEW_HEADER = struct.Struct(">IIfIf") # JPEG length, frame index, age of the frame in seconds, focus score index and focus score
+FOCUS_HISTORY = 100 # Focus scores shown in the sparkline of the live preview
+FOCUS_HEIGHT = 40 # Height of the focus sparkline in pixels
+PREVIEW_INTERVAL = 33 # Milliseconds between preview display updates, capping the display at ~30 fps
+POLL_INTERVAL = 20 # Milliseconds between checks for results from the network I/O worker
+PI_ADDRESS = ('192.168.1.1', 8000)
+CONNECT_TIMEOUT = 5 # Seconds to wait for each connection attempt
+RECONNECT_DELAY = 0.5 # Seconds before the first reconnection attempt, doubled after each failed attempt
+RECONNECT_MAX = 30 # Maximum seconds between reconnection attempts
+RECONNECT_ATTEMPTS = 10 # Attempts before giving up on the Pi, about 3 minutes
+QUIT_TIMEOUT = 10 # Seconds to wait for the network I/O worker when the GUI is closed
+# Camera parameters set together by the "M" command, as GUI names and Pi names
+BATCH_PARAMS = [("Width", "Width"), ("Height", "Height"), ("Framerate (fps)", "Framerate"),
+	("Exposure time (microseconds)", "Exposure time"), ("Brightness", "Brightness"), ("Contrast", "Contrast"),
+	("Gain", "Gain"), ("Saturation", "Saturation"), ("Sharpness", "Sharpness"),
+	("ROI x", "ROI x"), ("ROI y", "ROI y"), ("ROI width", "ROI width"), ("ROI height", "ROI height")]
+BATCH_CMDS = ["R", "F", "X", "B", "C", "G", "U", "S", "Z"] # Single parameter commands replaced by "M" while batching
 THRESH_PERCENT_DEFAULT = "5"
 THRESH_PERCENT_MIN = "0"
 THRESH_PERCENT_MAX = "100"
 THRESH_MAGNITUDE_DEFAULT = "30"
 THRESH_MAGNITUDE_MIN = "1"
 THRESH_MAGNITUDE_MAX = "500"
+ROI_DEFAULT = ["0", "0", "100", "100"] # x, y, width, height as percentages of the sensor
+STACK_DEFAULT = "32" # Frames averaged by the stacked capture
+DETECTORS = ['Pixel', 'Block'] # Change detectors of cameraLibSubtract.py
+DETECTOR_DEFAULT = "Pixel"
+POLICIES = ['block', 'drop-oldest', 'keep-latest'] # What subtraction does with frames when it falls behind
+STREAM_QUEUE = 16 # Decoded frames queued by gstreamer ahead of the subtraction ring (RING_SIZE of cameraLibSubtract.py)
+STREAM_FAILED = 3 # Exit status of cameraLibSubtract.py when the stream couldn't be opened
+STREAM_ENDED = 4 # Exit status of cameraLibSubtract.py when the stream ended before ESC or 'q' was pressed
+SUBTRACT_POLL = 0.1 # Seconds between checks of the stop button while the subtraction runs
+POLICY_DEFAULT = "block"
 
 COLOUR = True
 
@@ -61,6 +103,298 @@ else:
 	YELLOWFLASH = "\033[0m"
 	CLEAR = "\033[0m"
 
+class imageLibrary:
+
+	def __init__(self, folder, types):
+		'''
+		Index of the images in a folder, ordered from oldest to newest. The
+		folder is only scanned once; afterwards the index is updated by the code
+		which downloads, renames and deletes images.
+		'''
+
+		self.folder = folder
+		self.types = types
+		self.lock = threading.Lock()
+
+		# Seed the index with the images already in the folder
+		names = []
+		if os.path.isdir(folder):
+			names = [name for name in os.listdir(folder) if self.accepts(name)]
+		self.names = sorted(names, key=lambda name: os.path.getctime(folder + name))
+		self.members = set(self.names)
+
+	def accepts(self, name):
+		'''
+		Returns true if the file name has one of the image types of the library.
+		'''
+
+		parts = name.split(".")
+		return len(parts) > 1 and parts[-1].lower() in self.types
+
+	def add(self, name):
+		'''
+		Add a new or overwritten image as the newest image.
+		'''
+
+		name = name.split("/")[-1]
+		if not self.accepts(name):
+			return
+
+		with self.lock:
+			if name in self.members:
+				self.names.remove(name)
+			self.names.append(name)
+			self.members.add(name)
+
+	def remove(self, name):
+		'''
+		Remove a deleted image.
+		'''
+
+		name = name.split("/")[-1]
+		with self.lock:
+			if name in self.members:
+				self.names.remove(name)
+				self.members.discard(name)
+
+	def rename(self, old, new):
+		'''
+		Rename an image, keeping its place in the index.
+		'''
+
+		old = old.split("/")[-1]
+		new = new.split("/")[-1]
+		if not self.accepts(new):
+			self.remove(old)
+			return
+
+		with self.lock:
+			if old not in self.members:
+				return
+			if new in self.members:
+				self.names.remove(new)
+			self.names[self.names.index(old)] = new
+			self.members.discard(old)
+			self.members.add(new)
+
+	def count(self):
+		'''
+		Returns the number of images in the library.
+		'''
+
+		return len(self.names)
+
+	def latest(self):
+		'''
+		Returns the path of the newest image, or None if there are no images.
+		'''
+
+		with self.lock:
+			if len(self.names) == 0:
+				return None
+			return self.folder + self.names[-1]
+
+	def page(self, number, size=PAGE_SIZE):
+		'''
+		Returns the paths of the images on a page, newest first. Page 0 starts
+		with the newest image.
+		'''
+
+		with self.lock:
+			end = len(self.names) - number * size
+			start = max(end - size, 0)
+			if end <= 0:
+				return []
+			return [self.folder + name for name in reversed(self.names[start:end])]
+
+
+class thumbnailCache:
+
+	def __init__(self, width, height, size=THUMB_CACHE):
+		'''
+		Least recently used cache of display sized thumbnails, keyed by image
+		path and modification time. JPEG images are decoded at a reduced scale
+		in the DCT domain, so a full resolution image is never decoded.
+		Thumbnails of new images can be generated in a background thread.
+		'''
+
+		self.width = width
+		self.height = height
+		self.size = size
+		self.cache = OrderedDict()
+		self.lock = threading.Lock()
+
+		# Thread which generates thumbnails of queued paths
+		self.queue = Queue.Queue()
+		self.thread = threading.Thread(target=self.generate)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def load(self, path):
+		'''
+		Decode an image and scale it to fit the display size.
+		'''
+
+		image = Image.open(path)
+
+		# Let the JPEG decoder scale down by up to 8 times while decoding
+		image.draft(image.mode, (self.width, self.height))
+
+		scale = min(float(self.width)/image.size[0], float(self.height)/image.size[1])
+		return image.resize((max(int(image.size[0]*scale), 1), max(int(image.size[1]*scale), 1)), Image.ANTIALIAS)
+
+	def get(self, path):
+		'''
+		Returns the thumbnail of an image, decoding it if it isn't cached.
+		'''
+
+		key = (path, os.path.getmtime(path))
+		with self.lock:
+			if key in self.cache:
+				thumbnail = self.cache.pop(key)
+				self.cache[key] = thumbnail
+				return thumbnail
+
+		thumbnail = self.load(path)
+		self.store(key, thumbnail)
+		return thumbnail
+
+	def store(self, key, thumbnail):
+		'''
+		Add a thumbnail to the cache, evicting the least recently used.
+		'''
+
+		with self.lock:
+			self.cache.pop(key, None)
+			self.cache[key] = thumbnail
+			while len(self.cache) > self.size:
+				self.cache.popitem(last=False)
+
+	def prefetch(self, path):
+		'''
+		Queue an image to have its thumbnail generated in the background.
+		'''
+
+		self.queue.put(path)
+
+	def generate(self):
+		'''
+		Thread which generates the thumbnails of queued images.
+		'''
+
+		while True:
+			path = self.queue.get()
+			try:
+				key = (path, os.path.getmtime(path))
+				with self.lock:
+					if key in self.cache:
+						continue
+				self.store(key, self.load(path))
+			except (IOError, OSError):
+				# The image was deleted, or is not a readable image
+				pass
+
+
+class livePreview:
+
+	def __init__(self, host, port):
+		'''
+		Connect to the live preview stream of the Pi, and decode its frames in
+		a background thread. Only the newest decoded frame is kept, so the
+		display never falls behind the stream.
+		'''
+
+		# The TCP handshake takes one round trip, which is used to estimate the
+		# time frames spend on the network
+		self.sock = socket.socket()
+		start = time.time()
+		self.sock.connect((host, port))
+		self.rtt = time.time() - start
+
+		self.lock = threading.Lock()
+		self.latest = None
+		self.frames = 0
+		self.drops = 0
+		self.focus = deque(maxlen=FOCUS_HISTORY)	# Newest focus scores, measured several times a second by the Pi
+		self.focusIndex = 0
+		self.running = True
+
+		self.thread = threading.Thread(target=self.receive)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def recvall(self, n):
+		'''
+		Receive n bytes from the preview stream, or None if it has closed.
+		'''
+
+		data = b''
+		while len(data) < n:
+			packet = self.sock.recv(n - len(data))
+			if not packet:
+				return None
+			data += packet
+		return data
+
+	def receive(self):
+		'''
+		Thread which receives and decodes frames until the stream closes.
+		'''
+
+		try:
+			while self.running:
+				header = self.recvall(PREVIEW_HEADER.size)
+				if header is None:
+					break
+				length, index, age, focusIndex, focus = PREVIEW_HEADER.unpack(header)
+				if focusIndex != self.focusIndex:
+					self.focusIndex = focusIndex
+					self.focus.append(focus)
+				data = self.recvall(length)
+				if data is None:
+					break
+				received = time.time()
+
+				with timer("preview decode"):
+					image = Image.open(io.BytesIO(data))
+					image.load()
+
+				# Replace a frame that hasn't been displayed yet
+				with self.lock:
+					if self.latest is not None:
+						self.drops += 1
+					self.latest = (image, index, age, received)
+					self.frames += 1
+		except (socket.error, IOError):
+			pass
+
+		self.running = False
+
+	def take(self):
+		'''
+		Returns the newest frame as (image, index, age, received), or None if
+		there is no new frame since the last call.
+		'''
+
+		with self.lock:
+			item = self.latest
+			self.latest = None
+		return item
+
+	def close(self):
+		'''
+		Close the preview stream and stop the thread.
+		'''
+
+		self.running = False
+		try:
+			self.sock.shutdown(socket.SHUT_RDWR)
+		except socket.error:
+			pass
+		self.sock.close()
+		self.thread.join()
+
+
 class cameraGUI(Frame):
 
 	def __init__(self, parent, camera):
@@ -83,16 +417,27 @@ class cameraGUI(Frame):
 
 		self.renameWindow = None		# Used to store image renaming window object
 		self.statsWindow = None			# Used to store stats displaying window object
+		self.connectionWindow = None	# Shows the state of the connection while reconnecting
 		self.buttonWidth = 10
 		self.entryWidth = 22
 
-		self.error = 0
 		self.dispImgName = DEFAULT_DISP_IMG
-		self.dispImgWidth = 348
-		self.dispImgHeight = 240
+		self.dispImgIndex = 0			# Position of the display image in the image library, newest first
+		self.dispPage = None			# Page of the image library containing the display image
+		self.dispPageNumber = -1
+		self.dispImgWidth = DISP_IMG_WIDTH
+		self.dispImgHeight = DISP_IMG_HEIGHT
 
 		self.triggerMode = "1"			# Either 1 or 2 depending on which trigger is used by GUI
-		self.trigger = StringVar()		# Used to send triggers (T or Q) to microscope
+		self.subtractCmd = "O"			# Either O or D depending on whether subtraction also records
+		self.streamCmd = "N"			# Either N or L depending on whether streaming to VLC or previewing in the GUI
+		self.preview = None				# Live preview stream, while previewing
+		self.batching = False			# True while several entries are changed for one "M" command
+		self.previewWindow = None		# Used to store live preview window object
+		self.detector = StringVar()		# Change detector used for image subtraction
+		self.detector.set(DETECTOR_DEFAULT)
+		self.policy = StringVar()		# Frame queue policy used for image subtraction
+		self.policy.set(POLICY_DEFAULT)
 
 	def initSVs(self):
 		'''
@@ -118,6 +463,10 @@ class cameraGUI(Frame):
 		V		15		Video filename
 		O		16		Background image
 		-		17		Save filename
+		Z		18		ROI x
+		Z		19		ROI y
+		Z		20		ROI width
+		Z		21		ROI height
 
 		There are two sets of string variables used by the GUI:
 		- The entryStringVars|entrySVs are the stringvars used in Entries in the
@@ -133,13 +482,17 @@ class cameraGUI(Frame):
 		the entrySVs[] is used instead.
 		'''
 
-		# Saving the default parameter values
-		self.camera.sendCommand("A")
-		self.originalStats = self.camera.receiveAll()
+		# Saving the default parameter values, and fetching the camera
+		# properties in the same round trip
+		settings, stats = self.camera.query([("settings", {}), ("stats", {})])
+		self.originalStats = []
+		for var, name in BATCH_PARAMS[0:9]:
+			self.originalStats += [str(value) for value in settings[name]]
+		self.camera.setStats(stats)
 
 		# Setting up entryStringVars[]
 		self.entryStringVars = []
-		for i in range(18):
+		for i in range(24):
 			self.entryStringVars.append(StringVar())
 
 		for i in range(0, 9):
@@ -153,6 +506,12 @@ class cameraGUI(Frame):
 		self.entryStringVars[15].set("VID_" + current_milli_time())
 		self.entryStringVars[16].set("")
 		self.entryStringVars[17].set("")
+		self.entryStringVars[18].set(ROI_DEFAULT[0])
+		self.entryStringVars[19].set(ROI_DEFAULT[1])
+		self.entryStringVars[20].set(ROI_DEFAULT[2])
+		self.entryStringVars[21].set(ROI_DEFAULT[3])
+		self.entryStringVars[22].set(STACK_DEFAULT)
+		self.entryStringVars[23].set("0")
 
 		# Tracing some Entry stringvars so they call sendCmd when changed
 		self.entryStringVars[0].trace("w", lambda name, index, mode, _=self.entryStringVars[0]: self.sendCmd("R"))
@@ -166,6 +525,10 @@ class cameraGUI(Frame):
 		self.entryStringVars[8].trace("w", lambda name, index, mode, _=self.entryStringVars[8]: self.sendCmd("S"))
 		self.entryStringVars[9].trace("w", lambda name, index, mode, _=self.entryStringVars[9]: self.updateThresholdParam("Threshold percentage"))
 		self.entryStringVars[10].trace("w", lambda name, index, mode, _=self.entryStringVars[10]: self.updateThresholdParam("Threshold magnitude"))
+		self.entryStringVars[18].trace("w", lambda name, index, mode, _=self.entryStringVars[18]: self.sendCmd("Z"))
+		self.entryStringVars[19].trace("w", lambda name, index, mode, _=self.entryStringVars[19]: self.sendCmd("Z"))
+		self.entryStringVars[20].trace("w", lambda name, index, mode, _=self.entryStringVars[20]: self.sendCmd("Z"))
+		self.entryStringVars[21].trace("w", lambda name, index, mode, _=self.entryStringVars[21]: self.sendCmd("Z"))
 
 		# Setting up entrySVs, a python dictionary of entryStringVars[] for convenience
 		self.entrySVs = {"Width":self.entryStringVars[0],	"Height":self.entryStringVars[1],
@@ -176,11 +539,14 @@ class cameraGUI(Frame):
 			"Threshold magnitude":self.entryStringVars[10],	"Video duration":self.entryStringVars[11],
 			"Stream duration":self.entryStringVars[12],		"Subtraction duration":self.entryStringVars[13],
 			"Image filename":self.entryStringVars[14],		"Video filename":self.entryStringVars[15],
-			"Background image":self.entryStringVars[16],	"Save filename":self.entryStringVars[17]}
+			"Background image":self.entryStringVars[16],	"Save filename":self.entryStringVars[17],
+			"ROI x":self.entryStringVars[18],				"ROI y":self.entryStringVars[19],
+			"ROI width":self.entryStringVars[20],			"ROI height":self.entryStringVars[21],
+			"Stacked frames":self.entryStringVars[22],		"Reject outliers":self.entryStringVars[23]}
 
 		# Setting up paramStringVars[]
 		self.paramStringVars = []
-		for i in range(18):
+		for i in range(24):
 			self.paramStringVars.append(StringVar())
 			self.paramStringVars[i].set(self.entryStringVars[i].get())
 
@@ -193,7 +559,10 @@ class cameraGUI(Frame):
 			"Threshold magnitude":self.paramStringVars[10],	"Video duration":self.paramStringVars[11],
 			"Stream duration":self.paramStringVars[12],		"Subtraction duration":self.paramStringVars[13],
 			"Image filename":self.paramStringVars[14],		"Video filename":self.paramStringVars[15],
-			"Background image":self.paramStringVars[16],	"Save filename":self.entryStringVars[17]}
+			"Background image":self.paramStringVars[16],	"Save filename":self.entryStringVars[17],
+			"ROI x":self.paramStringVars[18],				"ROI y":self.paramStringVars[19],
+			"ROI width":self.paramStringVars[20],			"ROI height":self.paramStringVars[21],
+			"Stacked frames":self.paramStringVars[22],		"Reject outliers":self.paramStringVars[23]}
 
 	def initUI(self):
 		'''
@@ -247,10 +616,12 @@ class cameraGUI(Frame):
 		self.imgtabreg = Frame(self.imgnote)
 		self.imgtabt1 = Frame(self.imgnote)
 		self.imgtabt2 = Frame(self.imgnote)
+		self.imgtabstk = Frame(self.imgnote)
 
 		self.imgnote.add(self.imgtabreg, text='Image Capture')
 		self.imgnote.add(self.imgtabt1, text='Trigger V1')
 		self.imgnote.add(self.imgtabt2, text='Trigger V2')
+		self.imgnote.add(self.imgtabstk, text='Stacked')
 
 		self.imgtabt1.grid_columnconfigure(1,weight=1)
 		self.imgtabt1.grid_columnconfigure(2,weight=1)
@@ -272,9 +643,9 @@ class cameraGUI(Frame):
 		self.imglbl2.grid(sticky=W, row=1, column=0, pady=4, padx=4)
 		self.imgbut2 = Button(self.imgtabt1, text="Start", width=6, command=lambda: self.sendCmd("T1"))
 		self.imgbut2.grid(row=1, column=1, pady=4, padx=4)
-		self.imgbut3 = Button(self.imgtabt1, text="Capture", width=6, state=DISABLED, command=lambda: self.trigger.set("T"))
+		self.imgbut3 = Button(self.imgtabt1, text="Capture", width=6, state=DISABLED, command=lambda: self.camera.triggers.put("T"))
 		self.imgbut3.grid(row=1, column=2, pady=4, padx=4)
-		self.imgbut4 = Button(self.imgtabt1, text="Stop", width=6, state=DISABLED, command=lambda: self.trigger.set("Q"))
+		self.imgbut4 = Button(self.imgtabt1, text="Stop", width=6, state=DISABLED, command=lambda: self.camera.triggers.put("Q"))
 		self.imgbut4.grid(row=1, column=3, pady=4, padx=4)
 
 		# Tab interface to capture with trigger V2
@@ -282,11 +653,22 @@ class cameraGUI(Frame):
 		self.imglbl2.grid(sticky=W, row=1, column=0, pady=4, padx=4)
 		self.imgbut5 = Button(self.imgtabt2, text="Start", width=6, command=lambda: self.sendCmd("T2"))
 		self.imgbut5.grid(row=1, column=1, pady=4, padx=4)
-		self.imgbut6 = Button(self.imgtabt2, text="Capture", width=6, state=DISABLED, command=lambda: self.trigger.set("T"))
+		self.imgbut6 = Button(self.imgtabt2, text="Capture", width=6, state=DISABLED, command=lambda: self.camera.triggers.put("T"))
 		self.imgbut6.grid(row=1, column=2, pady=4, padx=4)
-		self.imgbut7 = Button(self.imgtabt2, text="Stop", width=6, state=DISABLED, command=lambda: self.trigger.set("Q"))
+		self.imgbut7 = Button(self.imgtabt2, text="Stop", width=6, state=DISABLED, command=lambda: self.camera.triggers.put("Q"))
 		self.imgbut7.grid(row=1, column=3, pady=4, padx=4)
 
+		# Tab interface to capture the mean of several frames, named by the
+		# filename of the image capture tab
+		self.imglbl3 = Label(self.imgtabstk, text="Frames:")
+		self.imglbl3.grid(sticky=W, row=1, column=1, pady=4, padx=4)
+		self.imgtxt2 = Entry(self.imgtabstk, width=4, textvariable=self.entryStringVars[22])
+		self.imgtxt2.grid(sticky=W, row=1, column=2, pady=4, padx=4)
+		self.imgchk = Checkbutton(self.imgtabstk, text="Reject outliers", variable=self.entryStringVars[23], onvalue="1", offvalue="0")
+		self.imgchk.grid(sticky=W, row=1, column=3, pady=4, padx=4)
+		self.imgbut13 = Button(self.imgtabstk, text="Capture", width=6, command=lambda: self.sendCmd("K"))
+		self.imgbut13.grid(row=1, column=4, pady=4, padx=4)
+
 		# Display image features
 		self.imglblimg = Label(self.imgframe3)
 		self.imglblimg.grid(row=0, column=0)
@@ -313,6 +695,17 @@ class cameraGUI(Frame):
 		self.imgbut10 = Button(self.imgframe31, text="Delete Image", width=self.buttonWidth, command=lambda: self.deleteDisplayImage())
 		self.imgbut10.grid(row=1, column=2, padx=4, pady=4)
 
+		# Browse through older images in the image library
+		self.imgbut11 = Button(self.imgframe31, text="< Older", width=self.buttonWidth, command=lambda: self.updateDisplayImage(self.dispImgIndex + 1))
+		self.imgbut11.grid(row=0, column=0, padx=4, pady=4)
+
+		self.imglblpos = Label(self.imgframe31)
+		self.imglblpos.grid(row=0, column=1, padx=4, pady=4)
+
+		self.imgbut12 = Button(self.imgframe31, text="Newer >", width=self.buttonWidth, command=lambda: self.updateDisplayImage(self.dispImgIndex - 1))
+		self.imgbut12.grid(row=0, column=2, padx=4, pady=4)
+		self.updateBrowseButtons()
+
 
 		# ***** Video tab *****
 
@@ -388,14 +781,41 @@ class cameraGUI(Frame):
 		self.vlcframe21 = Frame(self.vlcframe2)
 		self.vlcframe21.grid(sticky=W+E, row=4, column=1, columnspan=2)
 
+		# Region of interest, applied to both streaming and image subtraction
+		self.vlcframe22 = Frame(self.vlcframe2)
+		self.vlcframe22.grid(sticky=W+E, row=5, column=1, columnspan=2, pady=(12,0))
+
+		self.vlclbl3 = Label(self.vlcframe22, text="Region of interest (%)", font=(None, 11))
+		self.vlclbl3.grid(sticky=W, row=0, column=0, pady=4, padx=5, columnspan=6)
+
+		roinames = ["ROI x", "ROI y", "ROI width", "ROI height"]
+		roilabels = ["x:", "y:", "Width:", "Height:"]
+		for i in range(0, 4):
+			lbl = Label(self.vlcframe22, text=roilabels[i], font=("None",10))
+			lbl.grid(sticky=E, row=1+i//2, column=3*(i%2), pady=4, padx=(5,2))
+
+			lbl2 = Label(self.vlcframe22, textvariable=self.paramSVs[roinames[i]], font=("None",10), width=4)
+			lbl2.grid(sticky=W, row=1+i//2, column=3*(i%2)+1, pady=4)
+
+			txt = Entry(self.vlcframe22, width=4, textvariable=self.entrySVs[roinames[i]])
+			txt.grid(sticky=W, row=1+i//2, column=3*(i%2)+2, pady=4, padx=(0,12))
+			txt.bind("<FocusOut>", self.updateSVs)
+
+		self.vlctxt4 = Label(self.vlcframe22, text="The region of interest also applies to image subtraction.", font=(None,8))
+		self.vlctxt4.grid(sticky=W, row=3, column=0, pady=(0,4), padx=5, columnspan=6)
+
 		self.vlcframe21.grid_columnconfigure(0,weight=1)
 		self.vlcframe21.grid_columnconfigure(1,weight=1)
+		self.vlcframe21.grid_columnconfigure(2,weight=1)
 
 		self.vlcbut = Button(self.vlcframe21, text="Start", width=10, command=lambda: self.sendCmd("N"))
 		self.vlcbut.grid(row=0, column=0, pady=4, padx=4)
 
-		self.vlcbut2 = Button(self.vlcframe21, text="Stop", state=DISABLED, width=10, command=lambda: self.streamStop("N"))
-		self.vlcbut2.grid(row=0, column=1, pady=4, padx=4)
+		self.vlcbut3 = Button(self.vlcframe21, text="Preview", width=10, command=lambda: self.sendCmd("L"))
+		self.vlcbut3.grid(row=0, column=1, pady=4, padx=4)
+
+		self.vlcbut2 = Button(self.vlcframe21, text="Stop", state=DISABLED, width=10, command=lambda: self.streamStop(self.streamCmd))
+		self.vlcbut2.grid(row=0, column=2, pady=4, padx=4)
 
 
 		# ***** Background subtraction tab *****
@@ -479,17 +899,33 @@ class cameraGUI(Frame):
 		self.bgslbl = Label(self.bgsframe31, text="Amount of change required for a pixel to have 'changed'.", font=("None",8))
 		self.bgslbl.grid(row=3, column=0, pady=(0,4), padx=2, sticky=W, columnspan=8)
 
+		self.bgslbl = Label(self.bgsframe31, text="Change detector:", font=("None",10))
+		self.bgslbl.grid(row=4, column=0, pady=(6,3), padx=2, sticky=W)
+		self.bgscmb = Combobox(self.bgsframe31, width=6, state="readonly", values=DETECTORS, textvariable=self.detector)
+		self.bgscmb.grid(row=4, column=1, pady=(6,3), padx=2, sticky=W, columnspan=2)
+		self.bgslbl = Label(self.bgsframe31, text="Queue:", font=("None",10))
+		self.bgslbl.grid(row=4, column=3, pady=(6,3), padx=2, sticky=E)
+		self.bgscmb2 = Combobox(self.bgsframe31, width=10, state="readonly", values=POLICIES, textvariable=self.policy)
+		self.bgscmb2.grid(row=4, column=4, pady=(6,3), padx=2, sticky=W, columnspan=3)
+
+		self.bgslbl = Label(self.bgsframe31, text="Block compares the mean and variance of tiles, which is faster.", font=("None",8))
+		self.bgslbl.grid(row=5, column=0, pady=(0,4), padx=2, sticky=W, columnspan=8)
+
 		self.bgsframe22 = Frame(self.bgsframe3)
 		self.bgsframe22.grid(sticky=W+E, row=9, column=1, columnspan=2)
 
 		self.bgsframe22.grid_columnconfigure(0,weight=1)
 		self.bgsframe22.grid_columnconfigure(1,weight=1)
+		self.bgsframe22.grid_columnconfigure(2,weight=1)
 
 		self.bgsbut = Button(self.bgsframe22, text="Start", width=10, command=lambda: self.sendCmd("O"))
 		self.bgsbut.grid(row=0, column=0, pady=4, padx=4)
 
-		self.bgsbut2 = Button(self.bgsframe22, text="Stop", state=DISABLED, width=10, command=lambda: self.streamStop("O"))
-		self.bgsbut2.grid(row=0, column=1, pady=4, padx=4)
+		self.bgsbut4 = Button(self.bgsframe22, text="Record", width=10, command=lambda: self.sendCmd("D"))
+		self.bgsbut4.grid(row=0, column=1, pady=4, padx=4)
+
+		self.bgsbut2 = Button(self.bgsframe22, text="Stop", state=DISABLED, width=10, command=lambda: self.streamStop(self.subtractCmd))
+		self.bgsbut2.grid(row=0, column=2, pady=4, padx=4)
 
 
 		# ***** Help program tab *****
@@ -538,6 +974,7 @@ class cameraGUI(Frame):
 		descriptions = (
 		"Accepted image file extensions are: " + ", ".join(IMAGE_TYPES) + ". "
 		"\nImages with .gif extension can not be displayed in GUI tab."
+		"\nImages with a " + ", ".join(RAW_TYPES) + " extension are raw 16-bit captures of the sensor, which are not displayed."
 		"\nAccepted video file extensions are: " + ", ".join(VIDEO_TYPES) + "."
 		"\n\nIf you set exposure time to 0, a default value will be based on framerate."
 		"\n\nThere are two trigger modes:"
@@ -614,7 +1051,7 @@ class cameraGUI(Frame):
 		quickly, the params don't change in time.
 		'''
 
-		for i in range(11):
+		for i in range(11) + range(18, 22):
 			if self.entryStringVars[i].get() != self.paramStringVars[i].get():
 				self.entryStringVars[i].set(self.paramStringVars[i].get())
 
@@ -623,14 +1060,20 @@ class cameraGUI(Frame):
 		Start running the given command, and disable some UI if we're videoing.
 		'''
 
+		# Entries changed together are sent in a single "M" command instead
+		if self.batching and useCmd in BATCH_CMDS:
+			return
+
 		# Don't send image subtraction command if background image size doesn't
-		# match current recording size, or doesn't exist
-		if useCmd == "O" and self.entrySVs["Background image"].get() != "":
+		# match current recording size, or doesn't exist. The "D" command resizes
+		# the background to the analysis stream, so only existence is checked.
+		if (useCmd == "O" or useCmd == "D") and self.entrySVs["Background image"].get() != "":
 			try:
 				img = Image.open("Images/" + self.entrySVs["Background image"].get())
 			except IOError:
 				print(RED + "ERROR: Can't open background image." + CLEAR)
 				return
+		if useCmd == "O" and self.entrySVs["Background image"].get() != "":
 			w1 = self.paramSVs["Width"].get()
 			h1 = self.paramSVs["Height"].get()
 			w2 = img.size[0]
@@ -643,10 +1086,15 @@ class cameraGUI(Frame):
 
 		# For commands that take time to complete, the GUI buttons and entries
 		# are disabled, so that only the stop button can be pressed
-		if useCmd == "T1" or useCmd == "T2" or useCmd == "V" or useCmd == "N" or useCmd == "O":
+		if useCmd == "T1" or useCmd == "T2" or useCmd == "V" or useCmd == "N" or useCmd == "L" or useCmd == "O" or useCmd == "D":
 
 			self.disableWidgets(self.parent, useCmd)
 
+			if useCmd == "O" or useCmd == "D":
+				self.subtractCmd = useCmd
+			elif useCmd == "N" or useCmd == "L":
+				self.streamCmd = useCmd
+
 			if useCmd == "T1":
 				useCmd = "T"
 				self.triggerMode = "1"
@@ -654,11 +1102,55 @@ class cameraGUI(Frame):
 				useCmd = "T"
 				self.triggerMode = "2"
 
-			# Perform the specified command, give it time to let GUI update
-			self.parent.after(10, self.camera.sendCommand, useCmd)
-		else:
-			# Send command without delay
-			self.camera.sendCommand(useCmd)
+		# Perform the command in the network I/O worker, so the GUI stays responsive
+		self.camera.request(self.snapshot(), self.camera.sendCommand, (useCmd,))
+
+	def setParams(self, values):
+		'''
+		Change several entries at once, and send all the camera parameters to
+		the Pi in a single command, which is applied as a whole or not at all.
+		values is a list of (entry name, value) pairs.
+		'''
+
+		self.batching = True
+		try:
+			for var, val in values:
+				if self.entrySVs[var].get() != val:
+					self.entrySVs[var].set(val)
+		finally:
+			self.batching = False
+
+		self.sendCmd("M")
+
+	def snapshot(self):
+		'''
+		Copy the values of the GUI variables used by commands, so that the
+		network I/O worker never reads Tk variables from its own thread.
+		'''
+
+		return {"entries": dict((k, v.get()) for k, v in self.entrySVs.items()),
+				"params": dict((k, v.get()) for k, v in self.paramSVs.items()),
+				"detector": self.detector.get(),
+				"policy": self.policy.get(),
+				"triggerMode": self.triggerMode}
+
+	def pollResults(self):
+		'''
+		Run the GUI updates posted by the network I/O worker. Reschedules itself
+		for as long as the GUI is running.
+		'''
+
+		while True:
+			try:
+				function, args = self.camera.results.get_nowait()
+			except Queue.Empty:
+				break
+			try:
+				function(*args)
+			except Exception:
+				traceback.print_exc()
+
+		self.parent.after(POLL_INTERVAL, self.pollResults)
 
 	def updateThresholdParam(self, cmd):
 		'''
@@ -692,21 +1184,14 @@ class cameraGUI(Frame):
 		# Re-enable all the buttons after the stop button has been pressed
 		self.disableWidgets(self.parent, "Enable")
 
-		# Set the value to stop the stream/record process
-		self.camera.procStop.value = 1
-		time.sleep(1)
-
-		if useCmd == "V":
-			# Receive the video file
-			self.camera.printStats()
-			self.camera.receiveFile(self.camera.videoName, "Video")
-
-		elif useCmd == "N":
-			# Free connection resources
-			print(GREEN + "Network stream closed" + CLEAR)
-			self.camera.client_socket.close()
-			self.camera.client_socket = socket.socket()
-			self.camera.client_socket.connect(('192.168.1.1', 8000))
+		if useCmd == "L":
+			# Close the live preview
+			self.stopPreview()
+		else:
+			# Set the value to stop the stream/record process, and let the
+			# network I/O worker finish the command
+			self.camera.procStop.value = 1
+			self.camera.request(self.snapshot(), self.camera.stopStream, (useCmd,))
 
 	def disableWidgets(self, parent, useCmd):
 		'''
@@ -744,45 +1229,160 @@ class cameraGUI(Frame):
 				self.imgbut7.config(state=NORMAL)
 			elif useCmd == "V":
 				self.vidbut2.config(state=NORMAL)
-			elif useCmd == "N":
+			elif useCmd == "N" or useCmd == "L":
 				self.vlcbut2.config(state=NORMAL)
-			elif useCmd == "O":
+			elif useCmd == "O" or useCmd == "D":
 				self.bgsbut2.config(state=NORMAL)
 
-	def updateDisplayImage(self):
+	def startPreview(self, preview, size):
 		'''
-		Updates the image being displayed in the image tab to the latest image
-		taken by the microscope, or a placeholder otherwise.
+		Show a connected live preview in a preview window with a status bar.
 		'''
 
-		# Deciding on what image we should be displaying.
-		# Priority: most recent non-gif photo in Image folder > default image
-		imageList = []
-		for type in IMAGE_TYPES:
-			imageList.extend(glob.glob("Images/*." + type))
+		self.preview = preview
+		self.previewShown = 0
+		self.previewRate = (time.time(), 0)
+		self.previewFps = 0.0
 
-		if len(imageList) > 0:
-			imageList = sorted(imageList, key=os.path.getctime)
-			while True:
-				img = imageList.pop()
-				if (img[-3:]) != "gif":
-					self.dispImgName = "Images/" + img.split("/")[-1]
-					break
-				if len(imageList) == 0:
-					print(RED + ".gif images can not be displayed." + CLEAR)
-					self.dispImgName = DEFAULT_DISP_IMG
-					break
+		if (self.previewWindow == None) or (self.previewWindow.winfo_exists() == 0):
+			self.previewWindow = Toplevel(self)
+			self.previewWindow.wm_title("Live Preview (" + size + ")")
+			self.previewWindow.protocol("WM_DELETE_WINDOW", lambda: self.streamStop("L"))
+
+			self.previewImage = Label(self.previewWindow)
+			self.previewImage.grid(row=0, column=0)
+			self.previewFocus = Canvas(self.previewWindow, height=FOCUS_HEIGHT, background="white", highlightthickness=0)
+			self.previewFocus.grid(sticky=W+E, row=1, column=0)
+			self.previewFocusLine = self.previewFocus.create_line(0, 0, 0, 0, fill="blue")
+			self.previewStatus = Label(self.previewWindow, relief=SUNKEN, anchor=W, font=('None', 8))
+			self.previewStatus.grid(sticky=W+E, row=2, column=0)
 		else:
-			self.dispImgName = DEFAULT_DISP_IMG
+			self.previewWindow.focus_set()
+
+		self.parent.after(PREVIEW_INTERVAL, self.updatePreview)
+
+	def updatePreview(self):
+		'''
+		Display the newest preview frame, dropping any older frames, and show
+		the latency and display rate in the status bar. Reschedules itself
+		until the preview ends.
+		'''
+
+		if self.preview is None:
+			return
+
+		item = self.preview.take()
+		if item is not None:
+			image, index, age, received = item
+			self.previewImg = ImageTk.PhotoImage(image)
+			self.previewImage.configure(image=self.previewImg)
+			self.previewShown += 1
+
+			# Latency is the age of the frame when sent by the Pi, plus half a
+			# round trip on the network, plus the time to decode and display it
+			latency = age + self.preview.rtt / 2 + (time.time() - received)
+
+			now = time.time()
+			start, shown = self.previewRate
+			if now - start >= 1:
+				self.previewRate = (now, self.previewShown)
+				self.previewFps = (self.previewShown - shown) / (now - start)
+			status = "Frame %d   Latency: %d ms   Display: %.1f fps   Dropped: %d" % (index, latency * 1000, self.previewFps, self.preview.drops)
+			scores = list(self.preview.focus)
+			if len(scores) > 0:
+				status += "   Focus: %.0f (peak %.0f)" % (scores[-1], max(scores))
+				self.drawFocus(scores)
+			self.previewStatus.configure(text=status)
+
+		elif not self.preview.running:
+			# The preview has finished its duration
+			self.stopPreview()
+			self.disableWidgets(self.parent, "Enable")
+			return
+
+		self.parent.after(PREVIEW_INTERVAL, self.updatePreview)
+
+	def drawFocus(self, scores):
+		'''
+		Draw the newest focus scores as a sparkline, scaled to the highest
+		score shown, so the peak of the focus stands out while focusing.
+		'''
+
+		width = self.previewFocus.winfo_width()
+		peak = max(max(scores), 1e-6)
+		step = float(width) / max(FOCUS_HISTORY - 1, 1)
+		coords = []
+		for i, score in enumerate(scores):
+			coords.append((FOCUS_HISTORY - len(scores) + i) * step)
+			coords.append((FOCUS_HEIGHT - 2) * (1 - score / peak) + 1)
+		if len(coords) == 2:
+			coords += coords
+		self.previewFocus.coords(self.previewFocusLine, *coords)
+
+	def stopPreview(self):
+		'''
+		Stop the live preview, and close the preview window.
+		'''
+
+		if self.preview is not None:
+			# Stop the Pi if the preview hasn't already finished
+			if self.preview.running:
+				self.camera.request(self.snapshot(), self.camera.stopStream, ("L",))
+			self.preview.close()
+			self.preview = None
+
+		if (self.previewWindow != None) and (self.previewWindow.winfo_exists() == 1):
+			self.previewWindow.destroy()
+
+	def updateDisplayImage(self, index=0):
+		'''
+		Updates the image being displayed in the image tab to an image from the
+		image library, by default the latest image taken by the microscope, or a
+		placeholder if there are no images.
+		'''
+
+		# Deciding on what image we should be displaying.
+		# Priority: image at index in the library (0 is the newest) > default image
+		library = self.camera.images
+		index = max(min(index, library.count() - 1), 0)
+		if index == 0:
+			# Always pick up newly downloaded images
+			self.dispPageNumber = -1
+			latest = library.latest()
+			self.dispImgName = latest if latest is not None else DEFAULT_DISP_IMG
+		else:
+			# Fetch the page of the library containing the image
+			number = index // PAGE_SIZE
+			if number != self.dispPageNumber:
+				self.dispPage = library.page(number)
+				self.dispPageNumber = number
+				for path in self.dispPage:
+					self.camera.thumbnails.prefetch(path)
+			if index % PAGE_SIZE < len(self.dispPage):
+				self.dispImgName = self.dispPage[index % PAGE_SIZE]
+			else:
+				self.dispImgName = DEFAULT_DISP_IMG
+		self.dispImgIndex = index
 
 		# Updating the display image and name of image imgtab
-		image = Image.open(self.dispImgName)
-		scale = min(float(self.dispImgWidth)/image.size[0], float(self.dispImgHeight)/image.size[1])
-		image = image.resize((int(image.size[0]*scale), int(image.size[1]*scale)), Image.ANTIALIAS)
+		image = self.camera.thumbnails.get(self.dispImgName)
 
 		self.dispImg = ImageTk.PhotoImage(image)
 		self.imglblimg.configure(image=self.dispImg)
 		self.imglblfn.configure(text=self.dispImgName)
+		if hasattr(self, "imglblpos"):
+			self.updateBrowseButtons()
+
+	def updateBrowseButtons(self):
+		'''
+		Shows the position of the display image in the image library, and
+		enables the buttons to browse to older and newer images.
+		'''
+
+		count = self.camera.images.count()
+		self.imglblpos.configure(text="%d of %d" % (self.dispImgIndex + 1 if count > 0 else 0, count))
+		self.imgbut11.config(state=NORMAL if self.dispImgIndex < count - 1 else DISABLED)
+		self.imgbut12.config(state=NORMAL if self.dispImgIndex > 0 else DISABLED)
 
 	def deleteDisplayImage(self):
 		'''
@@ -795,7 +1395,9 @@ class cameraGUI(Frame):
 		else:
 			try:
 				os.remove(self.dispImgName)
-				self.updateDisplayImage()
+				self.camera.images.remove(self.dispImgName)
+				self.dispPageNumber = -1
+				self.updateDisplayImage(self.dispImgIndex)
 			except OSError:
 				print(RED + "Couldn't delete display image." + CLEAR)
 
@@ -859,6 +1461,8 @@ class cameraGUI(Frame):
 
 		newfn = "/".join(self.dispImgName.split("/")[0:-1]) + "/" + fname
 		os.rename(self.dispImgName, newfn)
+		self.camera.images.rename(self.dispImgName, newfn)
+		self.dispPageNumber = -1
 		self.dispImgName = newfn
 		self.imglblfn.configure(text=self.dispImgName)
 		self.renameWindow.destroy()
@@ -869,9 +1473,42 @@ class cameraGUI(Frame):
 		time to reset parameter values.
 		'''
 
-		for i in range(0, 9):
-			if self.entryStringVars[i].get() != self.originalStats[3*i]:
-				self.entryStringVars[i].set(self.originalStats[3*i])
+		values = [(BATCH_PARAMS[i][0], self.originalStats[3*i]) for i in range(0, 9)]
+
+		# The region of interest defaults to the full sensor
+		values += [(BATCH_PARAMS[9+i][0], ROI_DEFAULT[i]) for i in range(0, 4)]
+
+		self.setParams(values)
+
+	def showConnection(self, message, reconnecting):
+		'''
+		Show the state of a lost connection, with a button to stop
+		reconnecting, or to close the message once the client has given up.
+		'''
+
+		if (self.connectionWindow == None) or (self.connectionWindow.winfo_exists() == 0):
+			self.connectionWindow = Toplevel(self)
+			self.connectionWindow.wm_title("Connection to the Pi")
+			self.connectionLabel = Label(self.connectionWindow, wraplength=300)
+			self.connectionLabel.grid(sticky=W, row=0, column=0, padx=6, pady=6)
+			self.connectionButton = Button(self.connectionWindow, width=10)
+			self.connectionButton.grid(row=1, column=0, padx=6, pady=6)
+
+		self.connectionLabel.configure(text=message)
+		if reconnecting:
+			self.connectionWindow.protocol("WM_DELETE_WINDOW", self.camera.giveUp.set)
+			self.connectionButton.configure(text="Give up", command=self.camera.giveUp.set)
+		else:
+			self.connectionWindow.protocol("WM_DELETE_WINDOW", self.closeConnection)
+			self.connectionButton.configure(text="Close", command=self.closeConnection)
+
+	def closeConnection(self):
+		'''
+		Close the connection window.
+		'''
+
+		if (self.connectionWindow != None) and (self.connectionWindow.winfo_exists() == 1):
+			self.connectionWindow.destroy()
 
 	def openStatsWindow(self):
 		'''
@@ -885,8 +1522,16 @@ class cameraGUI(Frame):
 		else:
 			self.statsWindow.focus_set()
 
-		# Get the camera to update its properties
-		self.sendCmd("P")
+		# Get the camera to update its properties, and show them once received
+		self.camera.request(self.snapshot(), self.camera.queryStats, (), self.showStats)
+
+	def showStats(self):
+		'''
+		Shows the camera parameters received by openStatsWindow.
+		'''
+
+		if (self.statsWindow == None) or (self.statsWindow.winfo_exists() == 0):
+			return
 
 		stats = ["Resolution: " + str(self.camera.resolution),
 				"Framerate: " + str(self.camera.framerate) + " fps",
@@ -938,15 +1583,16 @@ class cameraGUI(Frame):
 		try:
 			fid = open(askopenfilename(), "r")
 
+			values = []
 			for ln in fid:
 				val = ln.split(" ")[-1][:-1]
 				var = ln[0:-len(val)-2]
-
-				if self.entrySVs[var].get() != val:
-					self.entrySVs[var].set(val)
+				values.append((var, val))
 
 			fid.close()
 
+			self.setParams(values)
+
 		except IOError:
 			print("Error reading stats file: Tried to open invalid file.")
 
@@ -959,18 +1605,33 @@ class cameraModuleClient:
 		'''
 
 		# Initialise the socket connection
-
-		self.client_socket = socket.socket()
 		print(YELLOW + "Waiting for connection..." + CLEAR)
-		self.client_socket.connect(('192.168.1.1', 8000))
+		self.connect()
 		print(GREEN + "Connection accepted" + CLEAR)
+		self.requestId = 0				# ID of the last request of the versioned protocol
+		self.resumed = None				# Open-ended command started before the connection was lost
+		self.giveUp = threading.Event()	# Set from the GUI to stop reconnecting
 
 		# GUI settings
 		self.useGUI = 0
 		self.procStop = Value('i', 0)
+		self.streamFailed = Value('i', 0)	# Set if the Pi couldn't start the subtraction stream
 		self.videoName = ""
 		self.confStop = ""
-		self.msgSent = 0
+		self.streamProcess = None		# Process running an open-ended command until it is stopped
+		self.error = 0
+		self.streaming = None	# Open-ended command to finish when the stop button is pressed
+
+		# Network I/O worker, which owns the socket while the GUI is running
+		self.requests = Queue.Queue()	# Commands from the GUI
+		self.results = Queue.Queue()	# GUI updates for the Tk thread
+		self.triggers = Queue.Queue()	# Trigger button presses
+		self.gui = {}					# Snapshot of the GUI variables of the current request
+		self.worker = None
+
+		# Index of the downloaded images, and their thumbnails, shown by the GUI
+		self.images = imageLibrary(IMAGE_FOLDER, DISPLAY_TYPES)
+		self.thumbnails = thumbnailCache(DISP_IMG_WIDTH, DISP_IMG_HEIGHT)
 
 		# Camera properties (given in units converted by printStats())
 		self.resolution = 0
@@ -983,92 +1644,283 @@ class cameraModuleClient:
 		self.saturation = 0
 		self.xt = 0
 
+	def connect(self):
+		'''
+		Connect to the Raspberry Pi.
+		'''
+
+		self.client_socket = socket.create_connection(PI_ADDRESS, CONNECT_TIMEOUT)
+		self.client_socket.settimeout(None)
+
+		# Send short messages straight away, rather than waiting for the
+		# acknowledgement of the previous message
+		self.client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+	def reconnect(self, error=None):
+		'''
+		Reconnect to the Raspberry Pi after the connection has been lost,
+		waiting longer after each failed attempt, and resume the session.
+		Returns False if the Pi can't be reached after RECONNECT_ATTEMPTS, or
+		the user gives up from the GUI.
+		'''
+
+		message = "Connection to the Pi lost"
+		if error is not None:
+			message = str(error)
+		print(RED + message + ", reconnecting..." + CLEAR)
+		self.client_socket.close()
+		self.giveUp.clear()
+
+		delay = RECONNECT_DELAY
+		connected = False
+		for attempt in range(1, RECONNECT_ATTEMPTS + 1):
+			if self.useGUI == 1:
+				self.post(self.app.showConnection, message + "\nReconnecting (attempt " + str(attempt) + " of " + str(RECONNECT_ATTEMPTS) + ")...", True)
+			try:
+				self.connect()
+				connected = True
+				break
+			except socket.error:
+				# Waiting on the event lets the GUI give up straight away
+				if attempt == RECONNECT_ATTEMPTS or self.giveUp.wait(delay):
+					break
+				delay = min(delay*2, RECONNECT_MAX)
+
+		if not connected:
+			print(RED + "Could not reconnect to the Pi" + CLEAR)
+			if self.useGUI == 1:
+				self.post(self.app.showConnection, message + "\nCould not reconnect to the Pi. Check that cameraServerTest.py is running, then try the command again.", False)
+			return False
+
+		print(GREEN + "Reconnected" + CLEAR)
+		if self.useGUI == 1:
+			self.post(self.app.closeConnection)
+		self.resume()
+		return True
+
+	def resume(self):
+		'''
+		Re-attach to the session on the Pi after reconnecting. The parameters
+		shown by the GUI are refreshed, an open-ended command started from the
+		GUI carries on until it is stopped, and the files the Pi couldn't send
+		are received once the Pi has finished any other command.
+		'''
+
+		settings, state = self.query([("settings", {}), ("resume", {})])
+		if self.useGUI == 1:
+			for var, name in BATCH_PARAMS:
+				self.setParam(var, str(settings[name][0]))
+
+		running = state["running"]
+		if running is not None and self.useGUI == 1 and running == self.streaming:
+			# Stopping the command also fetches its results
+			print(GREEN + "Command " + running + " is still running" + CLEAR)
+			self.resumed = running
+			return
+
+		if running is not None and self.useGUI == 1 and state["open"]:
+			# The stop button was pressed while the connection was lost
+			self.send_msg(self.client_socket, "Stop")
+
+		if running is not None or state["pending"] > 0:
+			self.send_msg(self.client_socket, "E")
+			self.receivePending()
+
+	def receivePending(self):
+		'''
+		Receive the files the Pi couldn't send while the connection was lost,
+		after sending the E command. The Pi sends them once any command it is
+		running has finished.
+		'''
+
+		if self.useGUI != 1:
+			print(YELLOW + "Downloading files..." + CLEAR)
+
+		while True:
+			msg = self.recv_msg(self.client_socket)
+			if msg == "Q":
+				break
+
+			typ, fname = msg.split(":", 1)
+			if typ == "Video":
+				self.recvFile(os.getcwd() + "/Videos/" + fname)
+			else:
+				self.recvFile(os.getcwd() + "/Images/" + fname)
+				self.images.add(fname)
+				self.thumbnails.prefetch(IMAGE_FOLDER + fname)
+			print(GREEN + "Downloaded " + fname + CLEAR)
+
+		if self.useGUI == 1:
+			self.post(self.app.updateDisplayImage)
+
 	def networkStreamServer(self, duration):
 		'''
-		Recieve a video stream from the Pi, and playback through VLC.
+		Recieve a video stream from the Pi on the stream channel of the
+		control connection, and playback through VLC.
 		'''
 
 		# Determine the framerate of the stream
 		frate = self.recv_msg(self.client_socket)
-		self.msgSent = 0
 
-		# Make a file-like object for the connection
-		connection = self.client_socket.makefile('rb')
+		# Start stream to VLC
+		cmdline = ['vlc', '--demux', 'h264', '--h264-fps', frate, '-']
+		player = subprocess.Popen(cmdline, stdin=subprocess.PIPE)
+		stopped = False
 
-		try:
-			# Start stream to VLC
-			cmdline = ['vlc', '--demux', 'h264', '--h264-fps', frate, '-']
-			player = subprocess.Popen(cmdline, stdin=subprocess.PIPE)
-			while True:
-				# Send data to VLC input
-				data = connection.read(1024)
-				if not data:
+		# Read until the Pi closes the stream channel, so that the connection
+		# is left ready for the next command
+		while True:
+			try:
+				data = self.recvChannel(CHANNEL_STREAM)
+				if data is None:
 					break
-				player.stdin.write(data)
+				if not stopped:
+					# Send data to VLC input
+					with timer("stream relay"):
+						player.stdin.write(data)
 
-				# Finish if stop button is pressed
-				if self.useGUI == 1 and self.procStop.value == 1 and self.app.paramSVs["Stream duration"].get() == str(sys.maxint):
-					raise KeyboardInterrupt
+					# Finish if stop button is pressed
+					if self.useGUI == 1 and self.procStop.value == 1 and self.gui["params"]["Stream duration"] == str(sys.maxint):
+						raise KeyboardInterrupt
 
-		except (KeyboardInterrupt, IOError):
-			self.send_msg(self.client_socket, "Stop")
-			self.msgSent = 1
-			time.sleep(1)
+			except socket.error:
+				raise
+
+			except (KeyboardInterrupt, IOError):
+				# Ask the Pi to stop, and discard the rest of the stream
+				if not stopped:
+					self.send_msg(self.client_socket, "Stop")
+					stopped = True
 
 		# Close resources
-		connection.close()
 		player.terminate()
-
-		if not self.useGUI == 1 or not self.app.paramSVs["Stream duration"].get() == str(sys.maxint):
-			# Free connection resources
-			print(GREEN + "Network stream closed" + CLEAR)
-			self.client_socket.close()
-			self.client_socket = socket.socket()
-			self.client_socket.connect(('192.168.1.1', 8000))
+		print(GREEN + "Network stream closed" + CLEAR)
+		dumpTimings("stream")
 
 	def networkStreamSubtract(self, duration):
 		'''
 		Recieve a video stream from the Pi, and perform image subtraction through openCV.
+		The background image is cropped to the region of interest and resized to
+		the resolution of the stream.
 		'''
 
-		# Determine the framerate of the stream
+		# Determine the framerate, resolution and region of interest of the stream
 		frate = self.recv_msg(self.client_socket)
+		size = [int(x) for x in self.recv_msg(self.client_socket).split("x")]
+		roi = [float(x) for x in self.recv_msg(self.client_socket).split(",")]
 
+		temporary = False
 		try:
 			if self.useGUI == 1:
-				thresh_p = self.app.paramSVs["Threshold percentage"].get()
-				thresh_m = self.app.paramSVs["Threshold magnitude"].get()
+				thresh_p = self.gui["params"]["Threshold percentage"]
+				thresh_m = self.gui["params"]["Threshold magnitude"]
+				detector = self.gui["detector"]
+				policy = self.gui["policy"]
 			else:
 				thresh_p = THRESH_PERCENT_DEFAULT
 				thresh_m = THRESH_MAGNITUDE_DEFAULT
+				detector = DETECTOR_DEFAULT
+				policy = POLICY_DEFAULT
 
 			# Receive a stream from gstreamer, and pipe into the openCV executable.
-			gstcmd = "tcpclientsrc host=192.168.1.1 port=5000 ! gdpdepay ! rtph264depay ! video/x-h264, framerate=" + frate + "/1 ! avdec_h264 ! videoconvert ! queue max-size-buffers=0 max-size-time=0 max-size-bytes=0 ! appsink"
+			# The queue is bounded, so that frames back up into the ring of the
+			# subtraction, whose policy decides what happens when it falls
+			# behind. The drop policies let the queue drop its oldest frames.
+			leaky = " leaky=downstream" if policy != "block" else ""
+			gstcmd = "tcpclientsrc host=192.168.1.1 port=5000 ! gdpdepay ! rtph264depay ! video/x-h264, framerate=" + frate + "/1 ! avdec_h264 ! videoconvert ! queue max-size-buffers=" + str(STREAM_QUEUE) + " max-size-time=0 max-size-bytes=0" + leaky + " ! appsink"
+
+			# The subtraction library shards detection across all cores of this computer
+			subline = [sys.executable, 'cameraLibSubtract.py', '-vid', gstcmd, thresh_p, thresh_m, '-detector', detector, '-policy', policy]
 
 			# Determine whether a static image is used as the background
-			if self.useGUI == 0 or (self.useGUI == 1 and self.app.entrySVs["Background image"].get() == ""):
-				subline = ['./BackGroundSubbThread', '-vid', gstcmd, thresh_p, thresh_m]
-			else:
-				subline = ['./BackGroundSubbThread', '-vid', gstcmd, thresh_p, thresh_m, '-back', os.getcwd() + '/Images/' + self.app.entrySVs["Background image"].get()]
+			if self.useGUI == 1 and self.gui["entries"]["Background image"] != "":
+				background, temporary = self.prepareBackground(self.gui["entries"]["Background image"], size, roi)
+				subline += ['-back', background]
 
-			# Initiate the background subtraction process
-			time.sleep(0.1)
+			# Initiate the background subtraction process once the Pi is
+			# listening for the stream
+			self.streamFailed.value = 0
+			confirm = self.recv_msg(self.client_socket)
+			if confirm != "Listening":
+				print(RED + confirm + CLEAR)
+				self.streamFailed.value = 1
+				return
 			player = subprocess.Popen(subline, preexec_fn=os.setpgrp)
 
-			if self.useGUI == 1 and self.app.paramSVs["Subtraction duration"].get() == str(sys.maxint):
-				# Stop when stop button is pressed or process has ended
-				while player.poll() == None:
-					if self.procStop.value == 1:
+			if self.useGUI == 1 and self.gui["params"]["Subtraction duration"] == str(sys.maxint):
+				# Stop when stop button is pressed. If the stream was lost,
+				# connect to it again, until it can't be opened after
+				# RECONNECT_ATTEMPTS. The Pi is told to stop once the window
+				# is closed, the subtraction fails, or the stream is gone
+				delay = RECONNECT_DELAY
+				attempts = 0
+				while True:
+					while player.poll() == None:
+						if self.procStop.value == 1:
+							raise KeyboardInterrupt
+						time.sleep(SUBTRACT_POLL)
+
+					if player.returncode == STREAM_ENDED:
+						delay = RECONNECT_DELAY
+						attempts = 0
+					elif player.returncode == STREAM_FAILED and attempts < RECONNECT_ATTEMPTS:
+						attempts += 1
+					else:
+						if player.returncode == STREAM_FAILED:
+							print(RED + "Could not reconnect to the subtraction stream" + CLEAR)
 						raise KeyboardInterrupt
+
+					print(RED + "Subtraction stream lost, reconnecting..." + CLEAR)
+					end = time.time() + delay
+					while time.time() < end:
+						if self.procStop.value == 1:
+							raise KeyboardInterrupt
+						time.sleep(SUBTRACT_POLL)
+					delay = min(delay*2, RECONNECT_MAX)
+					player = subprocess.Popen(subline, preexec_fn=os.setpgrp)
 			else:
 				# Wait for executable to exit
 				player.wait()
 
 		except KeyboardInterrupt:
-			# Tell the Raspberry Pi to stop the process
-			self.send_msg(self.client_socket, "Stop")
+			# Tell the Raspberry Pi to stop the process. If the connection
+			# has been lost, the reconnected client stops it instead
+			try:
+				self.send_msg(self.client_socket, "Stop")
+			except socket.error:
+				player.terminate()
 			player.wait()
 
+		finally:
+			# Remove the background made for the stream, once the subtraction
+			# has exited
+			if temporary:
+				os.remove(background)
+
+	def prepareBackground(self, fname, size, roi):
+		'''
+		Returns the path of the background image used for image subtraction,
+		and whether it is a temporary file to remove afterwards. The background
+		is masked to the region of interest (x, y, width, height as fractions
+		of the frame) and resized to the resolution of the stream.
+		'''
+
+		filepath = os.getcwd() + "/Images/" + fname
+		image = Image.open(filepath)
+
+		# Crop the full frame background to the region of interest
+		if list(roi) != [0.0, 0.0, 1.0, 1.0]:
+			box = (int(roi[0]*image.size[0]), int(roi[1]*image.size[1]), int((roi[0]+roi[2])*image.size[0]), int((roi[1]+roi[3])*image.size[1]))
+			image = image.crop(box)
+		elif list(image.size) == list(size):
+			return filepath, False
+
+		# Store the cropped and resized background in a temporary file
+		fd, tmppath = tempfile.mkstemp(suffix=".png")
+		os.close(fd)
+		image.resize((size[0], size[1]), Image.ANTIALIAS).save(tmppath)
+		return tmppath, True
+
 	def returnThreshold(self):
 		'''
 		Returns the threshold parameter for image subtraction (what /% of the
@@ -1092,7 +1944,7 @@ class cameraModuleClient:
 
 			# Finding extension of filename
 			parts = fn.split(".")
-			if (len(parts) > 1) and ((parts[-1] in IMAGE_TYPES) or (parts[-1] in VIDEO_TYPES)):
+			if (len(parts) > 1) and ((parts[-1] in IMAGE_TYPES) or (parts[-1] in RAW_TYPES) or (parts[-1] in VIDEO_TYPES)):
 				ext = "." + parts[-1]
 				fn = fn[0:-len(ext)]
 			else:
@@ -1110,8 +1962,9 @@ class cameraModuleClient:
 					parts[-1] = str(int(parts[-1]) + 1)
 					newfn = "-".join(parts) + ext
 
-			self.app.entrySVs[param].set(newfn)
+			self.setEntry(param, newfn)
 
+	@timed("send_msg")
 	def send_msg(self, sock, msg):
 		'''
 		Send message with a prefixed length.
@@ -1121,6 +1974,7 @@ class cameraModuleClient:
 		msg = struct.pack('>I', len(msg)) + msg
 		sock.sendall(msg)
 
+	@timed("recv_msg")
 	def recv_msg(self, sock):
 		'''
 		Receive a message from the network.
@@ -1128,8 +1982,6 @@ class cameraModuleClient:
 
 		# Read message length and unpack it into an integer
 		raw_msglen = self.recvall(sock, 4)
-		if not raw_msglen:
-			return None
 		msglen = struct.unpack('>I', raw_msglen)[0]
 
 		# Read the message data
@@ -1140,16 +1992,153 @@ class cameraModuleClient:
 		Decode the message given the message length.
 		'''
 
-		# Helper function to recv n bytes or return None if EOF is hit
+		# Helper function to recv n bytes, the connection has been lost if EOF is hit
 		data = ''
 		while len(data) < n:
 			packet = sock.recv(n - len(data))
 			if not packet:
-				return None
+				raise socket.error("Connection to the Pi lost (Command may have failed, may need to lower resolution or framerate)")
 			data += packet
 
 		return data
 
+	def recvChannel(self, channel):
+		'''
+		Receive the next block of data sent on a channel of the control
+		connection, or None once the Pi has closed the channel.
+		'''
+
+		msg = self.recv_msg(self.client_socket)
+		if not isMessage(msg):
+			raise Exception("Expected data on channel " + str(channel) + ", received: " + msg)
+
+		version, kind, rid, payload = unpackMessage(msg)
+		if rid != channel or kind not in (KIND_DATA, KIND_CLOSE):
+			raise Exception("Unexpected message while receiving channel " + str(channel))
+		return payload
+
+	def recvFile(self, filepath, mode="wb"):
+		'''
+		Receive a file sent on the file channel of the control connection,
+		appending to the file with mode "ab".
+		'''
+
+		with open(filepath, mode) as f:
+			while True:
+				data = self.recvChannel(CHANNEL_FILE)
+				if data is None:
+					break
+				with timer("file write"):
+					f.write(data)
+
+	def query(self, requests):
+		'''
+		Send a list of (method, args) requests of the versioned protocol to the
+		Pi without waiting for each answer, and return their results in the
+		order requested. The Pi may answer them in any order.
+		'''
+
+		ids = []
+		for method, args in requests:
+			self.requestId += 1
+			ids.append(self.requestId)
+			self.send_msg(self.client_socket, packMessage(KIND_REQUEST, self.requestId, {"method": method, "args": args}))
+
+		# Collect every response before checking for errors, so that none are
+		# left unread on the connection
+		replies = {}
+		while len(replies) < len(ids):
+			msg = self.recv_msg(self.client_socket)
+			version, kind, rid, payload = unpackMessage(msg)
+			replies[rid] = (version, kind, payload)
+
+		results = []
+		for rid, (method, args) in zip(ids, requests):
+			version, kind, payload = replies[rid]
+			if version != PROTOCOL_VERSION:
+				raise Exception("Pi uses protocol version " + str(version) + ", expected " + str(PROTOCOL_VERSION))
+			if kind == KIND_ERROR:
+				raise Exception(method + " request failed: " + payload["error"])
+			results.append(payload["result"])
+
+		return results
+
+	def queryStats(self):
+		'''
+		Fetch the image/video stats from the Pi.
+		'''
+
+		self.setStats(self.query([("stats", {})])[0])
+
+	def printTelemetry(self):
+		'''
+		Fetch and print the telemetry of the Pi.
+		'''
+
+		values = self.query([("telemetry", {})])[0]
+		print("\nTelemetry: ")
+		for name in sorted(values):
+			print("	" + name + ": " + str(values[name]))
+		print("")
+
+	def manageJobs(self):
+		'''
+		Submit or cancel a background job on the Pi, then print the jobs.
+		Background jobs run alongside other commands, and their files are
+		downloaded with the E command once they have finished.
+		'''
+
+		action = ""
+		if self.useGUI != 1:
+			action = str(raw_input("R: background recording, W: background time-lapse, C: cancel a job, Enter: list jobs: ")).upper()
+
+		try:
+			if action == "R":
+				duration = float(raw_input("Recording duration (seconds): "))
+				self.query([("submit", {"job": "record", "duration": duration})])
+			elif action == "W":
+				interval = float(raw_input("Time-lapse interval (seconds): "))
+				duration = float(raw_input("Time-lapse duration (seconds): "))
+				self.query([("submit", {"job": "timelapse", "interval": interval, "duration": duration})])
+			elif action == "C":
+				jid = int(raw_input("Job ID: "))
+				self.query([("cancel", {"id": jid})])
+		except ValueError:
+			print(RED + "Invalid value" + CLEAR)
+		except Exception as e:
+			print(RED + str(e) + CLEAR)
+
+		jobs = self.query([("jobs", {})])[0]
+		print("\nJobs: ")
+		for job in jobs:
+			line = "	" + str(job["id"]) + ": " + job["name"] + " " + job["state"]
+			if len(job["ports"]) > 0:
+				line += " on ports " + ", ".join(str(port) for port in job["ports"])
+			if job["result"] is not None:
+				line += " - " + str(job["result"])
+			if job["error"] is not None:
+				line += " - " + job["error"]
+			print(line)
+		print("")
+
+	def setStats(self, stats):
+		'''
+		Store the image/video stats received from a "stats" request, in the
+		units used by printStats().
+		'''
+
+		self.resolution = str(stats["width"]) + "x" + str(stats["height"])
+		self.framerate = str(stats["framerate"])
+		self.brightness = str(stats["brightness"])
+		self.again = str(float(stats["analog gain"]))
+		self.dgain = str(float(stats["digital gain"]))
+		self.xt = str(stats["exposure time"])
+
+		# Convert contrast, sharpness, saturation to percentage
+		self.contrast = str((int(stats["contrast"])+100)/2)
+		self.sharpness = str((int(stats["sharpness"])+100)/2)
+		self.saturation = str((int(stats["saturation"])+100)/2)
+
 	def printCommands(self):
 		'''
 		Print a list of commands.
@@ -1158,10 +2147,17 @@ class cameraModuleClient:
 		print("\nList of commands: ")
 		print("B: Set brightness")
 		print("C: Set contrast")
+		print("D: Record with image subtraction")
+		print("E: Download files missed while disconnected")
 		print("F: Set framerate")
 		print("G: Set gain")
 		print("H: Help")
 		print("I: Capture an image")
+		print("J: Manage background jobs")
+		print("K: Capture a stacked low-noise image")
+		if self.useGUI == 1:
+			print("L: Live preview")
+		print("M: Set several parameters at once")
 		print("N: Stream to network")
 		print("O: Stream with image subtraction")
 		print("P: Get camera settings")
@@ -1171,20 +2167,10 @@ class cameraModuleClient:
 		print("T: Capture with trigger")
 		print("U: Set saturation")
 		print("V: Capture a video")
-		print("X: Set exposure time\n")
-
-	def receiveAll(self):
-		'''
-		Receive all camera properties for use by the GUI.
-		'''
-
-		result = []
-
-		# Fetch all camera properties, including mins and maxs
-		for i in range(27):
-			result.append(self.recv_msg(self.client_socket))
-
-		return result
+		print("W: Capture a time-lapse")
+		print("X: Set exposure time")
+		print("Y: Show telemetry")
+		print("Z: Set region of interest\n")
 
 	def processIntParameter(self, param):
 		'''
@@ -1204,7 +2190,7 @@ class cameraModuleClient:
 		# Input parameter value from terminal or GUI
 		while True:
 			if self.useGUI == 1:
-				value = self.app.entrySVs[param].get()
+				value = self.gui["entries"][param]
 			else:
 				value = str(raw_input(param + " (Default: " + str(default) + ", Min: " + str(minimum) + ", Max: " + str(maximum) + "): "))
 
@@ -1217,14 +2203,14 @@ class cameraModuleClient:
 				if float(value) < float(minimum):
 					if self.useGUI == 1:
 						value = default
-						self.app.error = 1
+						self.error = 1
 						break
 					else:
 						print(RED + "Value is less than minimum" + CLEAR)
 				elif float(value) > float(maximum):
 					if self.useGUI == 1:
 						value = default
-						self.app.error = 1
+						self.error = 1
 						break
 					else:
 						print(RED + "Value is greater than maximum" + CLEAR)
@@ -1237,7 +2223,7 @@ class cameraModuleClient:
 				# Condition for parameter inputs that are not integers
 				if self.useGUI == 1:
 					value = default
-					self.app.error = 1
+					self.error = 1
 					break
 				else:
 					print(RED + "Not a number" + CLEAR)
@@ -1247,22 +2233,53 @@ class cameraModuleClient:
 
 		# Receive confirmation message from the Pi.
 		confirm = self.recv_msg(self.client_socket)
-		if confirm == None:
-			raise Exception("Command Failed (May need to lower resolution or framerate)")
+		if self.useGUI == 1 and self.error == 0:
+			if "Resolution" in confirm:
+				confirm = "Resolution changed"
+		elif self.useGUI == 1 and self.error == 1:
+			self.error = 0
 		else:
-			if self.useGUI == 1 and self.app.error == 0:
-				if "Resolution" in confirm:
-					confirm = "Resolution changed"
-			elif self.useGUI == 1 and self.app.error == 1:
-				self.app.error = 0
-			else:
-				print(GREEN + confirm + CLEAR)
+			print(GREEN + confirm + CLEAR)
 
 		if self.useGUI == 1:
-			self.app.paramSVs[param].set(value)
+			self.setParam(param, value)
 
 		return value
 
+	def processParameters(self):
+		'''
+		Send every camera parameter to the Pi in a single message, and receive
+		the result with the values used by the Pi.
+		'''
+
+		params = {}
+		if self.useGUI == 1:
+			for var, name in BATCH_PARAMS:
+				value = self.gui["entries"][var]
+				params[name] = value if value != "" else "0"
+		else:
+			line = str(raw_input("Parameters (e.g. Brightness=50, Contrast=10): "))
+			for pair in line.split(","):
+				if "=" in pair:
+					name, value = pair.split("=", 1)
+					params[name.strip()] = value.strip()
+
+		self.send_msg(self.client_socket, json.dumps(params))
+
+		result = json.loads(self.recv_msg(self.client_socket))
+
+		# The parameters are either all changed, or all unchanged
+		for name in result["errors"]:
+			print(RED + name + ": " + result["errors"][name] + CLEAR)
+		if len(result["errors"]) == 0 and self.useGUI != 1:
+			print(GREEN + "Parameters changed" + CLEAR)
+
+		if self.useGUI == 1:
+			for var, name in BATCH_PARAMS:
+				self.setParam(var, str(result["values"][name]))
+
+		return result
+
 	def processStrParameter(self, param):
 		'''
 		Decides on an appropriate string parameter (file name) and send it to Pi.
@@ -1275,7 +2292,7 @@ class cameraModuleClient:
 
 		# Input parameter value from terminal or GUI
 		if self.useGUI == 1:
-			value = self.app.entrySVs[param].get()
+			value = self.gui["entries"][param]
 		else:
 			value = str(raw_input(param + " (Default: " + str(default) + "): "))
 
@@ -1292,7 +2309,7 @@ class cameraModuleClient:
 
 		# Add extension if there is no appropriate extension currently
 		if (param == "Image filename"):
-			if ftype not in IMAGE_TYPES:
+			if ftype not in IMAGE_TYPES + RAW_TYPES:
 				value += DEFAULT_IMAGE_TYPE
 		elif (param == "Video filename"):
 			if ftype not in VIDEO_TYPES:
@@ -1303,11 +2320,8 @@ class cameraModuleClient:
 
 		# Receive start confirmation message from the Pi.
 		confirm = self.recv_msg(self.client_socket)
-		if confirm == None:
-			raise Exception("Command Failed (May need to lower resolution or framerate)")
-		else:
-			if self.useGUI != 1:
-				print(YELLOW + confirm + CLEAR)
+		if self.useGUI != 1:
+			print(YELLOW + confirm + CLEAR)
 
 		try:
 			# Receive finish confirmation message from the Pi.
@@ -1317,11 +2331,8 @@ class cameraModuleClient:
 			self.send_msg(self.client_socket, "Stop")
 			confirm = self.recv_msg(self.client_socket)
 
-		if confirm == None:
-			raise Exception("Command Failed (May need to lower resolution or framerate)")
-		else:
-			if self.useGUI != 1:
-				print(GREEN + confirm + CLEAR)
+		if self.useGUI != 1:
+			print(GREEN + confirm + CLEAR)
 
 		return value
 
@@ -1339,7 +2350,7 @@ class cameraModuleClient:
 
 		# Input parameter value from terminal or GUI
 		if self.useGUI == 1:
-			value = self.app.entrySVs[param].get()
+			value = self.gui["entries"][param]
 		else:
 			value = str(raw_input(param + " (Default: " + str(default) + "): "))
 
@@ -1364,11 +2375,8 @@ class cameraModuleClient:
 
 		# Receive start confirmation message from the Pi.
 		confirm = self.recv_msg(self.client_socket)
-		if confirm == None:
-			raise Exception("Command Failed (May need to lower resolution or framerate)")
-		else:
-			if self.useGUI != 1:
-				print(YELLOW + confirm + CLEAR)
+		if self.useGUI != 1:
+			print(YELLOW + confirm + CLEAR)
 
 		return value
 
@@ -1382,9 +2390,13 @@ class cameraModuleClient:
 			# Stop the process by setting the value
 			if self.procStop.value == 1:
 				break
-		# Send message to stop recording if Ctrl+C is pressed
-		self.send_msg(self.client_socket, "Stop")
-		self.confStop = self.recv_msg(self.client_socket)
+		# Send message to stop recording if Ctrl+C is pressed. If the
+		# connection has been lost, the reconnected client stops it instead
+		try:
+			self.send_msg(self.client_socket, "Stop")
+			self.confStop = self.recv_msg(self.client_socket)
+		except socket.error:
+			pass
 
 	def printStats(self):
 		'''
@@ -1435,11 +2447,12 @@ class cameraModuleClient:
 		if self.useGUI != 1:
 			print(YELLOW + "Downloading file..." + CLEAR)
 
-		# Must have Netcat installed on the command-line
+		# Files are received on the file channel of the control connection
 		if typ == "Image":
-			time.sleep(0.1)
 			filepath = os.getcwd() + "/Images/" + fname
-			os.system("nc 192.168.1.1 60000 > " + filepath)
+			self.recvFile(filepath)
+			self.images.add(fname)
+			self.thumbnails.prefetch(IMAGE_FOLDER + fname)
 
 		elif typ == "Trigger":
 			while True:
@@ -1451,25 +2464,82 @@ class cameraModuleClient:
 					break
 				else:
 					fname = fname.split("/")[-1]
-					time.sleep(0.1)
 					filepath = os.getcwd() + "/Images/" + fname
-					os.system("nc 192.168.1.1 60000 > " + filepath)
+					self.recvFile(filepath)
+					self.images.add(fname)
+					self.thumbnails.prefetch(IMAGE_FOLDER + fname)
 
 		elif typ == "Video":
-			time.sleep(0.1)
 			filepath = os.getcwd() + "/Videos/" + fname
-			os.system("nc 192.168.1.1 60000 > " + filepath)
+			self.recvFile(filepath)
 
 		if self.useGUI != 1:
 			print(GREEN + "Downloaded file" + CLEAR)
 
+	def receiveTimeLapse(self):
+		'''
+		Receive the images of a time-lapse as the Pi captures them, until the
+		duration has passed or Ctrl+C is pressed, and print the jitter of each
+		image.
+		'''
+
+		if self.useGUI != 1:
+			print(CYAN + "Note: Press Ctrl+C to stop the time-lapse" + CLEAR)
+
+		# Read until the Pi has sent every image, so that the connection is
+		# left ready for the next command
+		stopped = False
+		while True:
+			try:
+				msg = self.recv_msg(self.client_socket)
+			except KeyboardInterrupt:
+				# Ask the Pi to stop, and receive the remaining images
+				if not stopped:
+					self.send_msg(self.client_socket, "Stop")
+					stopped = True
+				continue
+			if msg == "Q":
+				break
+
+			typ, index, jitter, fname = msg.split(":", 3)
+			filepath = os.getcwd() + "/Images/" + fname
+			try:
+				self.recvFile(filepath)
+			except KeyboardInterrupt:
+				# Finish the image, so the file channel isn't left unread
+				if not stopped:
+					self.send_msg(self.client_socket, "Stop")
+					stopped = True
+				self.recvFile(filepath, "ab")
+			self.images.add(fname)
+			self.thumbnails.prefetch(IMAGE_FOLDER + fname)
+			if self.useGUI != 1:
+				print(GREEN + "Image " + index + ": " + fname + ", jitter " + jitter + " ms" + CLEAR)
+
+		confirm = self.recv_msg(self.client_socket)
+		if self.useGUI != 1:
+			print(GREEN + confirm + CLEAR)
+
+	def receiveRecording(self):
+		'''
+		Receive the finish confirmation, statistics and video file of a
+		recording made with the "D" command.
+		'''
+
+		confirm = self.recv_msg(self.client_socket)
+		if self.useGUI != 1:
+			print(GREEN + confirm + CLEAR)
+
+		self.printStats()
+		self.receiveFile(self.videoName, "Video")
+
 	def getTriggerMode(self):
 		'''
 		Identifies whether trigger mode 1 or trigger mode 2 is being used.
 		'''
 
 		if self.useGUI == 1:
-			mode = self.app.triggerMode
+			mode = self.gui["triggerMode"]
 		else:
 			print(CYAN + "Note: Option 1 uses the video port, which means there is a latency of 0-300 ms," + CLEAR)
 			print(CYAN + "  but allows images to be taken in rapid succession." + CLEAR)
@@ -1492,9 +2562,8 @@ class cameraModuleClient:
 		while True:
 			if self.useGUI == 1:
 				# Waits until either capture or stop button have been clicked
-				# When these buttons are clicked, they also update app.trigger
-				self.app.imgbut.wait_variable(self.app.trigger)
-				trigger = self.app.trigger.get()
+				# When these buttons are clicked, they queue the trigger
+				trigger = self.triggers.get()
 			else:
 				trigger = str(raw_input("Trigger (T for capture, Q for quit): ")).upper()
 
@@ -1514,9 +2583,9 @@ class cameraModuleClient:
 		'''
 
 		# List of commands
-		opt = ["B","C","F","G","H","I","N","O","P","Q","R","S","T","U","V","X"]
-
-		time.sleep(0.1)
+		opt = ["B","C","D","E","F","G","H","I","J","K","M","N","O","P","Q","R","S","T","U","V","W","X","Y","Z"]
+		if self.useGUI == 1:
+			opt.append("L")
 
 		if self.useGUI == 1:
 			command = useCmd
@@ -1542,6 +2611,28 @@ class cameraModuleClient:
 		elif command == "C":
 			self.processIntParameter("Contrast")
 
+		# Record at full resolution with image subtraction on a downscaled stream
+		elif command == "D":
+			duration = self.processIntParameter("Subtraction duration")
+			self.videoName = self.filenameGUI("Video filename")
+			self.nextFilename(self.videoName, "Video filename")
+			if self.useGUI == 1 and self.gui["params"]["Subtraction duration"] == str(sys.maxint):
+				self.procStop.value = 0
+				self.streaming = command
+				self.streamProcess = Process(target = self.networkStreamSubtract, args=(duration,))
+				self.streamProcess.start()
+			else:
+				print(CYAN + "Note: Press Ctrl+C to exit recording" + CLEAR)
+				self.networkStreamSubtract(duration)
+				if self.streamFailed.value == 0:
+					self.receiveRecording()
+				if self.useGUI == 1:
+					self.post(self.app.disableWidgets, self.root, "Enable")
+
+		# Receive files the Pi couldn't send while the connection was lost
+		elif command == "E":
+			self.receivePending()
+
 		# Change framerate
 		elif command == "F":
 			self.processIntParameter("Framerate (fps)")
@@ -1563,34 +2654,63 @@ class cameraModuleClient:
 			self.receiveFile(filename, "Image")
 			if self.useGUI == 1:
 				self.nextFilename(filename, "Image filename")
-				self.app.updateDisplayImage()
+				self.post(self.app.updateDisplayImage)
+
+		# Capture the mean of several frames
+		elif command == "K":
+			self.processIntParameter("Stacked frames")
+			if self.useGUI != 1:
+				print(CYAN + "Note: Reject outliers with 1, or keep them with 0" + CLEAR)
+			self.processIntParameter("Reject outliers")
+			filename = self.processStrParameter("Image filename")
+			self.printStats()
+			self.receiveFile(filename, "Image")
+			if self.useGUI == 1:
+				self.nextFilename(filename, "Image filename")
+				self.post(self.app.updateDisplayImage)
+
+		# Live preview in the GUI
+		elif command == "L":
+			self.processIntParameter("Stream duration")
+
+			# The Pi sends the preview resolution once it is ready for the connection
+			size = self.recv_msg(self.client_socket)
+			preview = livePreview('192.168.1.1', PREVIEW_PORT)
+			self.streaming = command
+			self.post(self.app.startPreview, preview, size)
+
+		# Set several parameters at once
+		elif command == "M":
+			self.processParameters()
 
 		# Network stream
 		elif command == "N":
 			duration = self.processIntParameter("Stream duration")
-			if self.useGUI == 1 and self.app.paramSVs["Stream duration"].get() == str(sys.maxint):
+			if self.useGUI == 1 and self.gui["params"]["Stream duration"] == str(sys.maxint):
 				self.procStop.value = 0
-				prc = Process(target = self.networkStreamServer, args=(duration,))
-				prc.start()
+				self.streaming = command
+				self.streamProcess = Process(target = self.networkStreamServer, args=(duration,))
+				self.streamProcess.start()
 			else:
 				print(CYAN + "Note: Press Ctrl+C to exit recording" + CLEAR)
 				self.networkStreamServer(duration)
 				if self.useGUI == 1:
-					self.app.disableWidgets(self.root, "Enable")
+					self.post(self.app.disableWidgets, self.root, "Enable")
 
 		# Network subtract stream
 		elif command == "O":
 			#if self.useGUI == 1 and self.isCorrectBackground(self.app.paramSVs["Background image"].get()) == True:
 			duration = self.processIntParameter("Subtraction duration")
-			if self.useGUI == 1 and self.app.paramSVs["Subtraction duration"].get() == str(sys.maxint):
+			if self.useGUI == 1 and self.gui["params"]["Subtraction duration"] == str(sys.maxint):
 				self.procStop.value = 0
-				prc = Process(target = self.networkStreamSubtract, args=(duration,))
-				prc.start()
+				self.streaming = command
+				self.streamProcess = Process(target = self.networkStreamSubtract, args=(duration,))
+				self.streamProcess.start()
 			else:
 				print(CYAN + "Note: Press Ctrl+C to exit recording" + CLEAR)
 				self.networkStreamSubtract(duration)
 				if self.useGUI == 1:
-					self.app.disableWidgets(self.root, "Enable")
+					self.post(self.app.disableWidgets, self.root, "Enable")
 			#elif self.useGUI == 1:
 			#	time.sleep(1)
 			#	self.app.disableWidgets(self.root, "Enable")
@@ -1610,13 +2730,16 @@ class cameraModuleClient:
 
 		# Capture with trigger
 		elif command == "T":
+			# Discard trigger button presses from earlier trigger modes
+			while not self.triggers.empty():
+				self.triggers.get()
 			mode = self.getTriggerMode()
 			self.send_msg(self.client_socket, mode)
 			self.sendTrigger()
 			self.receiveFile("", "Trigger")
 			if self.useGUI == 1:
-				self.app.disableWidgets(self.root, "Enable")
-				self.app.updateDisplayImage()
+				self.post(self.app.disableWidgets, self.root, "Enable")
+				self.post(self.app.updateDisplayImage)
 
 		# Set saturation
 		elif command == "U":
@@ -1625,12 +2748,13 @@ class cameraModuleClient:
 		# Capture stream
 		elif command == "V":
 			self.processIntParameter("Video duration")
-			if self.useGUI == 1 and self.app.paramSVs["Video duration"].get() == str(sys.maxint):
+			if self.useGUI == 1 and self.gui["params"]["Video duration"] == str(sys.maxint):
 				self.videoName = self.filenameGUI("Video filename")
 				self.nextFilename(self.videoName, "Video filename")
 				self.procStop.value = 0
-				prc = Process(target = self.videoGUI)
-				prc.start()
+				self.streaming = command
+				self.streamProcess = Process(target = self.videoGUI)
+				self.streamProcess.start()
 			else:
 				print(CYAN + "Note: Press Ctrl+C to exit recording" + CLEAR)
 				self.videoName = self.processStrParameter("Video filename")
@@ -1638,7 +2762,7 @@ class cameraModuleClient:
 				self.printStats()
 				self.receiveFile(self.videoName, "Video")
 				if self.useGUI == 1:
-					self.app.disableWidgets(self.root, "Enable")
+					self.post(self.app.disableWidgets, self.root, "Enable")
 
 		# Change exposure time
 		elif command == "X":
@@ -1646,26 +2770,168 @@ class cameraModuleClient:
 				print(CYAN + "Note: Exposure time of 0 automatically sets the exposure time" + CLEAR)
 			self.processIntParameter("Exposure time (microseconds)")
 
+		# Capture a time-lapse
+		elif command == "W":
+			self.processIntParameter("Time-lapse interval")
+			self.processIntParameter("Time-lapse duration")
+			self.receiveTimeLapse()
+
+		# Submit, cancel and list background jobs
+		elif command == "J":
+			self.manageJobs()
+
+		# Show the counters and gauges of the Pi
+		elif command == "Y":
+			self.printTelemetry()
+
+		# Change region of interest
+		elif command == "Z":
+			if self.useGUI != 1:
+				print(CYAN + "Note: Region of interest is given as a percentage of the sensor" + CLEAR)
+			self.processIntParameter("ROI x")
+			self.processIntParameter("ROI y")
+			self.processIntParameter("ROI width")
+			self.processIntParameter("ROI height")
+
 		return command
 
+	def stopStream(self, useCmd):
+		'''
+		Finish an open-ended command after the stop button has been pressed.
+		Commands with a duration finish by themselves.
+		'''
+
+		if self.streaming != useCmd:
+			return
+		self.streaming = None
+
+		if useCmd == "L":
+			# Tell the Pi to stop the live preview
+			self.send_msg(self.client_socket, "Stop")
+			return
+
+		if self.resumed == useCmd:
+			# The Pi keeps the results of a command started before the
+			# connection was lost, so stop it and then fetch them
+			self.resumed = None
+			self.send_msg(self.client_socket, "Stop")
+			self.streamProcess.join()
+			self.streamProcess = None
+			self.send_msg(self.client_socket, "E")
+			self.receivePending()
+			return
+
+		# Wait for the stream/record process to tell the Pi to stop. The
+		# process of the "N" command also reads the rest of the stream, which
+		# leaves the connection ready for the next command
+		self.streamProcess.join()
+		self.streamProcess = None
+
+		if useCmd == "V":
+			# Receive the video file
+			self.printStats()
+			self.receiveFile(self.videoName, "Video")
+
+		elif useCmd == "D" and self.streamFailed.value == 0:
+			# Receive the full resolution recording, which the Pi abandons if
+			# the stream failed
+			self.receiveRecording()
+
+	def request(self, snapshot, function, args=(), callback=None):
+		'''
+		Queue a function for the network I/O worker, with a snapshot of the GUI
+		variables it may use. The callback is run on the Tk thread afterwards.
+		'''
+
+		self.requests.put((snapshot, function, args, callback))
+
+	def post(self, function, *args):
+		'''
+		Run a GUI update on the Tk thread, from the network I/O worker.
+		'''
+
+		if self.useGUI == 1:
+			self.results.put((function, args))
+		else:
+			function(*args)
+
+	def setParam(self, param, value):
+		'''
+		Update a parameter value in the snapshot, and in the GUI.
+		'''
+
+		self.gui["params"][param] = value
+		self.post(self.app.paramSVs[param].set, value)
+
+	def setEntry(self, param, value):
+		'''
+		Update an entry value in the snapshot, and in the GUI.
+		'''
+
+		self.gui["entries"][param] = value
+		self.post(self.app.entrySVs[param].set, value)
+
+	def ioWorker(self):
+		'''
+		Thread which performs the queued requests one at a time, so that all
+		network I/O happens off the Tk thread. Runs until a None request.
+		'''
+
+		while True:
+			request = self.requests.get()
+			if request is None:
+				break
+
+			snapshot, function, args, callback = request
+			self.gui = snapshot
+			try:
+				function(*args)
+			except socket.error as e:
+				# Resume the session on a new connection, and abandon the request
+				traceback.print_exc()
+				if not self.reconnect(e) or self.resumed is None:
+					self.post(self.app.disableWidgets, self.root, "Enable")
+			except Exception:
+				traceback.print_exc()
+				self.post(self.app.disableWidgets, self.root, "Enable")
+
+			if callback is not None:
+				self.post(callback)
+
 	def runGUI(self):
 		'''
-		Initialise the camera GUI, and run the GUI loop.
+		Initialise the camera GUI, and run the GUI loop. Network I/O is
+		performed by a worker thread while the GUI loop runs.
 		'''
 
 		self.useGUI = 1
 		self.root = Tk()
 		self.root.geometry("675x415+150+150")
 		self.app = cameraGUI(self.root, self)
+
+		self.worker = threading.Thread(target=self.ioWorker)
+		self.worker.daemon = True
+		self.worker.start()
+		self.root.after(POLL_INTERVAL, self.app.pollResults)
+
 		self.root.mainloop()
 
+		# Wake the worker if it waits for a stop or trigger button, or to
+		# reconnect, then finish the remaining requests, including quitting
+		# the Pi. The worker is left behind if the Pi doesn't answer
+		self.procStop.value = 1
+		self.triggers.put("Q")
+		self.giveUp.set()
+		self.requests.put(None)
+		self.worker.join(QUIT_TIMEOUT)
+
 	def quitGUI(self, app):
 		'''
 		Quit the GUI, and tell the Raspberry Pi to quit also.
 		'''
 
+		self.request(app.snapshot(), self.sendCommand, ("Q",))
 		app.quit()
-		self.sendCommand("Q")
 
 	def closeServer(self):
 		'''
@@ -1675,3 +2941,6 @@ class cameraModuleClient:
 		# Close the connection and socket
 		print(YELLOW + "Closing socket..." + CLEAR)
 		self.client_socket.close()
+
+		# Print the timings of the session, if enabled
+		dumpTimings("session")
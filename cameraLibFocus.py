@@ -0,0 +1,97 @@
+'''
+Library for measuring the focus of the camera, to speed up manual focusing.
+
+The focus score is the variance of the Laplacian of the luminance: the
+Laplacian responds to edges and fine detail, which spread out and fade as the
+image goes out of focus, so the score peaks when the image is in focus. The
+score is only comparable between images of the same scene, so it is used by
+turning the focus until the score stops rising.
+
+The score is measured on a small unencoded stream from its own splitter port.
+The encoder callback only keeps the newest frame a few times a second, and the
+score is computed by a background thread, so measuring the focus never holds
+up the camera, and recordings on other splitter ports don't drop frames.
+
+Measuring the focus requires numpy on the Raspberry Pi.
+'''
+
+import time
+import threading
+import numpy as np
+from cameraLibStack import rawFrames
+from cameraLibTiming import timed, timer
+
+FOCUS_RATE = 10 # Focus scores measured per second
+
+
+def laplacianVariance(image):
+	'''
+	Returns the variance of the 4-neighbour Laplacian of a greyscale image.
+	'''
+
+	y = image.astype(np.int16)
+	laplacian = 4*y[1:-1, 1:-1] - y[:-2, 1:-1] - y[2:, 1:-1] - y[1:-1, :-2] - y[1:-1, 2:]
+	return float(laplacian.var())
+
+
+class focusFrames(rawFrames):
+
+	def __init__(self, resolution, rate=FOCUS_RATE):
+		'''
+		Create an output for camera.start_recording in the yuv format, which
+		measures the focus of frames of a resolution, rate times a second.
+		'''
+
+		rawFrames.__init__(self, resolution, "yuv")
+		self.period = 1.0 / rate
+		self.due = 0
+		self.latest = None
+		self.pending = threading.Event()	# Set while a frame is waiting to be measured
+		self.score = None					# Newest focus score
+		self.count = 0						# Number of scores measured
+
+		self.thread = threading.Thread(target=self.measure)
+		self.thread.daemon = True
+		self.thread.start()
+
+	@timed("focus frame callback")
+	def frame(self, data):
+		'''
+		Keep a frame for the background thread if a score is due, and the
+		previous frame has been measured.
+		'''
+
+		now = time.time()
+		if now < self.due or self.pending.is_set():
+			return
+
+		self.due = now + self.period
+		if isinstance(data, bytearray):
+			# The gathering buffer is reused for the next frame
+			data = bytes(data[:self.planeSize])
+		self.latest = data
+		self.pending.set()
+
+	def measure(self):
+		'''
+		Thread which measures the focus of each frame kept by frame().
+		'''
+
+		width, height = self.resolution
+		while not self.closed:
+			if not self.pending.wait(0.5) or self.closed:
+				continue
+			image = self.array(self.latest)[:height, :width]
+			with timer("focus score"):
+				self.score = laplacianVariance(image)
+			self.count += 1
+			self.pending.clear()
+
+	def close(self):
+		'''
+		Stop measuring the focus.
+		'''
+
+		self.closed = True
+		self.pending.set()
+		self.thread.join()
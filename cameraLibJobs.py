@@ -0,0 +1,228 @@
+'''
+Library for sharing the camera between jobs which run at the same time.
+
+Recordings and video port captures each use one of the four splitter ports of
+the camera, with an encoder and optionally a resizer of their own. The
+scheduler gives each job the splitter ports, encoders and resizers it needs,
+so that compatible jobs, such as a time-lapse, a recording and a live
+preview, run at once. A job whose resources are in use waits in a queue, and
+queued jobs start in the order they were submitted. An exclusive job, such
+as a change of resolution, waits for every other job to finish, and no other
+job starts until it has finished.
+
+A job either runs a function on its own thread (a background job), or is
+performed by the thread which submitted it once it is ready (a foreground
+job).
+'''
+
+import time
+import threading
+import traceback
+from collections import OrderedDict
+
+JOB_PORTS = [1, 2, 3, 0] # Splitter ports of the camera, in the order they are allocated
+JOB_LIMITS = OrderedDict([("h264", 2), ("jpeg", 2), ("resizer", 2)]) # Encoders and resizers which may be used at once
+JOB_HISTORY = 20 # Number of finished jobs which are remembered
+
+
+class cameraJob:
+
+	def __init__(self, jid, name, needs, function, args):
+		'''
+		Create a job which needs a number of splitter ports ("ports"), encoders
+		and resizers (counted by the names in JOB_LIMITS), or the whole camera
+		("exclusive").
+		'''
+
+		self.id = jid
+		self.name = name
+		self.needs = needs
+		self.function = function
+		self.args = args
+		self.ports = []
+		self.state = "queued"
+		self.result = None
+		self.error = None
+		self.submitted = time.time()
+		self.started = None
+		self.ended = None
+		self.ready = threading.Event()	# Set once the resources have been allocated
+		self.stop = threading.Event()	# Set to ask a background job to stop early
+
+	def describe(self):
+		'''
+		Returns a dictionary describing the job, for the "jobs" request.
+		'''
+
+		return {"id": self.id, "name": self.name, "state": self.state, "ports": self.ports,
+			"submitted": self.submitted, "started": self.started, "ended": self.ended,
+			"result": self.result, "error": None if self.error is None else str(self.error)}
+
+
+class jobScheduler:
+
+	def __init__(self):
+		'''
+		Create a scheduler with every splitter port, encoder and resizer free.
+		'''
+
+		self.lock = threading.Lock()
+		self.jobs = OrderedDict()	# ID -> job, for queued, running and recently finished jobs
+		self.queue = []				# Jobs waiting for resources, in the order submitted
+		self.running = []
+		self.free = list(JOB_PORTS)
+		self.used = dict((name, 0) for name in JOB_LIMITS)
+		self.nextId = 1
+
+	def submit(self, name, needs, function=None, args=()):
+		'''
+		Submit a job, which starts straight away if its resources are free.
+		A background job runs function(job, *args) on its own thread; a
+		foreground job is performed by the caller once job.ready is set.
+		'''
+
+		with self.lock:
+			job = cameraJob(self.nextId, name, needs, function, args)
+			self.nextId += 1
+			self.jobs[job.id] = job
+			self.queue.append(job)
+			self.dispatch()
+		return job
+
+	def finish(self, job):
+		'''
+		Release the resources of a job, and start the queued jobs which can
+		now run.
+		'''
+
+		with self.lock:
+			if job in self.running:
+				self.running.remove(job)
+				self.free = [port for port in JOB_PORTS if port in self.free or port in job.ports]
+				for name in JOB_LIMITS:
+					self.used[name] -= job.needs.get(name, 0)
+			elif job in self.queue:
+				self.queue.remove(job)
+
+			if job.state in ("queued", "running"):
+				job.state = "cancelled" if job.started is None else "finished"
+			job.ended = time.time()
+			self.forget()
+			self.dispatch()
+
+	def cancel(self, jid):
+		'''
+		Cancel a queued job, or ask a running background job to stop. Returns
+		False if there is no such job. Foreground jobs are left to the thread
+		performing them.
+		'''
+
+		with self.lock:
+			job = self.jobs.get(jid)
+			if job is None or job.state not in ("queued", "running"):
+				return False
+			if job.function is None:
+				raise ValueError("Job " + str(jid) + " is a command of the client, which is stopped with Stop")
+			queued = job.state == "queued"
+
+		if queued:
+			self.finish(job)
+		else:
+			job.stop.set()
+		return True
+
+	def stopBackground(self):
+		'''
+		Ask the running background jobs to stop, without waiting for them.
+		'''
+
+		with self.lock:
+			running = [job for job in self.running if job.function is not None]
+		for job in running:
+			job.stop.set()
+
+	def stopAll(self):
+		'''
+		Cancel the queued jobs, and stop the background jobs and wait for them
+		to finish.
+		'''
+
+		with self.lock:
+			queued = list(self.queue)
+			running = [job for job in self.running if job.function is not None]
+		for job in queued:
+			self.finish(job)
+		for job in running:
+			job.stop.set()
+			job.thread.join()
+
+	def describe(self):
+		'''
+		Returns a list describing the queued, running and recently finished
+		jobs.
+		'''
+
+		with self.lock:
+			return [job.describe() for job in self.jobs.values()]
+
+	def fits(self, job):
+		'''
+		Returns True if the resources a job needs are free.
+		'''
+
+		if job.needs.get("exclusive", False):
+			return len(self.running) == 0
+		if any(other.needs.get("exclusive", False) for other in self.running):
+			return False
+		if job.needs.get("ports", 0) > len(self.free):
+			return False
+		return all(self.used[name] + job.needs.get(name, 0) <= JOB_LIMITS[name] for name in JOB_LIMITS)
+
+	def dispatch(self):
+		'''
+		Start queued jobs in order, until one can't run. Called with the lock
+		held.
+		'''
+
+		while len(self.queue) > 0 and self.fits(self.queue[0]):
+			job = self.queue.pop(0)
+			count = job.needs.get("ports", 0)
+			job.ports = self.free[:count]
+			self.free = self.free[count:]
+			for name in JOB_LIMITS:
+				self.used[name] += job.needs.get(name, 0)
+
+			self.running.append(job)
+			job.state = "running"
+			job.started = time.time()
+			job.ready.set()
+
+			if job.function is not None:
+				job.thread = threading.Thread(target=self.run, args=(job,))
+				job.thread.daemon = True
+				job.thread.start()
+
+	def run(self, job):
+		'''
+		Thread which runs a background job, and releases its resources once
+		it has finished.
+		'''
+
+		try:
+			job.result = job.function(job, *job.args)
+		except Exception as e:
+			traceback.print_exc()
+			job.error = e
+			job.state = "failed"
+		finally:
+			self.finish(job)
+
+	def forget(self):
+		'''
+		Remove the oldest finished jobs, keeping JOB_HISTORY of them. Called
+		with the lock held.
+		'''
+
+		finished = [jid for jid, job in self.jobs.items() if job.state not in ("queued", "running")]
+		for jid in finished[:max(len(finished) - JOB_HISTORY, 0)]:
+			del self.jobs[jid]
@@ -0,0 +1,134 @@
+'''
+Library for logging per-frame metrics to a binary file, and loading them back
+into numpy arrays for plotting.
+
+Each log starts with a header describing its fields, followed by one
+fixed-width little-endian record per frame. Records are packed by the caller
+and written to the file in batches by a background thread, so logging does
+not slow down the loop being measured.
+
+A summary of a log can be printed from the command-line:
+
+	python cameraLibMetrics.py <Metrics filename>
+'''
+
+import struct
+import threading
+import sys
+import Queue
+from collections import OrderedDict
+
+METRICS_MAGIC = b"MET1" # Identifies a metrics log file
+METRICS_BATCH = 256 # Maximum number of records written to the file at once
+METRICS_TYPES = {'b': 'i1', 'B': 'u1', 'h': 'i2', 'H': 'u2', 'i': 'i4', 'I': 'u4', 'q': 'i8', 'Q': 'u8', 'f': 'f4', 'd': 'f8', '?': 'b1'}
+
+
+class metricsLog:
+
+	def __init__(self, fname, fields):
+		'''
+		Create a metrics log with a list of (name, format) fields, where format
+		is a single struct format character, e.g. [("frame", "I"), ("time", "d")].
+		'''
+
+		self.fname = fname
+		self.names = [field[0] for field in fields]
+		self.record = struct.Struct("<" + "".join(field[1] for field in fields))
+		self.records = 0
+
+		self.f = open(fname, "wb")
+		self.f.write(METRICS_MAGIC + struct.pack("<H", len(fields)))
+		for name, fmt in fields:
+			name = name.encode("ascii")
+			self.f.write(struct.pack("<B", len(name)) + name + fmt.encode("ascii"))
+
+		# Records are written to the file by a background thread
+		self.queue = Queue.Queue()
+		self.thread = threading.Thread(target=self.writer)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def write(self, *values):
+		'''
+		Append a record with one value per field.
+		'''
+
+		self.queue.put(self.record.pack(*values))
+		self.records += 1
+
+	def writer(self):
+		'''
+		Thread which writes the queued records to the file in batches, until a
+		None record is received.
+		'''
+
+		while True:
+			batch = [self.queue.get()]
+			while batch[-1] is not None and len(batch) < METRICS_BATCH and not self.queue.empty():
+				batch.append(self.queue.get())
+
+			if batch[-1] is None:
+				self.f.write(b"".join(batch[:-1]))
+				break
+			self.f.write(b"".join(batch))
+
+	def close(self):
+		'''
+		Write the remaining records and close the file.
+		'''
+
+		self.queue.put(None)
+		self.thread.join()
+		self.f.close()
+
+
+def loadMetrics(fname):
+	'''
+	Load a metrics log into a dictionary of numpy arrays, one per field. A
+	partly written last record is ignored.
+	'''
+
+	import numpy as np
+
+	with open(fname, "rb") as f:
+		if f.read(4) != METRICS_MAGIC:
+			raise ValueError(fname + " is not a metrics log")
+
+		fields = []
+		count = struct.unpack("<H", f.read(2))[0]
+		for i in range(count):
+			length = struct.unpack("<B", f.read(1))[0]
+			name = str(f.read(length).decode("ascii"))
+			fmt = f.read(1).decode("ascii")
+			fields.append((name, "<" + METRICS_TYPES[fmt]))
+
+		dtype = np.dtype(fields)
+		data = f.read()
+
+	records = np.frombuffer(data[:len(data) - len(data) % dtype.itemsize], dtype=dtype)
+	return OrderedDict((name, records[name].copy()) for name in dtype.names)
+
+
+def main(argv):
+	'''
+	Print the number of records, and the mean, minimum and maximum of every
+	field of a metrics log.
+	'''
+
+	if len(argv) < 2:
+		print("Usage: python cameraLibMetrics.py <Metrics filename>")
+		return 1
+
+	metrics = loadMetrics(argv[1])
+	for name in metrics:
+		values = metrics[name].astype(float)
+		if len(values) == 0:
+			print("%s: no records" % name)
+		else:
+			print("%s: %d records, mean %.6g, min %.6g, max %.6g" % (name, len(values), values.mean(), values.min(), values.max()))
+
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
@@ -0,0 +1,101 @@
+'''
+Library for the versioned request/response messages shared by the camera
+client and server.
+
+Requests are sent in the same length prefixed messages as the single letter
+commands, but start with a header holding the protocol version, the kind of
+message and a request ID, followed by a JSON payload. The first byte of the
+header is never sent by a single letter command, so both kinds of message can
+share the connection. A client may send several requests before reading any
+responses, and the server may answer them in any order; each response carries
+the ID of its request.
+
+	Request:  {"method": <name>, "args": {<arguments>}}
+	Response: {"result": <value>}
+	Error:    {"error": <message>}
+
+Stream data and files are sent on the same connection as data messages, where
+the request ID is the number of the channel, and the payload is raw bytes. A
+close message with no payload marks the end of the data on a channel, so the
+connection can be used for further commands straight afterwards.
+'''
+
+import json
+import struct
+from fractions import Fraction
+
+PROTOCOL_VERSION = 1
+PROTOCOL_MAGIC = b"\x00CP" # Starts every protocol message
+PROTOCOL_HEADER = struct.Struct(">3sBBI") # Magic, version, kind of message and request ID
+KIND_REQUEST = 1
+KIND_RESPONSE = 2
+KIND_ERROR = 3
+KIND_DATA = 4
+KIND_CLOSE = 5
+CHANNEL_STREAM = 1 # Video streamed by the "N" command
+CHANNEL_FILE = 2 # Images and videos downloaded from the Pi
+
+
+def isMessage(msg):
+	'''
+	Returns True if a received message is a protocol message, rather than a
+	single letter command or a command parameter.
+	'''
+
+	return msg is not None and msg[:len(PROTOCOL_MAGIC)] == PROTOCOL_MAGIC
+
+
+def encodeValue(value):
+	'''
+	Convert values which JSON can't represent, such as the fractions used by
+	picamera for the framerate and gains, into numbers.
+	'''
+
+	if isinstance(value, Fraction):
+		return int(value) if value.denominator == 1 else float(value)
+	raise TypeError(repr(value) + " can't be sent in a protocol message")
+
+
+def packMessage(kind, rid, payload):
+	'''
+	Pack a message of the current protocol version with a JSON payload.
+	'''
+
+	return PROTOCOL_HEADER.pack(PROTOCOL_MAGIC, PROTOCOL_VERSION, kind, rid) + json.dumps(payload, default=encodeValue).encode("utf-8")
+
+
+def packData(channel, data):
+	'''
+	Pack a block of data sent on a channel.
+	'''
+
+	return PROTOCOL_HEADER.pack(PROTOCOL_MAGIC, PROTOCOL_VERSION, KIND_DATA, channel) + data
+
+
+def packClose(channel):
+	'''
+	Pack the message which ends the data sent on a channel.
+	'''
+
+	return PROTOCOL_HEADER.pack(PROTOCOL_MAGIC, PROTOCOL_VERSION, KIND_CLOSE, channel)
+
+
+def unpackMessage(msg):
+	'''
+	Unpack a protocol message into its version, kind, request ID (or channel)
+	and payload. The payload of a data message is returned as bytes, and of a
+	close message as None. The version is returned rather than checked, so
+	that the receiver can answer a request of another version with an error.
+	'''
+
+	magic, version, kind, rid = PROTOCOL_HEADER.unpack(msg[:PROTOCOL_HEADER.size])
+	if magic != PROTOCOL_MAGIC:
+		raise ValueError("Not a protocol message")
+
+	if kind == KIND_DATA:
+		payload = msg[PROTOCOL_HEADER.size:]
+	elif kind == KIND_CLOSE:
+		payload = None
+	else:
+		payload = json.loads(msg[PROTOCOL_HEADER.size:].decode("utf-8"))
+	return version, kind, rid, payload
@@ -0,0 +1,158 @@
+'''
+Library for unpacking the raw Bayer data of the camera, for quantitative
+images which are linear and lossless, unlike the processed JPEG.
+
+A capture with bayer=True appends the raw sensor data to the JPEG: a 32 kB
+header, which holds the resolution and the Bayer order of the sensor, then
+the 10-bit pixel values packed into 5 bytes for every 4 pixels, in rows
+padded to 32 bytes. Each packed group holds the 8 high bits of the 4 pixels,
+then a byte of their 2 low bits, first pixel lowest (the MIPI RAW10 layout).
+The unpacker works on whole arrays of groups at a time, so a full 3280x2464
+frame is unpacked in a few array operations.
+
+The pixel values (0-1023) are saved as a uint16 numpy array (.npy), or as a
+16-bit TIFF, either as the Bayer mosaic or demosaiced into an RGB image at
+half the resolution, where each 2x2 block of the mosaic becomes one pixel.
+
+A saved mosaic can be demosaiced on the remote computer from the
+command-line, giving the Bayer order printed when it was captured:
+
+	python cameraLibRaw.py <Mosaic .npy> <Bayer order> <Output .npy or .tif>
+'''
+
+import sys
+import struct
+import numpy as np
+
+RAW_BLOCKS = {"ov5647": 6404096, "imx219": 10270208} # Size of the raw data appended by each sensor
+RAW_HEADER_SIZE = 32768
+RAW_HEADER = struct.Struct("<4s172x32sHHHH24xHHBB") # Magic, then the sensor name, resolution, padding, transform, format and Bayer order
+BAYER_ORDERS = ["RGGB", "GBRG", "BGGR", "GRBG"] # Colours of each 2x2 block, by the Bayer order of the header
+TIFF_TYPES = ["tif", "tiff"]
+
+
+def findRaw(data):
+	'''
+	Returns the raw data appended to a JPEG captured with bayer=True.
+	'''
+
+	for size in RAW_BLOCKS.values():
+		if len(data) >= size and data[-size:-size + 4] == b"BRCM":
+			return data[-size:]
+	raise ValueError("The capture doesn't contain raw data of a supported sensor")
+
+
+def unpackBayer(data):
+	'''
+	Unpack the raw data of a capture, returning the Bayer mosaic as a uint16
+	array, and the Bayer order of the sensor.
+	'''
+
+	raw = findRaw(data)
+	magic, name, width, height, right, down, transform, fmt, order, bayerFormat = RAW_HEADER.unpack_from(raw)
+
+	# Rows are padded to 32 bytes, and the number of rows to 16
+	stride = (width * 5 // 4 + 31) // 32 * 32
+	rows = (height + 15) // 16 * 16
+	pixels = np.frombuffer(raw, dtype=np.uint8, count=rows * stride, offset=RAW_HEADER_SIZE).reshape(rows, stride)
+	return unpackRaw10(pixels[:height, :width * 5 // 4], width), BAYER_ORDERS[order]
+
+
+def unpackRaw10(packed, width):
+	'''
+	Unpack rows of 10-bit pixels packed 4 to 5 bytes into a uint16 array.
+	'''
+
+	height = packed.shape[0]
+	groups = packed.reshape(height, width // 4, 5)
+	image = np.empty((height, width // 4, 4), dtype=np.uint16)
+
+	# High bits of each pixel, then the low bits from the fifth byte
+	np.left_shift(groups[:, :, :4], 2, out=image, dtype=np.uint16)
+	low = groups[:, :, 4:5] >> np.array([0, 2, 4, 6], dtype=np.uint8)
+	low &= 3
+	image |= low
+	return image.reshape(height, width)
+
+
+def demosaic(mosaic, order):
+	'''
+	Returns an RGB image at half the resolution of a Bayer mosaic, where each
+	2x2 block becomes a pixel, with the mean of its two green values.
+	'''
+
+	offsets = {}
+	for i, colour in enumerate(order):
+		offsets.setdefault(colour, []).append((i // 2, i % 2))
+
+	height, width = mosaic.shape[0] // 2, mosaic.shape[1] // 2
+	image = np.empty((height, width, 3), dtype=np.uint16)
+	for channel, colour in enumerate("RGB"):
+		planes = [mosaic[y:height*2:2, x:width*2:2] for y, x in offsets[colour]]
+		if len(planes) == 1:
+			image[:, :, channel] = planes[0]
+		else:
+			# 10-bit values can be added in 16 bits without overflowing
+			image[:, :, channel] = (planes[0] + planes[1] + 1) >> 1
+	return image
+
+
+def saveTiff(fname, image):
+	'''
+	Save a uint16 greyscale or RGB image as an uncompressed 16-bit TIFF.
+	'''
+
+	image = np.ascontiguousarray(image, dtype="<u2")
+	height, width = image.shape[:2]
+	samples = 1 if image.ndim == 2 else image.shape[2]
+
+	# The image data follows the header, the directory of tags and the
+	# bits per sample of an RGB image
+	entries = 10
+	bitsOffset = 8 + 2 + entries * 12 + 4
+	dataOffset = bitsOffset + (2 * samples if samples > 1 else 0)
+	bits = 16 if samples == 1 else bitsOffset
+	tags = [(256, 4, 1, width), (257, 4, 1, height), (258, 3, samples, bits), (259, 3, 1, 1),
+		(262, 3, 1, 2 if samples > 1 else 1), (273, 4, 1, dataOffset), (277, 3, 1, samples),
+		(278, 4, 1, height), (279, 4, 1, image.nbytes), (284, 3, 1, 1)]
+
+	with open(fname, "wb") as f:
+		f.write(struct.pack("<2sHI", b"II", 42, 8))
+		f.write(struct.pack("<H", entries))
+		for tag in tags:
+			f.write(struct.pack("<HHII", *tag))
+		f.write(struct.pack("<I", 0))
+		if samples > 1:
+			f.write(struct.pack("<" + "H" * samples, *([16] * samples)))
+		image.tofile(f)
+
+
+def saveImage(fname, image):
+	'''
+	Save a uint16 image as a numpy array or a 16-bit TIFF, by the extension
+	of the filename.
+	'''
+
+	if fname.split(".")[-1].lower() in TIFF_TYPES:
+		saveTiff(fname, image)
+	else:
+		# np.save adds .npy to other extensions, so write to the file itself
+		with open(fname, "wb") as f:
+			np.save(f, image)
+
+
+def main(argv):
+	'''
+	Demosaic a Bayer mosaic saved as a numpy array.
+	'''
+
+	if len(argv) < 4 or argv[2] not in BAYER_ORDERS:
+		print("Usage: python cameraLibRaw.py <Mosaic .npy> <Bayer order (" + ", ".join(BAYER_ORDERS) + ")> <Output .npy or .tif>")
+		return 1
+
+	saveImage(argv[3], demosaic(np.load(argv[1]), argv[2]))
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
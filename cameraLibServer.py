@@ -11,6 +11,11 @@ from picamera import PiVideoFrame
 from multiprocessing import Process, Value
 from PIL import Image
 from datetime import datetime
+from cameraLibMetrics import metricsLog
+from cameraLibTelemetry import telemetry, cpuLoad, temperature, throttled, freeSpace
+from cameraLibTiming import timed, timer, dump as dumpTimings
+from cameraLibJobs import jobScheduler
+from cameraLibProtocol import PROTOCOL_VERSION, KIND_RESPONSE, KIND_ERROR, CHANNEL_STREAM, CHANNEL_FILE, isMessage, packMessage, packData, packClose, unpackMessage
 import socket
 import time
 import struct
@@ -20,6 +25,9 @@ import select
 import subprocess
 import io
 import threading
+import json
+import Queue
+import traceback
 
 
 BRIGHTNESS_MIN = 0
@@ -43,7 +51,79 @@ FRAMERATE_MAX = 90
 EXPOSURE_MIN = 0
 EXPOSURE_MAX = float("inf")
 IMAGE_TYPES = ['jpeg', 'jpg', 'png', 'gif', 'bmp']
+RAW_TYPES = ['npy', 'tif', 'tiff'] # Image filenames which capture the raw Bayer data
+RAW_DEMOSAIC = False # Save raw captures as half resolution RGB, rather than as the Bayer mosaic
 IMAGE_OFFSET = 0 # Possibly need to set to 3-4
+RECORD_PORT = 1 # Splitter port used for full resolution recording
+ANALYSIS_PORT = 2 # Splitter port used for the downscaled analysis stream
+ANALYSIS_WIDTH = 320
+ANALYSIS_HEIGHT = 240
+ROI_MIN = 0
+ROI_MAX = 100
+ROI_SIZE_MIN = 1
+PREVIEW_PORT = 3 # Splitter port used for the live preview
+PREVIEW_NET_PORT = 5001 # Network port that preview frames are sent on
+PREVIEW_WIDTH = 480
+PREVIEW_HEIGHT = 360
+PREVIEW_HEADER = struct.Struct(">IIfIf") # JPEG length, frame index, age of the frame in seconds, focus score index and focus score
+PREVIEW_TIMEOUT = 10 # Seconds to wait for the client to connect to the preview
+FOCUS_PORT = 2 # Splitter port used to measure the focus during the live preview
+FOCUS_WIDTH = 320
+FOCUS_HEIGHT = 240
+PARAMETERS = ["Width", "Height", "Framerate", "Exposure time", "Brightness", "Contrast", "Gain", "Saturation", "Sharpness", "ROI x", "ROI y", "ROI width", "ROI height"] # Parameters that can be set together, in the order they are applied
+TRIGGER_FIELDS = [("image", "I"), ("time", "d"), ("capture", "f")] # Metrics logged for every triggered capture
+METRICS_FOLDER = "../../Metrics/" # Metrics files of the sessions, kept apart from the images and videos
+FILE_CHUNK = 65536 # Size of the blocks a file is sent in
+STREAM_PORT = 5000 # Network port of the gstreamer subtraction stream
+LISTEN_TIMEOUT = 5 # Seconds to wait for gstreamer to listen for the client
+LISTEN_POLL = 0.01 # Seconds between checks that gstreamer is listening
+TCP_FILE = "/proc/net/tcp" # Table of the TCP sockets of the Pi, read to find listening ports
+TCP_LISTEN = "0A" # State of a listening socket in the table
+STOP_POLL = 0.5 # Seconds between checks for camera errors while waiting for a recording to stop
+KEEPALIVE = (10, 5, 3) # Idle seconds, seconds between probes, and probes before a silent connection is dropped
+INTERVAL_MIN = 0.1 # Minimum seconds between time-lapse images
+INTERVAL_MAX = 86400
+INTERVAL_DEFAULT = 10
+FRACTIONAL_INPUTS = ["Interval"] # Parameters which may be entered as a fraction on the Pi terminal
+TIMELAPSE_FIELDS = [("image", "I"), ("deadline", "d"), ("jitter", "f"), ("capture", "f")] # Metrics logged for every time-lapse image
+STACK_MIN = 2 # Frames averaged into a stacked image
+STACK_MAX = 256
+STACK_DEFAULT = 32
+STACK_FORMAT = "yuv" # Stack the luminance ("yuv"), or the colour at three times the cost ("rgb")
+
+# Splitter ports, encoders and resizers used by the commands and background
+# jobs which use the camera. Exclusive commands change the camera mode, or
+# time their captures with camera.frame, which only describes one recording.
+JOB_EXCLUSIVE = {"exclusive": True}
+JOB_NEEDS = {"D": {"ports": 2, "h264": 2, "resizer": 1}, "I": {"ports": 1, "jpeg": 1},
+	"L": {"ports": 2, "jpeg": 1, "resizer": 2}, "N": {"ports": 1, "h264": 1, "resizer": 1},
+	"O": {"ports": 1, "h264": 1, "resizer": 1}, "V": {"ports": 1, "h264": 1}, "W": {"ports": 1, "jpeg": 1}, "K": {"ports": 1},
+	"F": JOB_EXCLUSIVE, "M": JOB_EXCLUSIVE, "R": JOB_EXCLUSIVE, "T": JOB_EXCLUSIVE, "X": JOB_EXCLUSIVE}
+
+
+def metricsPath(fname):
+	'''
+	Returns the path of a metrics file in the metrics folder, which is
+	created if it doesn't exist.
+	'''
+
+	if not os.path.isdir(METRICS_FOLDER):
+		os.makedirs(METRICS_FOLDER)
+	return METRICS_FOLDER + fname
+
+
+def isListening(port):
+	'''
+	Returns whether a TCP socket of the Pi is listening on a port.
+	'''
+
+	with open(TCP_FILE) as f:
+		lines = f.readlines()[1:]
+	for line in lines:
+		fields = line.split()
+		if fields[3] == TCP_LISTEN and int(fields[1].split(":")[1], 16) == port:
+			return True
+	return False
 
 
 class SplitFrames(object):
@@ -54,6 +134,7 @@ class SplitFrames(object):
 		self.frameout = []
 		self.fnames = []
 
+	@timed("trigger frame callback")
 	def write(self, buf):
 		if buf.startswith(b'\xff\xd8'):
 			# Start of new frame; close the old one (if any) and
@@ -66,13 +147,141 @@ class SplitFrames(object):
 				fname = "../../Images/IMG_" + datetime.utcnow().strftime('%y%m%d-%H%M%S.%f')[:-3] + ".jpg"
 				self.fnames.append(fname)
 				self.output = io.open(fname, 'wb')
-				self.output.write(buf)
+				with timer("file write"):
+					self.output.write(buf)
 				print("Captured")
 				self.frameout.pop(0)
 
 		self.frame_num += 1
 
 
+class PreviewFrames(object):
+	def __init__(self, camera, connection, focus=None):
+		self.camera = camera
+		self.connection = connection
+		self.focus = focus
+		self.buffer = io.BytesIO()
+		self.frame_num = 0
+		self.timestamp = None
+		self.closed = False
+
+	@timed("preview frame callback")
+	def write(self, buf):
+		if self.closed:
+			return
+
+		if buf.startswith(b'\xff\xd8'):
+			# Start of new frame; send the old one (if any)
+			if self.buffer.tell() > 0:
+				self.send()
+			self.timestamp = self.camera.frame.timestamp
+
+		self.buffer.write(buf)
+
+	def send(self):
+		# The age of the frame is measured on the camera clock, so that the
+		# client can add it to the time the frame spends on the network
+		age = 0.0
+		if self.timestamp is not None:
+			age = max(self.camera.timestamp - self.timestamp, 0) / 1000000.0
+
+		# Each frame carries the newest focus score, which the client shows
+		# when its index changes
+		score = (0, 0.0)
+		if self.focus is not None and self.focus.score is not None:
+			score = (self.focus.count, self.focus.score)
+
+		data = self.buffer.getvalue()
+		try:
+			with timer("preview send"):
+				self.connection.sendall(PREVIEW_HEADER.pack(len(data), self.frame_num, age, score[0], score[1]) + data)
+		except socket.error:
+			# Stop sending if the client has gone
+			self.closed = True
+
+		self.frame_num += 1
+		self.buffer.seek(0)
+		self.buffer.truncate()
+
+	def flush(self):
+		pass
+
+
+class ChannelOutput(object):
+	def __init__(self, server, channel):
+		self.server = server
+		self.channel = channel
+		self.sock = server.hostSock		# A reconnecting client doesn't receive the rest of the data
+		self.failed = False
+
+	@timed("channel write")
+	def write(self, buf):
+		# Send the data as one block on the channel of the control connection
+		if not self.server.send_msg(self.sock, packData(self.channel, buf)):
+			self.failed = True
+		return len(buf)
+
+	def flush(self):
+		pass
+
+	def close(self):
+		# Tell the client that no more data will be sent on the channel
+		if not self.server.send_msg(self.sock, packClose(self.channel)):
+			self.failed = True
+
+
+class TelemetryOutput(object):
+	def __init__(self, camera, telemetry, output, stream, port=RECORD_PORT):
+		self.camera = camera
+		self.telemetry = telemetry
+		self.stream = stream
+		self.port = port
+		self.index = None
+		self.timestamp = None
+
+		# Open a file output here, so that its writes can be counted
+		self.owned = isinstance(output, str)
+		if self.owned:
+			self.output = io.open(output, 'wb')
+		else:
+			self.output = output
+
+	@timed("encoder callback")
+	def write(self, buf):
+		self.telemetry.count("encoder_bytes_total", len(buf), self.stream)
+
+		# camera.frame describes the recording on the lowest splitter port,
+		# so frames are only counted on the record port
+		if self.port == RECORD_PORT:
+			self.countFrame(self.camera.frame)
+
+		return self.output.write(buf)
+
+	def countFrame(self, frame):
+		# Count each frame once it is complete, and count the frames missing
+		# between the timestamps of successive frames as dropped
+		if not frame.complete or frame.timestamp is None or frame.index == self.index:
+			return
+
+		self.telemetry.count("frames_captured_total", 1, self.stream)
+		if self.timestamp is not None and self.camera.framerate > 0:
+			period = 1000000.0 / self.camera.framerate
+			missed = int(round((frame.timestamp - self.timestamp) / period)) - 1
+			if missed > 0:
+				self.telemetry.count("frames_dropped_total", missed, self.stream)
+
+		self.index = frame.index
+		self.timestamp = frame.timestamp
+
+	def flush(self):
+		self.output.flush()
+
+	def close(self):
+		# Outputs passed in are closed by their owner
+		if self.owned:
+			self.output.close()
+
+
 class cameraModuleServer:
 
 	def __init__(self):
@@ -91,6 +300,27 @@ class cameraModuleServer:
 
 		# Initialise network variable
 		self.network = 0
+		self.server_socket = None
+		self.hostSock = None
+		self.sendLock = threading.Lock()	# Messages may be sent by request threads
+		self.answerLock = threading.Lock()	# Held while a command prompts the client
+		self.prompting = False
+
+		# Session state kept for a client which reconnects
+		self.running = None		# Command being performed
+		self.openEnded = False	# Whether the command runs until it is stopped
+		self.detached = False	# Whether the client of the command has been lost
+		self.pending = []		# (path, type) of files which couldn't be sent
+		self.deferred = []		# Commands received while waiting for a recording to stop
+		self.held = []			# Parameters received while a command waits for the camera
+
+		# Methods of the versioned protocol, which are answered by their own threads
+		self.methods = {"hello": self.requestHello, "settings": self.requestSettings, "stats": self.requestStats, "resume": self.requestResume, "telemetry": self.requestTelemetry,
+			"submit": self.requestSubmit, "jobs": self.requestJobs, "cancel": self.requestCancel}
+
+		# Share the camera between commands and background jobs
+		self.scheduler = jobScheduler()
+		self.job = None			# Job of the command being performed
 
 		# Initialise trigger mode variables
 		self.start = 0
@@ -104,6 +334,47 @@ class cameraModuleServer:
 		# Initialise trigger
 		self.trigger = Value('i', 0)
 
+		# Initialise the region of interest (x, y, width, height) as fractions of the sensor
+		self.roi = (0.0, 0.0, 1.0, 1.0)
+
+		# Keep counters and gauges of the server, served on localhost
+		self.started = time.time()
+		self.telemetry = telemetry()
+		self.initTelemetry()
+		self.telemetry.serve()
+
+	def initTelemetry(self):
+		'''
+		Declare the counters and gauges of the server telemetry.
+		'''
+
+		t = self.telemetry
+		t.counter("frames_captured_total", "Frames encoded on the record splitter port", "stream")
+		t.counter("frames_dropped_total", "Frames missing between the timestamps of successive frames", "stream")
+		t.counter("encoder_bytes_total", "Bytes output by the video encoder", "stream")
+		t.counter("images_total", "Images captured")
+		t.counter("commands_total", "Commands performed", "command")
+		t.counter("requests_total", "Requests of the versioned protocol answered", "method")
+		t.counter("request_errors_total", "Requests answered with an error")
+		t.counter("files_sent_total", "Images and videos sent to the client")
+		t.counter("file_bytes_sent_total", "Bytes of images and videos sent to the client")
+		t.counter("connections_total", "Connections accepted from the client")
+		t.counter("connections_lost_total", "Connections to the client lost")
+		t.gauge("cpu_percent", "CPU load since the last reading", cpuLoad())
+		t.gauge("load_average", "Load average over the last minute", lambda: os.getloadavg()[0])
+		t.gauge("soc_temperature_celsius", "Temperature of the SoC", temperature)
+		t.gauge("throttled", "Throttling flags of the Pi firmware (vcgencmd get_throttled)", throttled)
+		t.gauge("free_bytes", "Free space for images and videos", lambda: {"Images": freeSpace("../../Images"), "Videos": freeSpace("../../Videos")}, "folder")
+		t.gauge("pending_files", "Files waiting for the client to reconnect", lambda: len(self.pending))
+		t.gauge("deferred_commands", "Commands waiting for a recording to stop", lambda: len(self.deferred))
+		t.gauge("connected", "Whether the client is connected", lambda: int(self.hostSock is not None))
+		t.gauge("busy", "Whether a command is being performed", lambda: int(self.running is not None))
+		t.gauge("jobs_running", "Commands and background jobs using the camera", lambda: len(self.scheduler.running))
+		t.gauge("jobs_queued", "Commands and background jobs waiting for the camera", lambda: len(self.scheduler.queue))
+		t.gauge("free_ports", "Splitter ports which aren't in use", lambda: len(self.scheduler.free))
+		t.gauge("framerate", "Framerate of the camera", lambda: float(self.camera.framerate))
+		t.gauge("uptime_seconds", "Time since the server started", lambda: time.time() - self.started)
+
 	def setResolution(self, width, height):
 		'''
 		Set the resolution of the camera.
@@ -169,33 +440,154 @@ class cameraModuleServer:
 
 		self.camera.iso = gain
 
-	def waitProcess(self, duration):
+	def setROI(self, x, y, width, height):
 		'''
-		Threaded process to wait for the duration of a recording, and to throw errors in event of camera failing.
+		Set the region of interest of the camera, given as percentages of the
+		sensor. The region is applied as a sensor crop, so that streams only
+		contain the region of interest.
 		'''
 
-		self.camera.wait_recording(duration)
+		# Keep the region within the sensor
+		width = min(max(width, ROI_SIZE_MIN), ROI_MAX)
+		height = min(max(height, ROI_SIZE_MIN), ROI_MAX)
+		x = min(max(x, ROI_MIN), ROI_MAX - width)
+		y = min(max(y, ROI_MIN), ROI_MAX - height)
+
+		self.roi = (x/100.0, y/100.0, width/100.0, height/100.0)
+		self.camera.zoom = self.roi
 
-	def delayProcess(self, duration):
+	def roiSize(self, size):
 		'''
-		Threaded process to wait for the duration of a recording, and to throw errors in event of camera failing.
+		Scale a stream resolution by the region of interest, so that pixels in
+		the cropped stream are the same size as in the full frame. A cropped
+		size is rounded down to a multiple of 16 for the encoder; the full
+		frame keeps the requested size.
 		'''
 
-		time.sleep(duration)
+		if tuple(self.roi) == (0, 0, 1, 1):
+			return (int(size[0]), int(size[1]))
 
-	def stopProcess(self):
+		width = max(int(size[0]*self.roi[2]) // 16 * 16, WIDTH_MIN)
+		height = max(int(size[1]*self.roi[3]) // 16 * 16, HEIGHT_MIN)
+		return (width, height)
+
+	def sendStreamInfo(self, size):
 		'''
-		Threaded process to stop recording if there is an interrupt from a network computer.
+		Send the framerate, resolution and region of interest of a stream, so
+		that the client can match its background image to the stream.
 		'''
 
-		while True:
-			msg = self.recv_msg(self.hostSock)
-			if msg == "Stop":
-				break
+		self.send_msg(self.hostSock, str(self.camera.framerate))
+		self.send_msg(self.hostSock, str(size[0]) + "x" + str(size[1]))
+		self.send_msg(self.hostSock, ",".join(str(r) for r in self.roi))
+
+	def waitListening(self, port):
+		'''
+		Wait until a process started by the server is listening on a network
+		port, so that the client is only told to connect once it can. Returns
+		False if nothing is listening after LISTEN_TIMEOUT seconds.
+		'''
+
+		# The socket table is read rather than connecting to the port, which
+		# would add a client to the stream
+		end = time.time() + LISTEN_TIMEOUT
+		while time.time() < end:
+			if isListening(port):
+				return True
+			time.sleep(LISTEN_POLL)
+
+		print("Nothing is listening on port " + str(port))
+		return False
+
+	def waitStop(self, duration, port=None, stopOnLoss=False, finished=None):
+		'''
+		Wait for the duration of a recording, or until the client sends "Stop".
+		Errors of the camera are raised if a splitter port is given, and the
+		wait also ends once the finished event is set, if one is given.
+		Requests are answered while waiting. If the connection is lost, the
+		recording carries on unless stopOnLoss is set, and a reconnecting
+		client takes over the session.
+		'''
+
+		held = self.releaseAnswers()
+		try:
+			self.openEnded = duration >= sys.maxint
+			end = time.time() + duration
+			while time.time() < end:
+				if port is not None:
+					self.camera.wait_recording(0, splitter_port=port)
+				if finished is not None and finished.is_set():
+					return
+
+				sockets = [self.server_socket]
+				if self.hostSock is not None:
+					sockets.append(self.hostSock)
+				readable = select.select(sockets, [], [], max(min(end - time.time(), STOP_POLL), 0))[0]
+
+				if self.server_socket in readable:
+					self.acceptClient()
+					if stopOnLoss:
+						return
+				elif self.hostSock in readable:
+					msg = self.recv_msg(self.hostSock)
+					if msg == "Stop":
+						return
+					elif msg == None:
+						self.connectionLost()
+						if stopOnLoss:
+							return
+					elif isMessage(msg):
+						self.answerRequest(msg)
+					else:
+						# Perform other commands once the recording has finished
+						self.deferred.append(msg)
+		finally:
+			if held:
+				self.holdAnswers()
+
+	def acceptPreview(self, listener):
+		'''
+		Accept the preview connection of the client, and close the listener.
+		The control connection is served while waiting, as in waitStop.
+		Returns None if the client doesn't connect within PREVIEW_TIMEOUT,
+		sends "Stop", or the connection is lost.
+		'''
+
+		end = time.time() + PREVIEW_TIMEOUT
+		held = self.releaseAnswers()
+		try:
+			while time.time() < end:
+				sockets = [listener, self.server_socket]
+				if self.hostSock is not None:
+					sockets.append(self.hostSock)
+				readable = select.select(sockets, [], [], max(min(end - time.time(), STOP_POLL), 0))[0]
+
+				if listener in readable:
+					return listener.accept()[0]
+				elif self.server_socket in readable:
+					# A reconnecting client doesn't expect the preview
+					self.acceptClient()
+					return None
+				elif self.hostSock in readable:
+					msg = self.recv_msg(self.hostSock)
+					if msg == "Stop":
+						return None
+					elif msg == None:
+						self.connectionLost()
+						return None
+					elif isMessage(msg):
+						self.answerRequest(msg)
+					else:
+						self.deferred.append(msg)
+			return None
+		finally:
+			listener.close()
+			if held:
+				self.holdAnswers()
 
-	def capturePhoto(self, fname):
+	def capturePhoto(self, fname, port=0):
 		'''
-		Capture a photo and store on Pi.
+		Capture a photo on a splitter port of the video port, and store on Pi.
 		'''
 
 		# Locate the Images folder
@@ -206,9 +598,84 @@ class cameraModuleServer:
 		time.sleep(2)
 
 		# Capture the image
-		self.camera.capture(floc, use_video_port=True)
+		with timer("capture"):
+			self.camera.capture(floc, use_video_port=True, splitter_port=port)
+		self.camera.stop_preview()
+		self.telemetry.count("images_total")
+
+	def captureRaw(self, fname):
+		'''
+		Capture the raw Bayer data of the sensor on the still port, and store
+		on Pi as a 16-bit numpy array or TIFF. Returns a summary of the image.
+		'''
+
+		# numpy is only needed on the Pi for raw captures
+		from cameraLibRaw import unpackBayer, demosaic, saveImage
+
+		# Locate the Images folder
+		floc = "../../Images/" + fname
+
+		# Warm the camera up
+		self.camera.start_preview()
+		time.sleep(2)
+
+		# The raw data is appended to a JPEG
+		stream = io.BytesIO()
+		with timer("capture"):
+			self.camera.capture(stream, format='jpeg', bayer=True)
 		self.camera.stop_preview()
 
+		start = time.time()
+		with timer("raw unpack"):
+			image, order = unpackBayer(stream.getvalue())
+		elapsed = time.time() - start
+		if RAW_DEMOSAIC:
+			image = demosaic(image, order)
+		with timer("file write"):
+			saveImage(floc, image)
+		self.telemetry.count("images_total")
+
+		return "Raw %dx%d %s image captured, unpacked in %.2f s" % (image.shape[1], image.shape[0], "RGB" if RAW_DEMOSAIC else order + " Bayer", elapsed)
+
+	def captureStack(self, frames, reject, fname, port=0):
+		'''
+		Capture a low-noise image, the mean of a number of unencoded frames
+		from a splitter port, and store on Pi. Returns a summary of the stack.
+		'''
+
+		# numpy is only needed on the Pi for stacking
+		from cameraLibStack import frameStack
+
+		# Locate the Images folder
+		floc = "../../Images/" + fname
+
+		# Warm the camera up
+		self.camera.start_preview()
+		time.sleep(2)
+
+		stack = frameStack(self.camera.resolution, frames, STACK_FORMAT, reject)
+		start = time.time()
+		self.camera.start_recording(stack, format=STACK_FORMAT, splitter_port=port)
+		try:
+			# Allow for frames dropped while the frame rate is low
+			timeout = 2.0 * frames / float(self.camera.framerate) + 5
+			while not stack.done.wait(STOP_POLL) and time.time() < start + timeout:
+				self.camera.wait_recording(0, splitter_port=port)
+		finally:
+			self.camera.stop_recording(splitter_port=port)
+			self.camera.stop_preview()
+		elapsed = time.time() - start
+
+		mode = "L" if STACK_FORMAT == "yuv" else "RGB"
+		with timer("file write"):
+			Image.fromarray(stack.mean(), mode).save(floc, quality=95)
+		self.telemetry.count("images_total")
+
+		summary = "Stacked " + str(stack.count) + " frames in %.2f s (%.1f fps)" % (elapsed, stack.count / elapsed)
+		if stack.reject:
+			summary += ", darkest and brightest values rejected"
+		return summary
+
 	def paraTrigger(self, fn):
 		'''
 		Trigger function executed in parallel to capture function.
@@ -224,6 +691,9 @@ class cameraModuleServer:
 			self.trigger.value = 1
 		elif trig == "Q":
 			self.trigger.value = 2
+		elif trig == None:
+			# The connection was lost, which ends trigger mode
+			self.trigger.value = 3
 
 	def captureTriggerV1(self):
 		'''
@@ -265,9 +735,11 @@ class cameraModuleServer:
 					self.trigtime.append(self.camera.timestamp)
 					self.imno += 1
 
-				# Quit the recording
-				elif self.trigger.value == 2:
+				# Quit the recording, which also happens if the connection was lost
+				elif self.trigger.value >= 2:
 					endflag = 1
+					if self.trigger.value == 3:
+						self.connectionLost()
 
 				# Restart the trigger process
 				pt.terminate()
@@ -286,6 +758,7 @@ class cameraModuleServer:
 		self.camera.stop_preview()
 
 		self.fnames = output.fnames
+		self.telemetry.count("images_total", len(self.fnames))
 
 	def captureTriggerV2(self):
 		'''
@@ -297,6 +770,10 @@ class cameraModuleServer:
 		self.fnames = []
 		self.ind = 0
 
+		# Log the capture time of every image instead of printing it
+		metrics = metricsLog(metricsPath("TRIG_" + datetime.utcnow().strftime('%y%m%d-%H%M%S') + ".met"), TRIGGER_FIELDS)
+		captureTime = 0.0
+
 		# Warm-up the camera
 		self.camera.start_preview()
 		time.sleep(2)
@@ -316,13 +793,18 @@ class cameraModuleServer:
 					self.fnames.append(fname)
 					self.ind += 1
 					self.start = time.time()
-					self.camera.capture(fname,'jpeg')
+					with timer("capture"):
+						self.camera.capture(fname,'jpeg')
 					self.end = time.time()
-					print("Captured in: " + str(self.end-self.start) + " seconds")
+					metrics.write(self.ind, self.start, self.end - self.start)
+					self.telemetry.count("images_total")
+					captureTime += self.end - self.start
 
-				# Quit the loop
-				elif self.trigger.value == 2:
+				# Quit the loop, which also happens if the connection was lost
+				elif self.trigger.value >= 2:
 					pt.terminate()
+					if self.trigger.value == 3:
+						self.connectionLost()
 					break
 
 				# Restart the trigger process
@@ -334,9 +816,159 @@ class cameraModuleServer:
 		# Close the camera preview
 		self.camera.stop_preview()
 
-	def captureStream(self, duration, fname):
+		metrics.close()
+		if self.ind > 0:
+			print("Captured " + str(self.ind) + " images, average capture time: " + str(captureTime / self.ind) + " seconds")
+
+	def timeLapse(self, interval, duration, port=0):
+		'''
+		Capture an image every interval seconds for the duration, or until the
+		client sends "Stop". Images are captured on a splitter port of a warm
+		camera, and sent to the client by a background thread, so the network
+		never delays a capture. Returns a summary of the images and their
+		jitter.
+		'''
+
+		# Warm the camera up once, rather than for every image
+		self.camera.start_preview()
+		time.sleep(2)
+
+		lapse = self.newLapse(port)
+		stop = threading.Event()
+		finished = threading.Event()
+		transfers = None
+		if self.network == 1:
+			transfers = Queue.Queue()
+			sender = threading.Thread(target=self.timeLapseTransfer, args=(transfers,))
+			sender.start()
+
+		capture = threading.Thread(target=self.timeLapseCapture, args=(lapse, interval, time.time() + duration, stop, finished, transfers))
+		capture.start()
+
+		if self.network == 1:
+			# Wait for the duration, or until the client stops the time-lapse
+			self.waitStop(duration, finished=finished)
+		else:
+			try:
+				while not finished.wait(STOP_POLL):
+					pass
+			except KeyboardInterrupt:
+				pass
+
+		# Stop capturing, and wait for the last images to be sent
+		stop.set()
+		capture.join()
+		if transfers is not None:
+			sender.join()
+		self.camera.stop_preview()
+
+		return self.lapseSummary(lapse)
+
+	def timeLapseJob(self, job, interval, duration):
+		'''
+		Background job which captures a time-lapse on the splitter port of the
+		job, alongside other commands. The images are kept for the E command.
+		'''
+
+		lapse = self.newLapse(job.ports[0])
+		self.timeLapseCapture(lapse, interval, time.time() + duration, job.stop, threading.Event(), None)
+		self.pending.extend((fname, "Image") for fname in lapse["files"])
+		return self.lapseSummary(lapse)
+
+	def newLapse(self, port):
+		'''
+		Returns the state of a new time-lapse on a splitter port.
+		'''
+
+		return {"name": "TL_" + datetime.utcnow().strftime('%y%m%d-%H%M%S') + "_" + str(port), "port": port,
+			"files": [], "jitters": [], "skipped": 0, "error": None}
+
+	def lapseSummary(self, lapse):
+		'''
+		Returns a summary of the images of a time-lapse and their jitter.
 		'''
-		Capture a video and store on Pi.
+
+		jitters = lapse["jitters"]
+		summary = "Time-lapse finished: " + str(len(jitters)) + " images, " + str(lapse["skipped"]) + " skipped"
+		if len(jitters) > 0:
+			summary += ", jitter mean %.1f ms, max %.1f ms" % (1000*sum(jitters)/len(jitters), 1000*max(jitters))
+		if lapse["error"] is not None:
+			summary += ", stopped by error: " + str(lapse["error"])
+		return summary
+
+	def timeLapseCapture(self, lapse, interval, end, stop, finished, transfers):
+		'''
+		Thread which captures the images of a time-lapse. Each image is
+		scheduled on an absolute deadline from the start, rather than an
+		interval from the last capture, so that the time-lapse doesn't drift.
+		If a capture overruns, the deadlines which have passed are skipped.
+		The jitter of each image, from its deadline to the start of its
+		capture, is logged to a metrics file.
+		'''
+
+		frames = self.camera.capture_continuous("../../Images/" + lapse["name"] + "_{counter:05d}.jpg", use_video_port=True, splitter_port=lapse["port"])
+		metrics = metricsLog(metricsPath(lapse["name"] + ".met"), TIMELAPSE_FIELDS)
+		deadline = time.time()
+		try:
+			while deadline < end:
+				# Sleep until the deadline, unless the time-lapse is stopped
+				if stop.wait(max(deadline - time.time(), 0)):
+					break
+
+				woke = time.time()
+				with timer("capture"):
+					fname = next(frames)
+				done = time.time()
+
+				jitter = woke - deadline
+				lapse["jitters"].append(jitter)
+				lapse["files"].append(fname)
+				metrics.write(len(lapse["jitters"]), deadline, jitter, done - woke)
+				self.telemetry.count("images_total")
+				if transfers is not None:
+					transfers.put((len(lapse["jitters"]), jitter, fname))
+
+				deadline += interval
+				if done > deadline:
+					missed = int((done - deadline) / interval) + 1
+					lapse["skipped"] += missed
+					deadline += missed * interval
+		except Exception as e:
+			traceback.print_exc()
+			lapse["error"] = e
+		finally:
+			frames.close()
+			metrics.close()
+			if transfers is not None:
+				transfers.put(None)
+			finished.set()
+
+	def timeLapseTransfer(self, transfers):
+		'''
+		Thread which sends the images of a time-lapse to the client, until a
+		None image is received. The images captured since the last batch are
+		sent together, each preceded by its number, jitter in milliseconds and
+		name.
+		'''
+
+		while True:
+			batch = [transfers.get()]
+			while batch[-1] is not None and not transfers.empty():
+				batch.append(transfers.get())
+
+			for image in batch:
+				if image is None:
+					return
+
+				index, jitter, fname = image
+				fname = os.path.basename(fname)
+				if not self.detached:
+					self.send_msg(self.hostSock, "Frame:" + str(index) + ":" + "%.1f" % (jitter*1000) + ":" + fname)
+				self.sendFile(fname, "Image")
+
+	def captureStream(self, duration, fname, port=RECORD_PORT):
+		'''
+		Capture a video on a splitter port and store on Pi.
 		'''
 
 		# Locate the Videos folder
@@ -347,101 +979,108 @@ class cameraModuleServer:
 		time.sleep(2)
 
 		# Record the camera for length <duration>, and store in file <fname>
-		self.camera.start_recording("../../Videos/input.h264")
+		raw = "../../Videos/input" + str(port) + ".h264"
+		output = TelemetryOutput(self.camera, self.telemetry, raw, "video", port)
+		self.camera.start_recording(output, format='h264', splitter_port=port)
 
 		if self.network == 1:
-			# Set up camera wait processes
-			p1 = Process(target = self.waitProcess, args=(duration,))
-			p2 = Process(target = self.stopProcess)
-
-			# Multiprocessing to determine when to stop recording
-			p1.start()
-			p2.start()
-			while p1.is_alive() and p2.is_alive():
-				continue
-			p1.terminate()
-			p2.terminate()
+			# Wait for the duration, or until the client stops the recording
+			self.waitStop(duration, port)
 		else:
 			try:
-				self.camera.wait_recording(duration)
+				self.camera.wait_recording(duration, splitter_port=port)
 			except KeyboardInterrupt:
 				pass
 
 		# Stop recording once one process has finished
-		self.camera.stop_recording()
+		self.camera.stop_recording(splitter_port=port)
 		self.camera.stop_preview()
+		output.close()
 
 		# Place the h264 raw video file into a container, in order to get playback at the correct framerate
-		os.system("MP4Box -add ../../Videos/input.h264 " + floc + " -fps " + str(self.camera.framerate))
+		os.system("MP4Box -add " + raw + " " + floc + " -fps " + str(self.camera.framerate))
 
-	def networkStreamClient(self, sock, duration):
+	def recordJob(self, job, duration, fname):
 		'''
-		Stream a video through the network.
+		Background job which records a video on the splitter port of the job,
+		alongside other commands. The video is kept for the E command.
 		'''
 
-		if self.network == 1:
-			# Set up camera wait processes
-			p1 = Process(target = self.waitProcess, args=(duration,))
-			p2 = Process(target = self.stopProcess)
+		port = job.ports[0]
+		raw = "../../Videos/input" + str(port) + ".h264"
+		output = TelemetryOutput(self.camera, self.telemetry, raw, "video", port)
+		self.camera.start_recording(output, format='h264', splitter_port=port)
+		try:
+			# Record for the duration, or until the job is cancelled
+			end = time.time() + duration
+			while time.time() < end and not job.stop.wait(max(min(end - time.time(), STOP_POLL), 0)):
+				self.camera.wait_recording(0, splitter_port=port)
+		finally:
+			self.camera.stop_recording(splitter_port=port)
+			output.close()
+
+		os.system("MP4Box -add " + raw + " ../../Videos/" + fname + " -fps " + str(self.camera.framerate))
+		self.pending.append(("../../Videos/" + fname, "Video"))
+		return "Recorded " + fname
+
+	def networkStreamClient(self, sock, duration, port=RECORD_PORT):
+		'''
+		Stream a video through the network, on the stream channel of the
+		control connection.
+		'''
 
+		if self.network == 1:
 			# Send framerate to client
 			self.send_msg(sock, str(self.camera.framerate))
 
-			# Create a file-like object for the connection
-			connection = sock.makefile('wb')
+			# Create a file-like object for the stream channel
+			connection = ChannelOutput(self, CHANNEL_STREAM)
 			try:
 				# Warm the camera up
 				self.camera.start_preview()
 				time.sleep(2)
 
 				# Record the camera for length <duration>
-				self.camera.start_recording(connection, format = 'h264')
+				self.camera.start_recording(TelemetryOutput(self.camera, self.telemetry, connection, "network", port), format = 'h264', resize = self.roiSize(self.camera.resolution), splitter_port=port)
 
-				# Multiprocessing to determine when to stop recording
-				p1.start()
-				p2.start()
-				while p1.is_alive() and p2.is_alive():
-					continue
-				p1.terminate()
-				p2.terminate()
+				# Wait for the duration, or until the client stops the recording
+				self.waitStop(duration, port, stopOnLoss=True)
 
 				# Stop recording once one process has finished
-				self.camera.stop_recording()
+				self.camera.stop_recording(splitter_port=port)
 				self.camera.stop_preview()
 			finally:
-				# Free connection resources
+				# Close the channel, which leaves the connection ready for the next command
 				connection.close()
-				self.closeNetwork()
-				self.initNetwork()
 
-	def networkSubtract(self, duration):
+	def networkSubtract(self, duration, port=RECORD_PORT):
 		'''
 		Stream a video through the network, and allow image subtraction with openCV on the client computer.
 		'''
 
 		if self.network == 1:
 
-			# Set up camera wait processes
-			p1 = Process(target = self.delayProcess, args=(duration,))
-			p2 = Process(target = self.stopProcess)
-
-			# Send framerate to client
-			self.send_msg(self.hostSock, str(self.camera.framerate))
+			# Send framerate, resolution and region of interest to client
+			size = self.roiSize(self.camera.resolution)
+			self.sendStreamInfo(size)
 
 			# Stream from picamera and pipe into gstreamer to stream over network
-			cmdstr = ['gst-launch-1.0', '-v', 'fdsrc', '!', 'h264parse', '!', 'rtph264pay', 'config-interval=1', 'pt=96', '!', 'gdppay', '!', 'tcpserversink', 'host=192.168.1.1', 'port=5000']
+			cmdstr = ['gst-launch-1.0', '-v', 'fdsrc', '!', 'h264parse', '!', 'rtph264pay', 'config-interval=1', 'pt=96', '!', 'gdppay', '!', 'tcpserversink', 'host=192.168.1.1', 'port=' + str(STREAM_PORT)]
 			pcm = subprocess.Popen(cmdstr, stdin=subprocess.PIPE)
-			self.camera.start_recording(pcm.stdin, format='h264')
-			# Multiprocessing to determine when to stop recording
-			p1.start()
-			p2.start()
-			while p1.is_alive() and p2.is_alive():
-				continue
-			p1.terminate()
-			p2.terminate()
+			self.camera.start_recording(TelemetryOutput(self.camera, self.telemetry, pcm.stdin, "subtract", port), format='h264', resize=size, splitter_port=port)
+
+			# Tell the client to connect once gstreamer is listening, or that
+			# the stream failed
+			if self.waitListening(STREAM_PORT):
+				self.confirmCompletion("Listening")
+
+				# Wait for the duration, or until the client stops the recording
+				self.waitStop(duration)
+			else:
+				self.confirmCompletion("Stream failed to start")
 
 			# Stop recording
-			self.camera.stop_recording()
+			self.camera.stop_recording(splitter_port=port)
 
 			# Terminate the streamer command
 			pcm.terminate()
@@ -449,13 +1088,13 @@ class cameraModuleServer:
 		else:
 			try:
 				# Stream from picamera and pipe into gstreamer to stream into opencv
-				cmdstr = ['gst-launch-1.0', '-v', 'fdsrc', '!', 'h264parse', '!', 'rtph264pay', 'config-interval=1', 'pt=96', '!', 'gdppay', '!', 'tcpserversink', 'host=192.168.1.1', 'port=5000']
+				cmdstr = ['gst-launch-1.0', '-v', 'fdsrc', '!', 'h264parse', '!', 'rtph264pay', 'config-interval=1', 'pt=96', '!', 'gdppay', '!', 'tcpserversink', 'host=192.168.1.1', 'port=' + str(STREAM_PORT)]
 				pcm = subprocess.Popen(cmdstr, stdin=subprocess.PIPE)
-				self.camera.start_recording(pcm.stdin, format='h264')
+				self.camera.start_recording(TelemetryOutput(self.camera, self.telemetry, pcm.stdin, "subtract", port), format='h264', resize=self.roiSize(self.camera.resolution), splitter_port=port)
 
 				# Start the opencv executable
 				frate = str(self.camera.framerate)
-				gstcmd = "tcpclientsrc host=192.168.1.1 port=5000 ! gdpdepay ! rtph264depay ! video/x-h264, framerate=" + frate + "/1 ! avdec_h264 ! videoconvert ! appsink"
+				gstcmd = "tcpclientsrc host=192.168.1.1 port=" + str(STREAM_PORT) + " ! gdpdepay ! rtph264depay ! video/x-h264, framerate=" + frate + "/1 ! avdec_h264 ! videoconvert ! appsink"
 				subline = ['./BackGroundSubb_Video_RPI', '-vid', gstcmd]
 				time.sleep(0.1)
 				player = subprocess.Popen(subline)
@@ -464,16 +1103,146 @@ class cameraModuleServer:
 				time.sleep(duration)
 
 				# Stop recording and close resources
-				self.camera.stop_recording()
+				self.camera.stop_recording(splitter_port=port)
 				pcm.terminate()
 				player.terminate()
 
 			except KeyboardInterrupt:
 				# Stop recording and close resources if Ctrl+C is pressed
-				self.camera.stop_recording()
+				self.camera.stop_recording(splitter_port=port)
 				pcm.terminate()
 				player.terminate()
 
+	def networkPreview(self, duration, ports=(PREVIEW_PORT, FOCUS_PORT)):
+		'''
+		Stream a downscaled MJPEG preview on its own splitter port and network
+		port, for display in the client GUI. Each frame is sent with its index
+		and age, so that the client can measure the preview latency, and the
+		newest focus score, measured on a second splitter port.
+		'''
+
+		if self.network == 1:
+			# Listen for the preview connection before sending the resolution
+			size = self.roiSize((PREVIEW_WIDTH, PREVIEW_HEIGHT))
+			listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+			listener.bind((self.host, PREVIEW_NET_PORT))
+			listener.listen(0)
+			self.send_msg(self.hostSock, str(size[0]) + "x" + str(size[1]))
+			connection = self.acceptPreview(listener)
+			if connection is None:
+				print("The client didn't connect to the preview")
+				return
+			connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+			# The preview carries on without the focus score if numpy isn't installed
+			focus = None
+			try:
+				from cameraLibFocus import focusFrames
+				focus = focusFrames(self.roiSize((FOCUS_WIDTH, FOCUS_HEIGHT)))
+			except ImportError:
+				print("Install numpy to measure the focus")
+
+			output = PreviewFrames(self.camera, connection, focus)
+			try:
+				self.camera.start_recording(output, format='mjpeg', resize=size, splitter_port=ports[0])
+				if focus is not None:
+					self.camera.start_recording(focus, format='yuv', resize=focus.resolution, splitter_port=ports[1])
+
+				# Wait for the duration, or until the client stops the recording
+				self.waitStop(duration, stopOnLoss=True)
+
+				# Stop recording
+				if focus is not None:
+					self.camera.stop_recording(splitter_port=ports[1])
+				self.camera.stop_recording(splitter_port=ports[0])
+			finally:
+				# Closing the connection tells the client that the preview has ended
+				connection.close()
+				if focus is not None:
+					focus.close()
+
+	def networkPipeline(self, duration, fname, ports=(RECORD_PORT, ANALYSIS_PORT)):
+		'''
+		Record a full resolution video on one splitter port, while a downscaled
+		copy is streamed on another splitter port for image subtraction. The
+		cost of the subtraction then depends on the analysis resolution rather
+		than the sensor resolution.
+		'''
+
+		# Locate the Videos folder
+		floc = "../../Videos/" + fname
+		raw = "../../Videos/input" + str(ports[0]) + ".h264"
+		size = self.roiSize((ANALYSIS_WIDTH, ANALYSIS_HEIGHT))
+
+		# Stream from picamera and pipe into gstreamer to stream over network
+		cmdstr = ['gst-launch-1.0', '-v', 'fdsrc', '!', 'h264parse', '!', 'rtph264pay', 'config-interval=1', 'pt=96', '!', 'gdppay', '!', 'tcpserversink', 'host=192.168.1.1', 'port=' + str(STREAM_PORT)]
+
+		if self.network == 1:
+			# Send framerate, analysis resolution and region of interest to client
+			self.sendStreamInfo(size)
+
+			# Record at full resolution, and stream the resized copy
+			pcm = subprocess.Popen(cmdstr, stdin=subprocess.PIPE)
+			output = TelemetryOutput(self.camera, self.telemetry, raw, "video", ports[0])
+			self.camera.start_recording(output, format='h264', splitter_port=ports[0])
+			self.camera.start_recording(TelemetryOutput(self.camera, self.telemetry, pcm.stdin, "analysis", ports[1]), format='h264', resize=size, splitter_port=ports[1])
+
+			# Tell the client to connect once gstreamer is listening, or that
+			# the stream failed
+			listening = self.waitListening(STREAM_PORT)
+			if listening:
+				self.confirmCompletion("Listening")
+
+				# Wait for the duration, or until the client stops the recording
+				self.waitStop(duration)
+			else:
+				self.confirmCompletion("Stream failed to start")
+
+			# Stop recording on both splitter ports
+			self.camera.stop_recording(splitter_port=ports[1])
+			self.camera.stop_recording(splitter_port=ports[0])
+
+			# Terminate the streamer command
+			pcm.terminate()
+
+			if not listening:
+				# The recording is abandoned along with the stream
+				output.close()
+				return False
+
+		else:
+			pcm = subprocess.Popen(cmdstr, stdin=subprocess.PIPE)
+			output = TelemetryOutput(self.camera, self.telemetry, raw, "video", ports[0])
+			self.camera.start_recording(output, format='h264', splitter_port=ports[0])
+			self.camera.start_recording(TelemetryOutput(self.camera, self.telemetry, pcm.stdin, "analysis", ports[1]), format='h264', resize=size, splitter_port=ports[1])
+
+			# Start the opencv executable on the resized stream
+			frate = str(self.camera.framerate)
+			gstcmd = "tcpclientsrc host=192.168.1.1 port=" + str(STREAM_PORT) + " ! gdpdepay ! rtph264depay ! video/x-h264, framerate=" + frate + "/1 ! avdec_h264 ! videoconvert ! appsink"
+			subline = ['./BackGroundSubb_Video_RPI', '-vid', gstcmd]
+			time.sleep(0.1)
+			player = subprocess.Popen(subline)
+
+			try:
+				# Wait for specified duration
+				self.camera.wait_recording(duration, splitter_port=ports[0])
+			except KeyboardInterrupt:
+				pass
+
+			# Stop recording and close resources
+			self.camera.stop_recording(splitter_port=ports[1])
+			self.camera.stop_recording(splitter_port=ports[0])
+			pcm.terminate()
+			player.terminate()
+
+		output.close()
+
+		# Place the h264 raw video file into a container, in order to get playback at the correct framerate
+		os.system("MP4Box -add " + raw + " " + floc + " -fps " + str(self.camera.framerate))
+		return True
+
+	@timed("send_msg")
 	def send_msg(self, sock, msg):
 		'''
 		Send message with a prefixed length.
@@ -481,8 +1250,20 @@ class cameraModuleServer:
 
 		# Prefix each message with a 4-byte length (network byte order)
 		msg = struct.pack('>I', len(msg)) + msg
-		sock.sendall(msg)
 
+		# Messages to a lost client are dropped, and the command carries on
+		with self.sendLock:
+			if sock is None:
+				self.detached = True
+				return False
+			try:
+				sock.sendall(msg)
+			except socket.error:
+				self.detached = True
+				return False
+		return True
+
+	@timed("recv_msg")
 	def recv_msg(self, sock):
 		'''
 		Receive a message from the network.
@@ -505,7 +1286,10 @@ class cameraModuleServer:
 		# Helper function to recv n bytes or return None if EOF is hit
 		data = ''
 		while len(data) < n:
-			packet = sock.recv(n - len(data))
+			try:
+				packet = sock.recv(n - len(data))
+			except socket.error:
+				return None
 			if not packet:
 				return None
 			data += packet
@@ -517,28 +1301,73 @@ class cameraModuleServer:
 		Initialise the client side network on the Raspberry Pi.
 		'''
 
-		# Initialise the socket connection
-		self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-		self.host = '192.168.1.1'
-		self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-		self.server_socket.bind((self.host, 8000))
-		self.server_socket.listen(0)
+		# Keep listening for as long as the server runs, so that the client
+		# can reconnect at any time
+		if self.server_socket is None:
+			self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			self.host = '192.168.1.1'
+			self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+			self.server_socket.bind((self.host, 8000))
+			self.server_socket.listen(1)
 
 		# Wait for a computer to connect
 		print("Waiting for connection...")
-		(self.hostSock, self.address) = self.server_socket.accept()
-		print("Connection accepted")
-		self.server_socket.close()
+		self.acceptClient()
+
+	def acceptClient(self):
+		'''
+		Accept a connection from the client. A new connection replaces the
+		previous one, which may have been lost without the Pi noticing.
+		'''
+
+		(sock, self.address) = self.server_socket.accept()
+		self.telemetry.count("connections_total")
+		if self.hostSock is not None:
+			print("Client reconnected")
+			self.connectionLost()
+		else:
+			print("Connection accepted")
+
+		# Send short messages straight away, rather than waiting for the
+		# acknowledgement of the previous message
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+		# Notice a silently lost connection within a few seconds
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+		if hasattr(socket, "TCP_KEEPIDLE"):
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE[0])
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KEEPALIVE[1])
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, KEEPALIVE[2])
+
+		self.hostSock = sock
 		self.network = 1
 
+	def connectionLost(self):
+		'''
+		Drop the connection to the client. A command which is running carries
+		on, but its results are kept for the client instead of being sent.
+		'''
+
+		if self.hostSock is not None:
+			print("Connection lost")
+			self.telemetry.count("connections_lost_total")
+			self.hostSock.close()
+			self.hostSock = None
+		self.detached = True
+
 	def closeNetwork(self):
 		'''
 		Close the client side network on the Raspberry Pi.
 		'''
 
-		self.hostSock.close()
+		if self.hostSock is not None:
+			self.hostSock.close()
+			self.hostSock = None
 		self.network = 0
 
+		# Print the timings of the session, if enabled
+		dumpTimings("session")
+
 	def printCommands(self):
 		'''
 		Print a list of commands.
@@ -547,10 +1376,16 @@ class cameraModuleServer:
 		print("\nList of commands: ")
 		print("	B: Set brightness")
 		print("	C: Set contrast")
+		print("	D: Record with image subtraction")
+		print("	E: Resend files the client didn't receive")
 		print("	F: Set framerate")
 		print("	G: Set gain")
 		print("	H: Help")
 		print("	I: Capture an image")
+		print("	J: Show background jobs")
+		print("	K: Capture a stacked low-noise image")
+		print("	L: Live preview in the GUI")
+		print("	M: Set several parameters at once")
 		print("	N: Stream to network")
 		print("	O: Stream with image subtraction")
 		print("	P: Get camera settings")
@@ -560,7 +1395,10 @@ class cameraModuleServer:
 		print("	T: Capture with trigger")
 		print("	U: Set saturation")
 		print("	V: Capture a video")
-		print("	X: Set exposure time\n")
+		print("	W: Capture a time-lapse")
+		print("	X: Set exposure time")
+		print("	Y: Show telemetry")
+		print("	Z: Set region of interest\n")
 
 	def sendAll(self):
 
@@ -600,12 +1438,12 @@ class cameraModuleServer:
 		self.send_msg(self.hostSock, str(SHARPNESS_MIN))
 		self.send_msg(self.hostSock, str(SHARPNESS_MAX))
 
-	def inputParameter(self, parameter):
+	def parameterLimits(self, parameter):
 		'''
-		Wait for a parameter from either the network or the Pi terminal.
+		Returns the current (default), minimum and maximum values of a
+		parameter, or None for each if the parameter is unknown.
 		'''
 
-		# Find the default, minimum, and maximum values for the parameter
 		if parameter == "Brightness":
 			default = self.camera.brightness
 			minimum = BRIGHTNESS_MIN
@@ -656,11 +1494,180 @@ class cameraModuleServer:
 			minimum = FRAMERATE_MIN
 			maximum = FRAMERATE_MAX
 
+		elif parameter == "Interval":
+			default = INTERVAL_DEFAULT
+			minimum = INTERVAL_MIN
+			maximum = INTERVAL_MAX
+
+		elif parameter == "Frames":
+			default = STACK_DEFAULT
+			minimum = STACK_MIN
+			maximum = STACK_MAX
+
+		elif parameter == "Reject outliers":
+			default = 0
+			minimum = 0
+			maximum = 1
+
+		elif parameter == "ROI x":
+			default = int(round(self.roi[0]*100))
+			minimum = ROI_MIN
+			maximum = ROI_MAX
+
+		elif parameter == "ROI y":
+			default = int(round(self.roi[1]*100))
+			minimum = ROI_MIN
+			maximum = ROI_MAX
+
+		elif parameter == "ROI width":
+			default = int(round(self.roi[2]*100))
+			minimum = ROI_SIZE_MIN
+			maximum = ROI_MAX
+
+		elif parameter == "ROI height":
+			default = int(round(self.roi[3]*100))
+			minimum = ROI_SIZE_MIN
+			maximum = ROI_MAX
+
 		else:
 			default = None
 			minimum = None
 			maximum = None
 
+		return default, minimum, maximum
+
+	def currentParameters(self):
+		'''
+		Returns a dictionary of the current value of every parameter that can
+		be set with setParameters.
+		'''
+
+		values = {}
+		for parameter in PARAMETERS:
+			value = self.parameterLimits(parameter)[0]
+			values[parameter] = int(value) if float(value) == int(value) else float(value)
+		return values
+
+	def setParameters(self, params):
+		'''
+		Validate a dictionary of parameter values, then apply all of them. If
+		any value is invalid, or the camera rejects a value, then no parameter
+		is changed. Returns a dictionary of errors, which is empty on success.
+		'''
+
+		# Validate every value before changing anything
+		errors = {}
+		values = {}
+		for parameter in params:
+			if parameter not in PARAMETERS:
+				errors[parameter] = "Unknown parameter"
+				continue
+			default, minimum, maximum = self.parameterLimits(parameter)
+			try:
+				value = float(params[parameter])
+			except (TypeError, ValueError):
+				errors[parameter] = "Not a number"
+				continue
+			if value < minimum:
+				errors[parameter] = "Value is less than minimum"
+			elif value > maximum:
+				errors[parameter] = "Value is greater than maximum"
+			else:
+				values[parameter] = value
+
+		# The region of interest must fit within the sensor, along with the
+		# current values of the parameters which aren't changed, rather than
+		# being moved by setROI
+		merged = self.currentParameters()
+		merged.update(values)
+		for position, size in [("ROI x", "ROI width"), ("ROI y", "ROI height")]:
+			if position in errors or size in errors:
+				continue
+			if merged[position] + merged[size] > ROI_MAX:
+				errors[position if position in values else size] = "Region of interest extends past the sensor"
+
+		if len(errors) > 0:
+			return errors
+
+		# Apply the values, restoring the previous values if the camera fails
+		previous = self.currentParameters()
+		try:
+			self.applyParameters(values, previous)
+		except Exception as e:
+			self.applyParameters(previous, self.currentParameters())
+			errors["Camera"] = str(e)
+
+		return errors
+
+	def applyParameters(self, values, current):
+		'''
+		Apply validated parameter values which differ from the current values.
+		'''
+
+		changed = dict((p, values[p]) for p in values if values[p] != current[p])
+		merged = dict(current)
+		merged.update(values)
+
+		if "Width" in changed or "Height" in changed:
+			self.setResolution(int(merged["Width"]), int(merged["Height"]))
+		if "Framerate" in changed:
+			self.setFrameRate(merged["Framerate"])
+		if "Exposure time" in changed:
+			self.setExposureTime(int(merged["Exposure time"]))
+		if "Brightness" in changed:
+			self.setBrightness(int(merged["Brightness"]))
+		if "Contrast" in changed:
+			self.setContrast(int(merged["Contrast"]))
+		if "Gain" in changed:
+			self.setGain(int(merged["Gain"]))
+		if "Saturation" in changed:
+			self.setSaturation(int(merged["Saturation"]))
+		if "Sharpness" in changed:
+			self.setSharpness(int(merged["Sharpness"]))
+		if "ROI x" in changed or "ROI y" in changed or "ROI width" in changed or "ROI height" in changed:
+			self.setROI(merged["ROI x"], merged["ROI y"], merged["ROI width"], merged["ROI height"])
+
+	def inputParameters(self):
+		'''
+		Wait for a dictionary of parameter values from either the network, as
+		a JSON object, or the Pi terminal, as name=value pairs.
+		'''
+
+		if self.network == 1:
+			print("Waiting for parameters...")
+			return json.loads(self.recvInput())
+
+		params = {}
+		line = str(raw_input("Parameters (e.g. Brightness=50, Contrast=10): "))
+		for pair in line.split(","):
+			if "=" in pair:
+				name, value = pair.split("=", 1)
+				params[name.strip()] = value.strip()
+		return params
+
+	def sendParameters(self, errors):
+		'''
+		Send or print the result of setParameters, with the current values of
+		every parameter.
+		'''
+
+		result = {"errors": errors, "values": self.currentParameters()}
+		if self.network == 1:
+			self.send_msg(self.hostSock, json.dumps(result))
+		elif len(errors) > 0:
+			for parameter in errors:
+				print(parameter + ": " + errors[parameter])
+		else:
+			print("Parameters changed")
+
+	def inputParameter(self, parameter):
+		'''
+		Wait for a parameter from either the network or the Pi terminal.
+		'''
+
+		# Find the default, minimum, and maximum values for the parameter
+		default, minimum, maximum = self.parameterLimits(parameter)
+
 		if self.network == 1:
 
 			# Send default, min, and max to network computer
@@ -670,7 +1677,9 @@ class cameraModuleServer:
 
 			# Wait for parameter input from network computer
 			print("Waiting for " + parameter.lower() + "...")
-			value = self.recv_msg(self.hostSock)
+			value = self.recvInput()
+			if value == None:
+				raise socket.error("Connection lost while waiting for " + parameter.lower())
 			print(parameter + ": " + str(value))
 		else:
 			# Process parameter inputs from terminal
@@ -684,9 +1693,10 @@ class cameraModuleServer:
 				else:
 					try:
 						# Condition for exceeding min/max bounds
-						if int(value) < minimum:
+						number = float(value) if parameter in FRACTIONAL_INPUTS else int(value)
+						if number < minimum:
 							print("Value is less than minimum")
-						elif int(value) > maximum:
+						elif number > maximum:
 							print("Value is greater than maximum")
 						elif value == "inf":
 							value = str(sys.maxint)
@@ -708,7 +1718,9 @@ class cameraModuleServer:
 
 			# Wait for parameter input from network computer
 			print("Wating for " + parameter.lower() + "...")
-			value = self.recv_msg(self.hostSock)
+			value = self.recvInput()
+			if value == None:
+				raise socket.error("Connection lost while waiting for " + parameter.lower())
 			print(parameter + ": " + str(value))
 		else:
 			# Process parameter inputs from terminal
@@ -729,10 +1741,10 @@ class cameraModuleServer:
 						ftype = ""
 
 					# Continue only if file extension is correct
-					if ftype in IMAGE_TYPES:
+					if ftype in IMAGE_TYPES + RAW_TYPES:
 						break
 					else:
-						print("Image filename must have one of these extensions: " + str(IMAGE_TYPES))
+						print("Image filename must have one of these extensions: " + str(IMAGE_TYPES + RAW_TYPES))
 				else:
 					# All video extensions supported, so no need to check
 					break
@@ -744,7 +1756,9 @@ class cameraModuleServer:
 		'''
 
 		if self.network == 1:
-			self.send_msg(self.hostSock, message)
+			# A reconnecting client doesn't expect the rest of an earlier command
+			if not self.detached:
+				self.send_msg(self.hostSock, message)
 		else:
 			print(message)
 
@@ -764,7 +1778,10 @@ class cameraModuleServer:
 		saturation = str(self.camera.saturation)
 		xt = str(self.camera.exposure_speed)
 
-		if self.network == 1:
+		if self.network == 1 and self.detached:
+			# A reconnecting client doesn't expect the rest of an earlier command
+			return
+		elif self.network == 1:
 			# Send the properties to the remote computer
 			self.send_msg(self.hostSock, resolution)
 			self.send_msg(self.hostSock, framerate)
@@ -807,14 +1824,65 @@ class cameraModuleServer:
 		Send an image or video file over a network.
 		'''
 
-		# Send the image via Netcat
 		if typ == "Image":
-			os.system("nc -l 60000 < ../../Images/" + fname)
+			path = "../../Images/" + fname
 		elif typ == "Trigger":
-			self.send_msg(self.hostSock, fname)
-			os.system("nc -l 60000 < " + fname)
+			path = fname
 		elif typ == "Video":
-			os.system("nc -l 60000 < ../../Videos/" + fname)
+			path = "../../Videos/" + fname
+
+		# Keep the file for a reconnecting client if the connection was lost
+		if self.detached:
+			self.pending.append((path, typ))
+			return
+
+		if typ == "Trigger":
+			self.send_msg(self.hostSock, fname)
+		if not self.sendChannelFile(path):
+			self.pending.append((path, typ))
+
+	def sendChannelFile(self, path):
+		'''
+		Send a file on the file channel of the control connection. Returns
+		False if the connection was lost.
+		'''
+
+		# The channel is always closed, so that the client isn't left waiting
+		output = ChannelOutput(self, CHANNEL_FILE)
+		try:
+			with open(path, "rb") as f:
+				while True:
+					with timer("file read"):
+						data = f.read(FILE_CHUNK)
+					if not data:
+						break
+					output.write(data)
+					self.telemetry.count("file_bytes_sent_total", len(data))
+		except IOError:
+			print("Cannot send " + path)
+		finally:
+			output.close()
+
+		if not output.failed:
+			self.telemetry.count("files_sent_total")
+		return not output.failed
+
+	def sendPending(self):
+		'''
+		Send the files which couldn't be sent while the connection was lost,
+		each preceded by its type and name, followed by "Q".
+		'''
+
+		pending = self.pending
+		self.pending = []
+		for path, typ in pending:
+			if typ == "Video":
+				self.send_msg(self.hostSock, "Video:" + os.path.basename(path))
+			else:
+				self.send_msg(self.hostSock, "Image:" + os.path.basename(path))
+			if self.detached or not self.sendChannelFile(path):
+				self.pending.append((path, typ))
+		self.send_msg(self.hostSock, "Q")
 
 	def receiveCommand(self):
 		'''
@@ -822,10 +1890,30 @@ class cameraModuleServer:
 		'''
 
 		if self.network == 1:
-			# Recieve data from host
+			# Commands received while a recording was running come first
+			if len(self.deferred) > 0:
+				command = self.deferred.pop(0)
+				print("Command received: " + command)
+				return command
+
+			# Recieve data from host, or a connection from a reconnecting client
 			print("Waiting for command...")
+			while True:
+				sockets = [self.server_socket]
+				if self.hostSock is not None:
+					sockets.append(self.hostSock)
+				readable = select.select(sockets, [], [])[0]
+				if self.server_socket in readable:
+					self.acceptClient()
+				else:
+					break
 			command = self.recv_msg(self.hostSock)
-			print("Command received: " + command)
+			if command == None:
+				print("Connection lost")
+			elif isMessage(command):
+				print("Request received")
+			else:
+				print("Command received: " + command)
 		else:
 			# Wait for command from Pi
 			command = str(raw_input("Input camera command: ")).upper()
@@ -838,6 +1926,120 @@ class cameraModuleServer:
 		Raspberry Pi terminal.
 		'''
 
+		if isMessage(command):
+			self.answerRequest(command)
+			return
+
+		# Commands are performed for the client which sent them
+		self.running = command
+		self.detached = False
+		self.telemetry.count("commands_total", 1, command)
+
+		# Commands which use the camera wait for the splitter ports they need
+		if command in JOB_NEEDS:
+			self.job = self.waitJob(command, JOB_NEEDS[command])
+		self.holdAnswers()
+		try:
+			self.runCommand(command)
+		finally:
+			self.releaseAnswers()
+			if self.job is not None:
+				self.scheduler.finish(self.job)
+				self.job = None
+			self.running = None
+
+			# Messages which the command didn't read are performed next
+			self.deferred.extend(self.held)
+			self.held = []
+
+	def holdAnswers(self):
+		'''
+		Hold back the answers of requests while a command prompts the client,
+		so they don't arrive between the messages of its parameters.
+		'''
+
+		self.answerLock.acquire()
+		self.prompting = True
+
+	def releaseAnswers(self):
+		'''
+		Let requests be answered again. Returns whether they were held back.
+		'''
+
+		held = self.prompting
+		if held:
+			self.prompting = False
+			self.answerLock.release()
+		return held
+
+	def recvInput(self):
+		'''
+		Receive a parameter of the command from the client, starting with any
+		received while the command waited for the camera.
+		'''
+
+		if len(self.held) > 0:
+			return self.held.pop(0)
+		return self.recv_msg(self.hostSock)
+
+	def waitJob(self, name, needs):
+		'''
+		Submit a command to the job scheduler, and wait until the splitter
+		ports it needs are no longer used by background jobs. "Stop" (or
+		Ctrl+C on the Pi) stops the background jobs instead of waiting.
+		'''
+
+		job = self.scheduler.submit(name, needs)
+		if job.ready.is_set():
+			return job
+		print("Waiting for the camera...")
+
+		if self.network == 0:
+			try:
+				while not job.ready.wait(STOP_POLL):
+					pass
+			except KeyboardInterrupt:
+				# Ctrl+C stops the background jobs, so the command can go ahead
+				self.scheduler.stopBackground()
+				job.ready.wait()
+			return job
+
+		# Requests and reconnecting clients are served while waiting, so that a
+		# client can list and cancel the jobs holding the camera
+		held = self.releaseAnswers()
+		try:
+			while not job.ready.is_set():
+				sockets = [self.server_socket]
+				if self.hostSock is not None:
+					sockets.append(self.hostSock)
+				readable = select.select(sockets, [], [], STOP_POLL)[0]
+
+				if self.server_socket in readable:
+					self.acceptClient()
+				elif self.hostSock in readable:
+					msg = self.recv_msg(self.hostSock)
+					if msg == "Stop":
+						# Stop the background jobs, so the command can go ahead
+						print("Stopping background jobs...")
+						self.scheduler.stopBackground()
+					elif msg == None:
+						# The command carries on for a reconnecting client
+						self.connectionLost()
+					elif isMessage(msg):
+						self.answerRequest(msg)
+					else:
+						# Parameters of the command, which are read once it runs
+						self.held.append(msg)
+		finally:
+			if held:
+				self.holdAnswers()
+		return job
+
+	def runCommand(self, command):
+		'''
+		Perform a command once the camera resources it needs are allocated.
+		'''
+
 		if command == "A":
 			self.sendAll()
 
@@ -853,6 +2055,19 @@ class cameraModuleServer:
 			self.setContrast(contrast)
 			self.confirmCompletion("Contrast changed")
 
+		# Record at full resolution while streaming a downscaled subtraction stream
+		elif command == "D":
+			duration = float(self.inputParameter("Duration"))
+			self.confirmCompletion("Duration set")
+			filename = self.inputStrParameter("Video filename")
+			self.confirmCompletion("Recording started...")
+			if not self.networkPipeline(duration, filename, self.job.ports):
+				return
+			self.confirmCompletion("Recording finished")
+			self.printStats()
+			if self.network == 1:
+				self.sendFile(filename, "Video")
+
 		# Set framerate
 		elif command == "F":
 			rate = float(self.inputParameter("Framerate"))
@@ -865,6 +2080,11 @@ class cameraModuleServer:
 			self.setGain(gain)
 			self.confirmCompletion("Gain changed")
 
+		# Resend files which couldn't be sent while the connection was lost
+		elif command == "E":
+			if self.network == 1:
+				self.sendPending()
+
 		# Help
 		elif command == "H":
 			self.printCommands()
@@ -873,18 +2093,53 @@ class cameraModuleServer:
 		elif command == "I":
 			filename = self.inputStrParameter("Image filename")
 			self.confirmCompletion("Image capturing...")
-			self.capturePhoto(filename)
-			self.confirmCompletion("Image captured")
+			if filename.split(".")[-1].lower() in RAW_TYPES:
+				# Raw captures use the still port, which needs the whole camera
+				self.scheduler.finish(self.job)
+				self.job = self.waitJob(command, JOB_EXCLUSIVE)
+				self.confirmCompletion(self.captureRaw(filename))
+			else:
+				self.capturePhoto(filename, self.job.ports[0])
+				self.confirmCompletion("Image captured")
+			self.printStats()
+			if self.network == 1:
+				self.sendFile(filename, "Image")
+
+		# Capture the mean of several frames
+		elif command == "K":
+			frames = int(float(self.inputParameter("Frames")))
+			self.confirmCompletion("Frames set")
+			reject = int(float(self.inputParameter("Reject outliers")))
+			self.confirmCompletion("Outlier rejection set")
+			filename = self.inputStrParameter("Image filename")
+			self.confirmCompletion("Stacking frames...")
+			summary = self.captureStack(frames, reject == 1, filename, self.job.ports[0])
+			self.confirmCompletion(summary)
 			self.printStats()
 			if self.network == 1:
 				self.sendFile(filename, "Image")
 
+		# Live preview
+		elif command == "L":
+			if self.network == 1:
+				duration = float(self.inputParameter("Duration"))
+				self.confirmCompletion("Duration set")
+				self.networkPreview(duration, self.job.ports)
+			else:
+				print("Not connected to network")
+
+		# Set several parameters at once
+		elif command == "M":
+			params = self.inputParameters()
+			errors = self.setParameters(params)
+			self.sendParameters(errors)
+
 		# Network stream
 		elif command == "N":
 			if self.network == 1:
 				duration = float(self.inputParameter("Duration"))
 				self.confirmCompletion("Duration set")
-				self.networkStreamClient(self.hostSock, duration)
+				self.networkStreamClient(self.hostSock, duration, self.job.ports[0])
 			else:
 				print("Not connected to network")
 
@@ -892,7 +2147,7 @@ class cameraModuleServer:
 		elif command == "O":
 			duration = float(self.inputParameter("Duration"))
 			self.confirmCompletion("Duration set")
-			self.networkSubtract(duration)
+			self.networkSubtract(duration, self.job.ports[0])
 
 		# Get camera settings
 		elif command == "P":
@@ -921,7 +2176,7 @@ class cameraModuleServer:
 		# Capture with trigger
 		elif command == "T":
 			if self.network == 1:
-				mode = self.recv_msg(self.hostSock)
+				mode = self.recvInput()
 			else:
 				while True:
 					mode = str(raw_input("Enter mode (1 or 2): "))
@@ -938,7 +2193,8 @@ class cameraModuleServer:
 				for name in self.fnames:
 					print("Sending")
 					self.sendFile(name, "Trigger")
-				self.send_msg(self.hostSock, "Q")
+				if not self.detached:
+					self.send_msg(self.hostSock, "Q")
 
 		# Set saturation
 		elif command == "U":
@@ -952,25 +2208,183 @@ class cameraModuleServer:
 			self.confirmCompletion("Duration set")
 			filename = self.inputStrParameter("Video filename")
 			self.confirmCompletion("Recording started...")
-			self.captureStream(duration, filename)
+			self.captureStream(duration, filename, self.job.ports[0])
 			self.confirmCompletion("Recording finished")
 			self.printStats()
 			if self.network == 1:
 				self.sendFile(filename, "Video")
 
+		# Time-lapse
+		elif command == "W":
+			interval = float(self.inputParameter("Interval"))
+			self.confirmCompletion("Interval set")
+			duration = float(self.inputParameter("Duration"))
+			self.confirmCompletion("Time-lapse started...")
+			summary = self.timeLapse(interval, duration, self.job.ports[0])
+			if self.network == 1 and not self.detached:
+				self.send_msg(self.hostSock, "Q")
+			self.confirmCompletion(summary)
+
 		# Change exposure time
 		elif command == "X":
 			xt = int(float(self.inputParameter("Exposure time")))
 			self.setExposureTime(xt)
 			self.confirmCompletion("Exposure time changed")
 
+		# Show the jobs, which a network client requests instead
+		elif command == "J":
+			if self.network == 0:
+				for job in self.scheduler.describe():
+					print(job)
+
+		# Show telemetry, which a network client requests instead
+		elif command == "Y":
+			if self.network == 0:
+				print("\n" + self.telemetry.format())
+
+		# Set region of interest
+		elif command == "Z":
+			x = int(float(self.inputParameter("ROI x")))
+			self.confirmCompletion("Region of interest x changed")
+			y = int(float(self.inputParameter("ROI y")))
+			self.confirmCompletion("Region of interest y changed")
+			width = int(float(self.inputParameter("ROI width")))
+			self.confirmCompletion("Region of interest width changed")
+			height = int(float(self.inputParameter("ROI height")))
+			self.confirmCompletion("Region of interest height changed")
+			self.setROI(x, y, width, height)
+
 		else:
 			print("Not a command")
 
+	def answerRequest(self, msg):
+		'''
+		Answer a request of the versioned protocol on its own thread, so that
+		further requests can be received while it is answered. Responses are
+		sent as requests finish, tagged with the ID of their request.
+		'''
+
+		thread = threading.Thread(target=self.performRequest, args=(msg,))
+		thread.daemon = True
+		thread.start()
+
+	def performRequest(self, msg):
+		'''
+		Perform a request of the versioned protocol, and send its result or
+		error.
+		'''
+
+		version, kind, rid, payload = unpackMessage(msg)
+		try:
+			if version != PROTOCOL_VERSION:
+				raise ValueError("Unsupported protocol version " + str(version))
+			method = payload.get("method")
+			if method not in self.methods:
+				raise ValueError("Unknown method " + str(method))
+			self.telemetry.count("requests_total", 1, method)
+			reply = packMessage(KIND_RESPONSE, rid, {"result": self.methods[method](payload.get("args", {}))})
+		except Exception as e:
+			self.telemetry.count("request_errors_total")
+			reply = packMessage(KIND_ERROR, rid, {"error": str(e)})
+
+		# Wait until the command being performed isn't prompting the client
+		try:
+			with self.answerLock:
+				self.send_msg(self.hostSock, reply)
+		except socket.error:
+			print("Connection closed before request " + str(rid) + " was answered")
+
+	def requestHello(self, args):
+		'''
+		Returns the protocol version and methods of the server.
+		'''
+
+		return {"version": PROTOCOL_VERSION, "methods": sorted(self.methods)}
+
+	def requestSettings(self, args):
+		'''
+		Returns the current, minimum and maximum value of every parameter that
+		can be set with setParameters.
+		'''
+
+		return dict((parameter, self.parameterLimits(parameter)) for parameter in PARAMETERS)
+
+	def requestStats(self, args):
+		'''
+		Returns the image/video properties sent by printStats.
+		'''
+
+		return {"width": self.camera.resolution[0], "height": self.camera.resolution[1],
+			"framerate": self.camera.framerate, "brightness": self.camera.brightness,
+			"contrast": self.camera.contrast, "analog gain": self.camera.analog_gain,
+			"digital gain": self.camera.digital_gain, "sharpness": self.camera.sharpness,
+			"saturation": self.camera.saturation, "exposure time": self.camera.exposure_speed}
+
+	def requestResume(self, args):
+		'''
+		Returns the state of the session for a reconnecting client: the command
+		being performed, whether it runs until it is stopped, and the number of
+		files which couldn't be sent.
+		'''
+
+		return {"running": self.running, "open": self.running is not None and self.openEnded, "pending": len(self.pending)}
+
+	def requestTelemetry(self, args):
+		'''
+		Returns the counters and gauges of the server telemetry.
+		'''
+
+		return self.telemetry.values()
+
+	def requestSubmit(self, args):
+		'''
+		Submit a background job, which runs alongside the commands of the
+		client: "record" records a video, and "timelapse" captures a
+		time-lapse. Its files are sent by the E command once it has finished.
+		'''
+
+		name = args.get("job")
+		duration = float(args.get("duration", DURATION_MAX))
+		if duration <= 0:
+			raise ValueError("Duration must be positive")
+
+		if name == "record":
+			fname = os.path.basename(str(args.get("filename", "VID_" + datetime.utcnow().strftime('%y%m%d-%H%M%S') + ".mp4")))
+			job = self.scheduler.submit(name, JOB_NEEDS["V"], self.recordJob, (duration, fname))
+		elif name == "timelapse":
+			interval = float(args.get("interval", INTERVAL_DEFAULT))
+			if interval < INTERVAL_MIN or interval > INTERVAL_MAX:
+				raise ValueError("Interval must be between " + str(INTERVAL_MIN) + " and " + str(INTERVAL_MAX))
+			job = self.scheduler.submit(name, JOB_NEEDS["W"], self.timeLapseJob, (interval, duration))
+		else:
+			raise ValueError("Unknown job " + str(name))
+
+		return job.describe()
+
+	def requestJobs(self, args):
+		'''
+		Returns the queued, running and recently finished jobs.
+		'''
+
+		return self.scheduler.describe()
+
+	def requestCancel(self, args):
+		'''
+		Cancel a queued job, or stop a running background job.
+		'''
+
+		if not self.scheduler.cancel(int(args.get("id", 0))):
+			raise ValueError("No queued or running job " + str(args.get("id")))
+		return {"cancelled": int(args["id"])}
+
 	def closeCamera(self):
 		'''
 		Release the camera resources.
 		'''
 
+		self.scheduler.stopAll()
+		self.telemetry.close()
+		dumpTimings("session")
+
 		# Turn off the camera
 		self.camera.close()
@@ -0,0 +1,180 @@
+'''
+Library for stacking frames of the camera into a low-noise image.
+
+Low-light images are noisy, and raising the gain amplifies the noise as much as
+the signal. Averaging N frames instead reduces the noise by a factor of
+sqrt(N). Unencoded frames are taken from a splitter port of the video port, so
+frames arrive at the frame rate of the sensor (32 frames take about one second
+at 30 fps), and each frame is added to a preallocated uint32 sum as it
+arrives, so no frame is kept.
+
+Outliers, such as hot pixels and cosmic ray hits, are optionally rejected by
+keeping the darkest and brightest value of every pixel, which are left out of
+the mean. This costs two more array operations per frame, rather than keeping
+every frame to sort.
+
+Stacking requires numpy on the Raspberry Pi:
+
+	sudo apt-get install python-numpy
+'''
+
+import threading
+import numpy as np
+from cameraLibTiming import timed
+
+STACK_FORMATS = ["yuv", "rgb"] # yuv stacks the luminance only, rgb the colour at three times the cost
+
+
+def rawResolution(resolution):
+	'''
+	Returns the resolution of the unencoded frames of the camera, which are
+	padded to a width divisible by 32 and a height divisible by 16.
+	'''
+
+	width, height = resolution
+	return (width + 31) // 32 * 32, (height + 15) // 16 * 16
+
+
+class rawFrames(object):
+
+	def __init__(self, resolution, fmt="yuv"):
+		'''
+		Create an output for camera.start_recording, in the unencoded format
+		fmt, which passes each frame of a resolution to frame().
+		'''
+
+		if fmt not in STACK_FORMATS:
+			raise ValueError("Cannot read " + str(fmt) + " frames")
+
+		self.resolution = resolution
+		self.format = fmt
+		self.setSize(rawResolution(resolution))
+		self.closed = False		# Set to ignore further frames
+
+	def setSize(self, size):
+		'''
+		Set the shape and size of the frames, for frames padded to size.
+		'''
+
+		width, height = size
+		if self.format == "yuv":
+			# Only the Y plane is used, which comes before the U and V planes
+			self.shape = (height, width)
+			self.planeSize = width * height
+			self.frameSize = self.planeSize + 2 * ((width // 2) * (height // 2))
+		else:
+			self.shape = (height, width, 3)
+			self.planeSize = width * height * 3
+			self.frameSize = self.planeSize
+		self.buffer = bytearray(self.frameSize)
+		self.filled = 0
+
+	def write(self, buf):
+		'''
+		Pass each complete frame to frame(). A frame may arrive in several
+		buffers, which are gathered first.
+		'''
+
+		size = len(buf)
+		if self.closed:
+			return size
+
+		if self.filled == 0 and size != self.frameSize and self.format == "rgb" and size == self.resolution[0] * self.resolution[1] * 3:
+			# Some firmware doesn't pad RGB frames
+			self.setSize(self.resolution)
+
+		if self.filled == 0 and size == self.frameSize:
+			# The usual case of a whole frame per buffer, which isn't copied
+			self.frame(buf)
+			return size
+
+		view = memoryview(buf)
+		offset = 0
+		while offset < size and not self.closed:
+			count = min(size - offset, self.frameSize - self.filled)
+			self.buffer[self.filled:self.filled + count] = view[offset:offset + count]
+			self.filled += count
+			offset += count
+			if self.filled == self.frameSize:
+				self.frame(self.buffer)
+				self.filled = 0
+		return size
+
+	def array(self, data):
+		'''
+		Returns the Y plane (yuv) or the pixels (rgb) of a frame as a uint8
+		array, without copying it.
+		'''
+
+		return np.frombuffer(data, dtype=np.uint8, count=self.planeSize).reshape(self.shape)
+
+	def frame(self, data):
+		'''
+		Handle a complete frame, which is only valid until the next frame
+		arrives. Outputs override this, and frames are ignored otherwise.
+		'''
+
+		pass
+
+	def flush(self):
+		pass
+
+
+class frameStack(rawFrames):
+
+	def __init__(self, resolution, frames, fmt="yuv", reject=False):
+		'''
+		Create an output for camera.start_recording, in the format fmt, which
+		stacks the given number of frames of a resolution.
+		'''
+
+		rawFrames.__init__(self, resolution, fmt)
+		self.frames = frames
+		self.reject = reject and frames > 2
+		self.sum = None			# Allocated for the size of the first frame
+		self.count = 0
+		self.done = threading.Event()	# Set once every frame has been added
+
+	@timed("stack frame")
+	def frame(self, data):
+		'''
+		Add a frame to the sum, and to the darkest and brightest values.
+		'''
+
+		if self.sum is None:
+			self.sum = np.zeros(self.shape, dtype=np.uint32)
+			if self.reject:
+				self.low = np.full(self.shape, 255, dtype=np.uint8)
+				self.high = np.zeros(self.shape, dtype=np.uint8)
+
+		frame = self.array(data)
+		np.add(self.sum, frame, out=self.sum)
+		if self.reject:
+			np.minimum(self.low, frame, out=self.low)
+			np.maximum(self.high, frame, out=self.high)
+
+		self.count += 1
+		if self.count >= self.frames:
+			self.closed = True
+			self.done.set()
+
+	def mean(self):
+		'''
+		Returns the mean of the stacked frames as a uint8 array, cropped to the
+		resolution of the camera, leaving out the darkest and brightest value
+		of each pixel if outliers are rejected.
+		'''
+
+		count = self.count
+		if count == 0:
+			raise ValueError("No frames were stacked")
+
+		total = self.sum
+		if self.reject and count > 2:
+			total = total - self.low - self.high
+			count -= 2
+
+		# Round to the nearest value
+		mean = (total + count // 2) // count
+		width, height = self.resolution
+		return mean[:height, :width].astype(np.uint8)
@@ -0,0 +1,1037 @@
+'''
+Library for image subtraction of the microscope stream on the host computer,
+using numpy and openCV. It provides the per-pixel detector used by
+BackGroundSubbThread.cpp, as well as a block statistics detector, which
+compares the mean and variance of tiles of each frame with the background
+using integral images.
+
+Frames are decoded into a bounded ring of preallocated buffers in shared
+memory, with a selectable policy for when detection falls behind the stream.
+Detection can be sharded across a pool of worker processes, which split each
+buffer into horizontal stripes, and every worker applies its own detector to
+its stripe, so no pixel data is pickled.
+
+Each detected event is saved as it happens, with a number of frames before
+(pre-roll) and after (post-roll) the change. Frames are encoded by a pool of
+background threads, so no extraction pass is needed at the end. The
+foreground masks of each event are bit-packed, compressed and appended to a
+single mask container per event, which can be loaded back with loadMasks.
+
+Every processed frame is catalogued in an SQLite database in the session
+folder, with its timestamp, percentage of change, whether it was saved and
+where, so sessions can be searched with queryFrames without reading the
+images. The timing and queue state of every frame is logged to a binary
+metrics file in the same folder, which can be loaded with cameraLibMetrics.
+
+The library can be run from the command-line with the same arguments as
+BackGroundSubbThread, and optional detector and number of workers:
+
+	python cameraLibSubtract.py -vid <Video filename> thresh_p thresh_m [-back <Background image>] [-detector Block] [-workers N] [-policy keep-latest] [-preroll N] [-postroll N]
+'''
+
+import cv2
+import numpy as np
+import multiprocessing
+import threading
+import time
+import os
+import sys
+import Queue
+import struct
+import zlib
+import sqlite3
+from collections import deque
+from datetime import datetime
+from cameraLibMetrics import metricsLog
+from multiprocessing import Process, Pipe
+from multiprocessing.sharedctypes import RawArray
+
+INIT_DISCARD = 100 # Don't record the first x frames
+HISTORY = 100 # How many previous frames are used to make the model to detect change
+BLOCK_SIZE = 16 # Width and height in pixels of the tiles used by the block detector
+DETECTORS = ['Pixel', 'Block']
+WORKERS = multiprocessing.cpu_count() # Number of processes used for detection
+RING_SIZE = 16 # Number of preallocated frame buffers between the stream and detection
+POLICIES = ['block', 'drop-oldest', 'keep-latest'] # What to do with frames when detection falls behind
+PRE_ROLL = 15 # Number of frames saved before the start of an event
+POST_ROLL = 15 # Number of frames saved after the end of an event
+ENCODERS = 2 # Number of threads encoding saved frames
+ENCODE_QUEUE = 64 # Maximum number of frames waiting to be encoded
+SUBTRACT_FOLDER = "Subtract/"
+MASK_MAGIC = b"MSK1" # Identifies a mask container file
+MASK_HEADER = struct.Struct(">4sII") # Magic, mask height and mask width
+MASK_RECORD = struct.Struct(">IdI") # Frame number, timestamp and length of the packed mask
+INDEX_FILE = "session.db" # SQLite catalogue of every processed frame of a session
+INDEX_BATCH = 100 # Number of frames written to the catalogue in each transaction
+METRICS_FILE = "metrics.met" # Binary log of the timing of every processed frame
+METRICS_FIELDS = [("frame", "I"), ("time", "d"), ("percent", "f"), ("save", "?"), ("saved", "I"), ("total", "I"), ("process", "f"), ("queue", "H"), ("drops", "I"), ("lag", "f")]
+STATUS_INTERVAL = 1.0 # Seconds between status lines printed to the console
+STREAM_FAILED = 3 # Exit status when the stream couldn't be opened
+STREAM_ENDED = 4 # Exit status when the stream ended before ESC or 'q' was pressed
+
+
+def tileStatistics(gray, block):
+	'''
+	Compute the mean and variance of every block x block tile of a grayscale
+	frame from its integral images. Partial tiles at the right and bottom
+	edges of the frame are ignored.
+	'''
+
+	total, squared = cv2.integral2(gray, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+
+	# Sample the integral images at the corners of the tiles
+	rows = np.arange(gray.shape[0] // block + 1) * block
+	cols = np.arange(gray.shape[1] // block + 1) * block
+	total = total[rows[:, None], cols[None, :]]
+	squared = squared[rows[:, None], cols[None, :]]
+
+	# Sum of each tile from the four corners of the integral image
+	area = float(block * block)
+	mean = (total[1:, 1:] - total[:-1, 1:] - total[1:, :-1] + total[:-1, :-1]) / area
+	meansq = (squared[1:, 1:] - squared[:-1, 1:] - squared[1:, :-1] + squared[:-1, :-1]) / area
+
+	return mean, np.maximum(meansq - mean * mean, 0)
+
+def activityMask(activity, shape, block):
+	'''
+	Expand a tile activity map into a mask with the same size as the frame.
+	'''
+
+	mask = np.zeros(shape[:2], dtype=np.uint8)
+	tiles = np.repeat(np.repeat(activity, block, axis=0), block, axis=1)
+	mask[:tiles.shape[0], :tiles.shape[1]] = np.where(tiles, 255, 0)
+
+	return mask
+
+def activityOverlay(frame, mask):
+	'''
+	Tint the changed areas of a frame red, so the activity can be seen on top
+	of the video.
+	'''
+
+	overlay = frame.copy()
+	changed = mask > 0
+	overlay[changed] = overlay[changed] // 2 + np.array([0, 0, 127], dtype=np.uint8)
+
+	return overlay
+
+def createDetector(detectorType, thresh_m, background=None):
+	'''
+	Create a detector of the given type for frames of the same size as the
+	background, or for any frame size if no background is given.
+	'''
+
+	if detectorType == "Block":
+		return blockDetector(thresh_m, background)
+	else:
+		return pixelDetector(thresh_m, background)
+
+def stripeWorker(conn, frameBufs, maskBuf, shape, top, bottom, detectorType, thresh_m, background):
+	'''
+	Worker process which applies a detector to one horizontal stripe of a
+	shared frame buffer, and writes the stripe of the foreground mask. The
+	pipe only carries the index of the buffer, and the number of changed and
+	total pixels (or tiles) of the stripe.
+	'''
+
+	# Parallelism comes from the pool, not from openCV threads
+	cv2.setNumThreads(1)
+
+	frames = [np.frombuffer(buf, dtype=np.uint8).reshape(shape)[top:bottom] for buf in frameBufs]
+	mask = np.frombuffer(maskBuf, dtype=np.uint8).reshape(shape[:2])[top:bottom]
+
+	if background is not None:
+		background = background[top:bottom]
+	detector = createDetector(detectorType, thresh_m, background)
+
+	while True:
+		# A None request closes the worker
+		slot = conn.recv()
+		if slot is None:
+			break
+
+		percent, result = detector.apply(frames[slot])
+		if detectorType == "Block":
+			mask[:] = activityMask(result, frames[slot].shape, detector.block)
+		else:
+			mask[:] = result
+
+		conn.send((detector.count, detector.total))
+
+	conn.close()
+
+
+class pixelDetector:
+
+	def __init__(self, thresh_m, background=None):
+		'''
+		Detect changed pixels against a static background image, or against a
+		MOG2 model of the previous frames if no background is given.
+		'''
+
+		self.threshold = float(thresh_m) ** 2
+		self.background = None
+		self.model = None
+		self.count = 0
+		self.total = 0
+
+		if background is not None:
+			self.background = background.astype(np.int32)
+		else:
+			self.model = cv2.createBackgroundSubtractorMOG2(HISTORY, float(thresh_m))
+
+	def apply(self, frame):
+		'''
+		Returns the percentage of changed pixels, and the foreground mask.
+		'''
+
+		if self.model is None:
+			# A pixel has changed if its colour distance to the background exceeds the threshold
+			diff = frame.astype(np.int32) - self.background
+			dist = (diff * diff).sum(axis=2)
+			mask = np.where(dist > self.threshold, 255, 0).astype(np.uint8)
+		else:
+			mask = self.model.apply(frame)
+
+		self.count = cv2.countNonZero(mask)
+		self.total = mask.size
+		percent = 100.0 * self.count / self.total
+
+		return percent, mask
+
+
+class blockDetector:
+
+	def __init__(self, thresh_m, background=None, block=BLOCK_SIZE):
+		'''
+		Detect changed tiles by comparing the mean and standard deviation of
+		each tile with the background. Without a static background, the
+		background statistics are a running average of the previous frames.
+		'''
+
+		self.threshold = float(thresh_m)
+		self.block = block
+		self.static = background is not None
+		self.mean = None
+		self.std = None
+		self.count = 0
+		self.total = 0
+
+		if self.static:
+			self.mean, self.std = self.statistics(background)
+
+	def statistics(self, frame):
+		'''
+		Returns the mean and standard deviation of every tile of the frame.
+		'''
+
+		gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+		mean, var = tileStatistics(gray, self.block)
+
+		return mean, np.sqrt(var)
+
+	def apply(self, frame):
+		'''
+		Returns the percentage of changed tiles, and the tile activity map.
+		'''
+
+		mean, std = self.statistics(frame)
+		if self.mean is None:
+			self.mean = mean
+			self.std = std
+
+		# A tile has changed if its mean or spread has moved away from the background
+		activity = (np.abs(mean - self.mean) > self.threshold) | (np.abs(std - self.std) > self.threshold)
+
+		# Update the running background over the last HISTORY frames
+		if not self.static:
+			self.mean += (mean - self.mean) / HISTORY
+			self.std += (std - self.std) / HISTORY
+
+		self.count = int(np.count_nonzero(activity))
+		self.total = activity.size
+		percent = 100.0 * self.count / max(self.total, 1)
+
+		return percent, activity
+
+
+class frameRing:
+
+	def __init__(self, shape, size=RING_SIZE, policy="block"):
+		'''
+		A bounded ring of preallocated frame buffers in shared memory, between
+		the thread reading the stream and the detection loop. When every buffer
+		is full, the policy decides whether the reader waits (block), the oldest
+		waiting frame is dropped (drop-oldest), or whether detection only ever
+		takes the newest frame (keep-latest).
+		'''
+
+		self.shape = shape
+		self.policy = policy
+		self.buffers = [RawArray('B', int(np.prod(shape))) for i in range(size)]
+		self.frames = [np.frombuffer(buf, dtype=np.uint8).reshape(shape) for buf in self.buffers]
+
+		# Buffers that are free to be written, and frames waiting for detection
+		self.free = deque(range(size))
+		self.ready = deque()
+		self.times = [0.0] * size
+		self.numbers = [0] * size
+		self.count = 0
+		self.cond = threading.Condition()
+		self.closed = False
+
+		# Statistics
+		self.drops = 0
+		self.lag = 0.0
+
+	def acquire(self):
+		'''
+		Returns the index of a buffer for the reader to write the next frame into,
+		or None if the ring has been closed.
+		'''
+
+		with self.cond:
+			while len(self.free) == 0 and not self.closed:
+				if self.policy == "block":
+					self.cond.wait()
+				else:
+					# Overwrite the oldest waiting frame
+					self.free.append(self.ready.popleft())
+					self.drops += 1
+
+			if self.closed:
+				return None
+			return self.free.popleft()
+
+	def commit(self, slot, timestamp):
+		'''
+		Queue a buffer written by the reader for detection. Frames are numbered
+		in the order they are read, including frames that are later dropped.
+		'''
+
+		with self.cond:
+			self.times[slot] = timestamp
+			self.numbers[slot] = self.count
+			self.count += 1
+			self.ready.append(slot)
+			self.cond.notify_all()
+
+	def get(self):
+		'''
+		Returns the index of the next frame for detection, waiting for one if
+		necessary, or None if the ring is closed and empty.
+		'''
+
+		with self.cond:
+			while len(self.ready) == 0 and not self.closed:
+				self.cond.wait(0.1)
+
+			if len(self.ready) == 0:
+				return None
+
+			# Skip straight to the newest frame
+			if self.policy == "keep-latest":
+				while len(self.ready) > 1:
+					self.free.append(self.ready.popleft())
+					self.drops += 1
+
+			slot = self.ready.popleft()
+			self.lag = time.time() - self.times[slot]
+			return slot
+
+	def release(self, slot):
+		'''
+		Return a buffer to the ring once detection has finished with it.
+		'''
+
+		with self.cond:
+			self.free.append(slot)
+			self.cond.notify_all()
+
+	def close(self, discard=False):
+		'''
+		Close the ring once no more frames are coming. Frames already waiting
+		are still given to detection, unless they are discarded.
+		'''
+
+		with self.cond:
+			if discard:
+				self.ready.clear()
+			self.closed = True
+			self.cond.notify_all()
+
+	def depth(self):
+		'''
+		Returns the number of frames waiting for detection.
+		'''
+
+		return len(self.ready)
+
+
+class stripePool:
+
+	def __init__(self, ring, workers, detectorType, thresh_m, background=None):
+		'''
+		Start a pool of worker processes which each detect changes in one
+		horizontal stripe of the buffers of a frame ring. Stripes are of
+		nearly equal height, aligned to the tiles of the block detector.
+		'''
+
+		shape = ring.shape
+		height = shape[0]
+
+		# Shared memory for the foreground mask
+		self.maskBuf = RawArray('B', shape[0] * shape[1])
+		self.mask = np.frombuffer(self.maskBuf, dtype=np.uint8).reshape(shape[:2])
+
+		# Spread the rows evenly between the stripes, as the slowest stripe
+		# sets the frame rate. The block detector needs whole tile rows.
+		align = BLOCK_SIZE if detectorType == "Block" else 1
+		bounds = [align * int(round(i * height / float(workers * align))) for i in range(workers)] + [height]
+		bounds = sorted(set(bounds))
+
+		self.conns = []
+		self.procs = []
+		for i in range(len(bounds) - 1):
+			parent, child = Pipe()
+			proc = Process(target=stripeWorker, args=(child, ring.buffers, self.maskBuf, shape, bounds[i], bounds[i+1], detectorType, thresh_m, background))
+			proc.daemon = True
+			proc.start()
+			self.conns.append(parent)
+			self.procs.append(proc)
+
+	def apply(self, slot):
+		'''
+		Returns the percentage of changed pixels (or tiles) of the frame in the
+		given ring buffer, and the full size foreground mask. The mask is
+		overwritten by the next call.
+		'''
+
+		# Start every worker on its stripe of the buffer
+		for conn in self.conns:
+			conn.send(slot)
+
+		# Merge the counts of every stripe
+		changed = 0
+		total = 0
+		for conn in self.conns:
+			count, size = conn.recv()
+			changed += count
+			total += size
+
+		return 100.0 * changed / max(total, 1), self.mask
+
+	def close(self):
+		'''
+		Stop the worker processes.
+		'''
+
+		for conn in self.conns:
+			conn.send(None)
+		for proc in self.procs:
+			proc.join()
+
+
+def packMask(mask):
+	'''
+	Bit-pack a foreground mask (any non-zero pixel is foreground) and compress
+	it. A binary mask takes 1 bit per pixel before compression.
+	'''
+
+	return zlib.compress(np.packbits(mask > 0).tobytes(), 1)
+
+
+def unpackMask(data, shape):
+	'''
+	Unpack a mask packed by packMask into a boolean array of the given shape.
+	'''
+
+	bits = np.unpackbits(np.frombuffer(zlib.decompress(data), dtype=np.uint8))
+	return bits[:shape[0] * shape[1]].reshape(shape).astype(bool)
+
+
+def maskIndex(fname):
+	'''
+	Read the header and frame index of a mask container, without reading the
+	masks. Returns the mask shape and a dictionary mapping each frame number
+	to its timestamp, and the offset and length of its packed mask.
+	'''
+
+	index = {}
+	with open(fname, "rb") as f:
+		magic, height, width = MASK_HEADER.unpack(f.read(MASK_HEADER.size))
+		if magic != MASK_MAGIC:
+			raise ValueError(fname + " is not a mask container")
+
+		while True:
+			record = f.read(MASK_RECORD.size)
+			if len(record) < MASK_RECORD.size:
+				break
+			frame, timestamp, length = MASK_RECORD.unpack(record)
+			index[frame] = (timestamp, f.tell(), length)
+			f.seek(length, 1)
+
+	return (height, width), index
+
+
+def readMask(fname, frame):
+	'''
+	Read the mask of a single frame from a mask container.
+	'''
+
+	shape, index = maskIndex(fname)
+	timestamp, offset, length = index[frame]
+	with open(fname, "rb") as f:
+		f.seek(offset)
+		return unpackMask(f.read(length), shape)
+
+
+def loadMasks(fname):
+	'''
+	Load every mask of a mask container into numpy arrays. Returns the frame
+	numbers, the timestamps, and a boolean array of masks with shape
+	(frames, height, width), sorted by frame number.
+	'''
+
+	shape, index = maskIndex(fname)
+	frames = np.array(sorted(index), dtype=np.uint32)
+	times = np.array([index[frame][0] for frame in frames], dtype=np.float64)
+	masks = np.zeros((len(frames),) + shape, dtype=bool)
+	with open(fname, "rb") as f:
+		for i, frame in enumerate(frames):
+			timestamp, offset, length = index[frame]
+			f.seek(offset)
+			masks[i] = unpackMask(f.read(length), shape)
+
+	return frames, times, masks
+
+
+class maskContainer:
+
+	def __init__(self, fname, shape):
+		'''
+		Create a container file holding the packed foreground masks of one
+		event. Each mask is stored as a record with its frame number and
+		timestamp, so records may be appended in any order.
+		'''
+
+		self.fname = fname
+		self.lock = threading.Lock()
+		with open(fname, "wb") as f:
+			f.write(MASK_HEADER.pack(MASK_MAGIC, shape[0], shape[1]))
+
+	def add(self, frame, timestamp, mask):
+		'''
+		Pack a mask and append it to the container. May be called from several
+		encoder threads at once.
+		'''
+
+		data = packMask(mask)
+		with self.lock:
+			with open(self.fname, "ab") as f:
+				f.write(MASK_RECORD.pack(frame, timestamp, len(data)))
+				f.write(data)
+
+
+def queryFrames(fname, minPercent=0.0, start=None, end=None, saved=None):
+	'''
+	Search the catalogue of a session for frames with at least minPercent
+	change, between the start and end timestamps (seconds since the epoch, or
+	datetimes), and optionally only saved or unsaved frames. Returns a list of
+	(frame, time, percent, saved, event, image, masks, maskFrame) rows in
+	time order.
+	'''
+
+	query = "SELECT frame, time, percent, saved, event, image, masks, maskFrame FROM frames WHERE percent >= ?"
+	params = [minPercent]
+	for value, condition in ((start, " AND time >= ?"), (end, " AND time < ?")):
+		if value is not None:
+			if isinstance(value, datetime):
+				value = time.mktime(value.timetuple()) + value.microsecond / 1e6
+			query += condition
+			params.append(value)
+	if saved is not None:
+		query += " AND saved = ?"
+		params.append(int(saved))
+
+	db = sqlite3.connect(fname)
+	try:
+		return db.execute(query + " ORDER BY time", params).fetchall()
+	finally:
+		db.close()
+
+
+class sessionIndex:
+
+	def __init__(self, fname):
+		'''
+		Create the SQLite catalogue of a subtraction session. Frames are written
+		in batches of INDEX_BATCH per transaction, and indexed by time, change
+		and event. Must only be used from the thread which created it.
+		'''
+
+		self.db = sqlite3.connect(fname)
+		self.db.executescript('''
+			CREATE TABLE IF NOT EXISTS frames (
+				frame INTEGER PRIMARY KEY,
+				time REAL NOT NULL,
+				percent REAL NOT NULL,
+				saved INTEGER NOT NULL DEFAULT 0,
+				event INTEGER,
+				image TEXT,
+				masks TEXT,
+				maskFrame INTEGER);
+			CREATE INDEX IF NOT EXISTS framesTime ON frames (time, percent);
+			CREATE INDEX IF NOT EXISTS framesPercent ON frames (percent);
+			CREATE INDEX IF NOT EXISTS framesEvent ON frames (event);
+			CREATE VIEW IF NOT EXISTS events AS
+				SELECT event, MIN(time) AS start, MAX(time) AS end, COUNT(*) AS frames, MAX(percent) AS peak, masks
+				FROM frames WHERE event IS NOT NULL GROUP BY event;
+		''')
+
+		# Rows waiting to be written
+		self.frames = []
+		self.saves = []
+
+	def addFrame(self, frame, timestamp, percent):
+		'''
+		Add a processed frame to the catalogue.
+		'''
+
+		self.frames.append((frame, timestamp, percent))
+		if len(self.frames) >= INDEX_BATCH:
+			self.flush()
+
+	def saveFrame(self, frame, event, image, masks, maskFrame):
+		'''
+		Record that a frame was saved as part of an event, with its image file,
+		and the mask container and frame number of its mask. The frame may be
+		added before or after this is called, until the next flush.
+		'''
+
+		self.saves.append((event, image, masks, maskFrame, frame))
+
+	def flush(self):
+		'''
+		Write the waiting rows in a single transaction.
+		'''
+
+		with self.db:
+			self.db.executemany("INSERT OR REPLACE INTO frames (frame, time, percent) VALUES (?, ?, ?)", self.frames)
+			self.db.executemany("UPDATE frames SET saved = 1, event = ?, image = ?, masks = ?, maskFrame = ? WHERE frame = ?", self.saves)
+		self.frames = []
+		self.saves = []
+
+	def close(self):
+		'''
+		Write the remaining rows and close the catalogue.
+		'''
+
+		self.flush()
+		self.db.close()
+
+
+class encoderPool:
+
+	def __init__(self, workers=ENCODERS, size=ENCODE_QUEUE):
+		'''
+		Start a pool of threads which encode and write images in the background.
+		openCV releases the GIL while encoding, so the threads run in parallel
+		with detection. The queue is bounded, so detection slows down rather
+		than running out of memory if the disk can't keep up.
+		'''
+
+		self.jobs = Queue.Queue(size)
+		self.threads = []
+		for i in range(workers):
+			thread = threading.Thread(target=self.encode)
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+
+	def write(self, fname, image):
+		'''
+		Queue an image to be written. The image must not be modified afterwards.
+		'''
+
+		self.call(cv2.imwrite, fname, image)
+
+	def call(self, function, *args):
+		'''
+		Queue a function to be called by one of the threads.
+		'''
+
+		self.jobs.put((function, args))
+
+	def encode(self):
+		'''
+		Thread which runs queued jobs until a None job is received.
+		'''
+
+		while True:
+			job = self.jobs.get()
+			if job is None:
+				break
+			job[0](*job[1])
+
+	def close(self):
+		'''
+		Wait for the queued images to be written, and stop the threads.
+		'''
+
+		for thread in self.threads:
+			self.jobs.put(None)
+		for thread in self.threads:
+			thread.join()
+
+
+class eventWriter:
+
+	def __init__(self, preRoll=PRE_ROLL, postRoll=POST_ROLL, encoders=ENCODERS):
+		'''
+		Save the frames and foreground masks of each event as it happens. An
+		event starts at the first frame which exceeds the threshold, includes
+		the preRoll frames before it, and ends postRoll frames after the last
+		frame which exceeded the threshold.
+		'''
+
+		self.preRoll = preRoll
+		self.postRoll = postRoll
+		self.pool = encoderPool(encoders)
+
+		# Copies of the most recent frames, for the pre-roll of the next event
+		self.history = deque(maxlen=max(preRoll, 1))
+
+		# Session folder and catalogue, set by open
+		self.path = None
+		self.index = None
+
+		# Event info
+		self.masks = None
+		self.events = 0
+		self.active = False
+		self.remaining = 0
+		self.savedFrames = 0
+
+	def open(self, path, index=None):
+		'''
+		Set the session folder that events are saved in, and the session
+		catalogue which records the saved frames.
+		'''
+
+		self.path = path
+		self.index = index
+
+	def add(self, number, frame, mask, trigger, timestamp):
+		'''
+		Add a processed frame with its frame number. trigger is true if the
+		frame exceeded the threshold. Returns true if the frame is saved as part
+		of an event. The frame and mask are copied, so their buffers can be
+		reused immediately.
+		'''
+
+		if trigger:
+			if not self.active:
+				# Start a new event with the pre-roll frames
+				self.startEvent(timestamp, mask.shape)
+				for item in self.history:
+					self.write(*item)
+				self.history.clear()
+			self.active = True
+			self.remaining = self.postRoll
+		elif self.active:
+			if self.remaining > 0:
+				self.remaining -= 1
+			else:
+				self.active = False
+
+		if self.active:
+			self.write(number, frame.copy(), mask.copy(), timestamp)
+		elif self.preRoll > 0:
+			self.history.append((number, frame.copy(), mask.copy(), timestamp))
+
+		return self.active
+
+	def startEvent(self, timestamp, shape):
+		'''
+		Start a new event, and create the mask container of the event.
+		'''
+
+		self.events += 1
+		self.masks = maskContainer(self.path + "/MASK-E" + str(self.events) + ".msk", shape)
+
+	def write(self, number, frame, mask, timestamp):
+		'''
+		Queue a frame to be written as an image, and its foreground mask to be
+		added to the mask container of the event. The mask is stored under the
+		same frame number as the image name.
+		'''
+
+		name = "IMG_" + datetime.fromtimestamp(timestamp).strftime('%y%m%d-%H%M%S') + "-E" + str(self.events) + "-N" + str(self.savedFrames)
+		self.pool.write(self.path + "/" + name + ".jpg", frame)
+		self.pool.call(self.masks.add, self.savedFrames, timestamp, mask)
+		if self.index is not None:
+			self.index.saveFrame(number, self.events, name + ".jpg", os.path.basename(self.masks.fname), self.savedFrames)
+		self.savedFrames += 1
+
+	def close(self):
+		'''
+		Wait for the saved frames to be written.
+		'''
+
+		self.pool.close()
+
+
+class backgroundSubtractor:
+
+	def __init__(self, source, thresh_p, thresh_m, background="", detector="Pixel", workers=WORKERS, policy="block", preRoll=PRE_ROLL, postRoll=POST_ROLL):
+		'''
+		Initialise image subtraction of a video file or gstreamer pipeline.
+		'''
+
+		self.source = source
+		self.thresh_p = float(thresh_p)
+		self.thresh_m = float(thresh_m)
+		self.backgroundFile = background
+		self.detectorType = detector
+		self.detector = None
+		self.workers = workers
+		self.policy = policy
+
+		# Ring of frames read from the stream that are waiting to be processed
+		self.ring = None
+		self.opened = threading.Event()
+
+		# Saved events, and the catalogue of every frame
+		self.events = eventWriter(preRoll, postRoll)
+		self.index = None
+		self.metrics = None
+		self.totalFrames = 0
+
+	def readFrames(self):
+		'''
+		Thread which reads the video file or stream, and decodes each frame into
+		a buffer of the frame ring. This is run concurrently to the image
+		subtraction.
+		'''
+
+		capture = cv2.VideoCapture(self.source)
+		ok, frame = capture.read() if capture.isOpened() else (False, None)
+		if not ok:
+			print("Unable to open video file: " + self.source)
+			self.opened.set()
+			return
+
+		# The ring is allocated once the size of the frames is known
+		self.ring = frameRing(frame.shape, RING_SIZE, self.policy)
+		self.opened.set()
+
+		while ok:
+			slot = self.ring.acquire()
+			if slot is None:
+				break
+
+			# Decode straight into the preallocated buffer where possible
+			buf = self.ring.frames[slot]
+			if frame is not None:
+				buf[:] = frame
+				frame = None
+			else:
+				ok, image = capture.read(buf)
+				if not ok:
+					# End the thread when the video stops
+					print("Unable to read next frame.")
+					self.ring.release(slot)
+					break
+				if image is not buf:
+					buf[:] = image
+
+			self.ring.commit(slot, time.time())
+
+		capture.release()
+
+		# Let the processing loop know that no more video is coming
+		self.ring.close()
+
+	def createDetector(self, frame):
+		'''
+		Create the detector, or the pool of detectors, once the size of the
+		frames is known.
+		'''
+
+		background = None
+		if self.backgroundFile != "":
+			background = cv2.imread(self.backgroundFile, 1)
+			if background is None or background.shape != frame.shape:
+				raise ValueError("Background image is not of same resolution as current recording.")
+
+		if self.workers > 1:
+			self.detector = stripePool(self.ring, self.workers, self.detectorType, self.thresh_m, background)
+		else:
+			self.detector = createDetector(self.detectorType, self.thresh_m, background)
+
+	def openSession(self, timestamp):
+		'''
+		Create the timestamped folder of this session, which contains the saved
+		events and the catalogue of every frame.
+		'''
+
+		path = SUBTRACT_FOLDER + datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d_%H-%M-%S')
+		if not os.path.isdir(path):
+			os.makedirs(path)
+
+		self.index = sessionIndex(path + "/" + INDEX_FILE)
+		self.metrics = metricsLog(path + "/" + METRICS_FILE, METRICS_FIELDS)
+		self.events.open(path, self.index)
+
+	def detect(self, slot):
+		'''
+		Returns the percentage of changed pixels (or tiles) of the frame in a
+		ring buffer, and the foreground mask with the same size as the frame.
+		'''
+
+		frame = self.ring.frames[slot]
+		if self.detector is None:
+			self.createDetector(frame)
+
+		if self.workers > 1:
+			percent, mask = self.detector.apply(slot)
+		else:
+			percent, mask = self.detector.apply(frame)
+			if self.detectorType == "Block":
+				mask = activityMask(mask, frame.shape, self.detector.block)
+
+		return percent, mask
+
+	def run(self):
+		'''
+		Read frames from the ring and perform image subtraction on each frame.
+		If the percentage of changed pixels (or tiles) is greater than thresh_p,
+		then the frame, its foreground mask, and the pre-roll and post-roll
+		frames of the event are saved. Returns 0 if ESC or 'q' was pressed, or
+		STREAM_FAILED or STREAM_ENDED.
+		'''
+
+		reader = threading.Thread(target=self.readFrames)
+		reader.daemon = True
+		reader.start()
+
+		# Wait for the stream to open
+		self.opened.wait()
+		if self.ring is None:
+			return STREAM_FAILED
+
+		cv2.namedWindow("Frame")
+		cv2.namedWindow("FG Mask")
+
+		keyboard = -1
+		t1 = time.time()
+		status = t1
+		statusFrames = 0
+
+		# ESC or 'q' for quitting
+		while chr(keyboard & 0xFF) not in ('q', '\x1b'):
+			# Close when no frames are left to process
+			slot = self.ring.get()
+			if slot is None:
+				break
+
+			frame = self.ring.frames[slot]
+			number = self.ring.numbers[slot]
+			timestamp = self.ring.times[slot]
+			if self.index is None:
+				self.openSession(timestamp)
+			percent, mask = self.detect(slot)
+
+			# Save the event if the change exceeds the threshold
+			# Also skip the first few frames as they often appear green
+			trigger = percent > self.thresh_p and self.totalFrames >= INIT_DISCARD
+			self.index.addFrame(number, timestamp, percent)
+			save = self.events.add(number, frame, mask, trigger, timestamp)
+
+			# Show the current frame with the activity, and the foreground mask
+			cv2.imshow("Frame", activityOverlay(frame, mask))
+			cv2.imshow("FG Mask", mask)
+
+			# Return the buffer to the ring
+			self.ring.release(slot)
+			self.totalFrames += 1
+
+			# Log the time to process each frame, and the state of the ring
+			t2 = t1
+			t1 = time.time()
+			self.metrics.write(number, timestamp, percent, save, self.events.savedFrames, self.totalFrames, t1 - t2, self.ring.depth(), self.ring.drops, self.ring.lag)
+
+			# Print a short status line, rather than a line for every frame
+			if t1 - status >= STATUS_INTERVAL:
+				print("Perc: %.1f %%, Save: %d, Total: %d, FPS: %.1f, Queue: %d, Drops: %d, Lag: %.3f" % (percent, self.events.savedFrames, self.totalFrames, (self.totalFrames - statusFrames) / (t1 - status), self.ring.depth(), self.ring.drops, self.ring.lag))
+				status = t1
+				statusFrames = self.totalFrames
+
+			# Get the input from the keyboard
+			keyboard = cv2.waitKey(1)
+
+		# Stop reading the stream if quitting early
+		self.ring.close(discard=True)
+
+		# Stop the worker processes
+		if self.workers > 1 and self.detector is not None:
+			self.detector.close()
+
+		# Finish writing the saved events, the catalogue and the metrics
+		self.events.close()
+		if self.index is not None:
+			self.index.close()
+			self.metrics.close()
+
+		cv2.destroyAllWindows()
+
+		if chr(keyboard & 0xFF) in ('q', '\x1b'):
+			return 0
+		return STREAM_ENDED
+
+
+def main(argv):
+	'''
+	Parse the command-line arguments and run image subtraction.
+	'''
+
+	background = ""
+	detector = "Pixel"
+	workers = WORKERS
+	policy = "block"
+	preRoll = PRE_ROLL
+	postRoll = POST_ROLL
+
+	if len(argv) < 5 or argv[1] != "-vid":
+		print("Usage: python cameraLibSubtract.py -vid <Video filename> thresh_p thresh_m [-back <Background image>] [-detector " + "|".join(DETECTORS) + "] [-workers N] [-policy " + "|".join(POLICIES) + "] [-preroll N] [-postroll N]")
+		return 1
+
+	args = argv[5:]
+	while len(args) >= 2:
+		if args[0] == "-back":
+			background = args[1]
+		elif args[0] == "-detector" and args[1] in DETECTORS:
+			detector = args[1]
+		elif args[0] == "-workers" and args[1].isdigit():
+			workers = int(args[1])
+		elif args[0] == "-policy" and args[1] in POLICIES:
+			policy = args[1]
+		elif args[0] == "-preroll" and args[1].isdigit():
+			preRoll = int(args[1])
+		elif args[0] == "-postroll" and args[1].isdigit():
+			postRoll = int(args[1])
+		else:
+			print("Incorrect input list")
+			return 1
+		args = args[2:]
+
+	subtractor = backgroundSubtractor(argv[2], argv[3], argv[4], background, detector, workers, policy, preRoll, postRoll)
+	status = subtractor.run()
+	print("Done")
+
+	return status
+
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
@@ -0,0 +1,238 @@
+'''
+Library for the telemetry of the camera server: counters of the frames,
+commands and files handled by the server, and gauges of the state of the
+Raspberry Pi, such as the CPU load, the SoC temperature and the free space.
+
+Counters only go up, and are incremented by the server as it works. Gauges
+are read each time the telemetry is collected, so they are always current.
+The telemetry is returned by the "telemetry" request of the versioned
+protocol, and served as plain-text metrics (in the Prometheus text format)
+on localhost, so that throughput and throttling can be charted during long
+recordings:
+
+	curl http://localhost:8001/metrics
+'''
+
+import os
+import threading
+import subprocess
+from collections import OrderedDict
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+TELEMETRY_HOST = "127.0.0.1" # Metrics are only served to the Pi itself, or through an ssh tunnel
+TELEMETRY_PORT = 8001
+TELEMETRY_PREFIX = "camera_" # Prefix of every metric name
+TEMPERATURE_FILE = "/sys/class/thermal/thermal_zone0/temp"
+CPU_FILE = "/proc/stat"
+
+
+class telemetry:
+
+	def __init__(self):
+		'''
+		Create an empty set of counters and gauges.
+		'''
+
+		self.lock = threading.Lock()
+		self.metrics = OrderedDict()	# Name -> (type, help, label name)
+		self.counters = {}				# Name -> {label value: count}
+		self.gauges = {}				# Name -> function returning a value, or {label value: value}
+		self.httpd = None
+
+	def counter(self, name, help, label=None):
+		'''
+		Declare a counter, optionally split by the value of a label.
+		'''
+
+		self.metrics[name] = ("counter", help, label)
+		self.counters[name] = {}
+		if label is None:
+			self.counters[name][None] = 0
+
+	def gauge(self, name, help, function, label=None):
+		'''
+		Declare a gauge, which is read by calling a function. The function
+		returns a dictionary of {label value: value} if a label is given.
+		'''
+
+		self.metrics[name] = ("gauge", help, label)
+		self.gauges[name] = function
+
+	def count(self, name, amount=1, value=None):
+		'''
+		Add to a counter, for a label value if the counter has a label.
+		'''
+
+		with self.lock:
+			values = self.counters[name]
+			values[value] = values.get(value, 0) + amount
+
+	def collect(self):
+		'''
+		Returns an ordered dictionary of name -> (type, help, label name,
+		{label value: value}) for every metric. A gauge which can't be read,
+		such as the temperature on a computer which isn't a Pi, is left out.
+		'''
+
+		metrics = OrderedDict()
+		for name, (typ, help, label) in self.metrics.items():
+			if typ == "counter":
+				with self.lock:
+					values = dict(self.counters[name])
+			else:
+				try:
+					values = self.gauges[name]()
+				except (IOError, OSError, ValueError, subprocess.CalledProcessError):
+					continue
+				if label is None:
+					values = {None: values}
+				if None in values.values():
+					continue
+			metrics[name] = (typ, help, label, values)
+
+		return metrics
+
+	def values(self):
+		'''
+		Returns the telemetry as a dictionary of {metric: value}, where the
+		metric of a labelled value is written as name{label="value"}.
+		'''
+
+		values = OrderedDict()
+		for name, (typ, help, label, samples) in self.collect().items():
+			for value in sorted(samples):
+				values[metricName(name, label, value)] = samples[value]
+		return values
+
+	def format(self):
+		'''
+		Returns the telemetry in the Prometheus text format.
+		'''
+
+		lines = []
+		for name, (typ, help, label, samples) in self.collect().items():
+			lines.append("# HELP " + TELEMETRY_PREFIX + name + " " + help)
+			lines.append("# TYPE " + TELEMETRY_PREFIX + name + " " + typ)
+			for value in sorted(samples):
+				lines.append(TELEMETRY_PREFIX + metricName(name, label, value) + " " + repr(samples[value]))
+		return "\n".join(lines) + "\n"
+
+	def serve(self, port=TELEMETRY_PORT):
+		'''
+		Serve the telemetry over HTTP on localhost from a background thread.
+		The server carries on without the endpoint if the port is in use.
+		'''
+
+		try:
+			self.httpd = HTTPServer((TELEMETRY_HOST, port), TelemetryHandler)
+		except Exception as e:
+			print("Cannot serve telemetry on port " + str(port) + ": " + str(e))
+			return
+
+		self.httpd.telemetry = self
+		thread = threading.Thread(target=self.httpd.serve_forever)
+		thread.daemon = True
+		thread.start()
+
+	def close(self):
+		'''
+		Stop serving the telemetry.
+		'''
+
+		if self.httpd is not None:
+			self.httpd.shutdown()
+			self.httpd.server_close()
+			self.httpd = None
+
+
+class TelemetryHandler(BaseHTTPRequestHandler):
+
+	def do_GET(self):
+		if self.path.split("?")[0] not in ("/", "/metrics"):
+			self.send_error(404)
+			return
+
+		body = self.server.telemetry.format().encode("utf-8")
+		self.send_response(200)
+		self.send_header("Content-Type", "text/plain; version=0.0.4")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		# Don't print every scrape to the server terminal
+		pass
+
+
+class cpuLoad:
+
+	def __init__(self):
+		'''
+		Measure the CPU load between successive readings of /proc/stat. The
+		first reading is the load since the Pi booted.
+		'''
+
+		self.last = None
+
+	def __call__(self):
+		'''
+		Returns the percentage of CPU time spent busy since the last reading.
+		'''
+
+		times = cpuTimes()
+		last = self.last or [0]*len(times)
+		total = sum(times) - sum(last)
+		idle = times[3] + times[4] - last[3] - last[4]
+		self.last = times
+		if total <= 0:
+			return 0.0
+		return 100.0 * (total - idle) / total
+
+
+def metricName(name, label, value):
+	'''
+	Returns the name of a metric, with its label if it has one.
+	'''
+
+	if label is None:
+		return name
+	return name + "{" + label + "=\"" + str(value) + "\"}"
+
+
+def cpuTimes():
+	'''
+	Returns the time the CPUs have spent in each state, from /proc/stat.
+	'''
+
+	with open(CPU_FILE) as f:
+		fields = f.readline().split()
+	return [int(field) for field in fields[1:]]
+
+
+def temperature():
+	'''
+	Returns the SoC temperature in degrees Celsius.
+	'''
+
+	with open(TEMPERATURE_FILE) as f:
+		return int(f.read()) / 1000.0
+
+
+def throttled():
+	'''
+	Returns the throttling flags of the Pi firmware. Bits 0-3 are set while
+	the Pi is under-voltage, frequency capped, throttled or at its soft
+	temperature limit, and bits 16-19 if that has happened since boot.
+	'''
+
+	output = subprocess.check_output(["vcgencmd", "get_throttled"])
+	return int(output.decode("ascii").strip().split("=")[1], 16)
+
+
+def freeSpace(path):
+	'''
+	Returns the space available in the file system of a folder, in bytes.
+	'''
+
+	stat = os.statvfs(path)
+	return stat.f_bavail * stat.f_frsize
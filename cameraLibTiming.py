@@ -0,0 +1,204 @@
+'''
+Library for timing the hot paths of the camera client and server, such as the
+encoder callbacks, captures, file writes, network messages and stream relays.
+
+Timing is opt-in, and enabled by setting the CAMERA_TIMING environment
+variable before starting the client or server:
+
+	CAMERA_TIMING=1 python cameraServerTest.py
+
+Functions are timed with the timed decorator, and blocks of code with the
+timer context manager. When timing is disabled, timed returns the function
+itself and timer returns a shared context which does nothing, so the hooks
+cost close to nothing. Each duration is added to a histogram with fixed
+buckets, four per doubling of the duration from 1 microsecond to about 2
+minutes, so adding a duration takes a single bisection and no allocation.
+Percentiles are accurate to the width of a bucket (19%).
+
+The histograms are printed and reset at the end of each session with dump().
+'''
+
+import os
+import sys
+import time
+import bisect
+import functools
+from collections import OrderedDict
+
+TIMING_ENV = "CAMERA_TIMING" # Environment variable which enables timing
+TIMING_MIN = 0.000001 # Upper bound of the first bucket, in seconds
+TIMING_STEPS = 4 # Buckets per doubling of the duration
+TIMING_BUCKETS = 108 # Number of buckets, up to about 2 minutes
+TIMING_BOUNDS = [TIMING_MIN * 2**(i / float(TIMING_STEPS)) for i in range(TIMING_BUCKETS)]
+TIMING_PERCENTILES = [50, 90, 99, 99.9]
+
+# Monotonic clock where available
+clock = getattr(time, "perf_counter", time.time)
+
+enabled = os.environ.get(TIMING_ENV, "0") not in ("", "0")
+histograms = OrderedDict()
+
+
+class timingHistogram:
+
+	def __init__(self, name):
+		'''
+		Create an empty histogram of durations.
+		'''
+
+		self.name = name
+		self.reset()
+
+	def reset(self):
+		'''
+		Remove every duration from the histogram.
+		'''
+
+		# The last bucket counts durations longer than the last bound
+		self.counts = [0]*(TIMING_BUCKETS + 1)
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+
+	def add(self, seconds):
+		'''
+		Add a duration to the histogram. Durations added by several threads at
+		once may occasionally be lost, rather than slowing every hook with a
+		lock.
+		'''
+
+		self.counts[bisect.bisect_left(TIMING_BOUNDS, seconds)] += 1
+		self.count += 1
+		self.total += seconds
+		if seconds > self.max:
+			self.max = seconds
+
+	def percentile(self, percent):
+		'''
+		Returns the upper bound of the bucket holding a percentile, or the
+		longest duration if that is shorter.
+		'''
+
+		if self.count == 0:
+			return 0.0
+
+		rank = percent / 100.0 * self.count
+		seen = 0
+		for i, count in enumerate(self.counts):
+			seen += count
+			if seen >= rank and count > 0:
+				if i == TIMING_BUCKETS:
+					return self.max
+				return min(TIMING_BOUNDS[i], self.max)
+		return self.max
+
+	def summary(self):
+		'''
+		Returns the count, mean, percentiles and maximum of the durations, in
+		seconds.
+		'''
+
+		summary = OrderedDict()
+		summary["count"] = self.count
+		summary["mean"] = self.total / self.count if self.count > 0 else 0.0
+		for percent in TIMING_PERCENTILES:
+			summary["p" + str(percent)] = self.percentile(percent)
+		summary["max"] = self.max
+		return summary
+
+
+class nullTimer(object):
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		return False
+
+
+class blockTimer(object):
+	def __init__(self, histogram):
+		self.histogram = histogram
+
+	def __enter__(self):
+		self.start = clock()
+		return self
+
+	def __exit__(self, *args):
+		self.histogram.add(clock() - self.start)
+		return False
+
+
+NULL_TIMER = nullTimer()
+
+
+def histogram(name):
+	'''
+	Returns the histogram of a hook, creating it if needed.
+	'''
+
+	if name not in histograms:
+		histograms[name] = timingHistogram(name)
+	return histograms[name]
+
+
+def timed(name):
+	'''
+	Decorator which adds the duration of every call of a function to the
+	histogram of a hook. The function is returned unchanged if timing is
+	disabled.
+	'''
+
+	def decorator(function):
+		if not enabled:
+			return function
+
+		hist = histogram(name)
+
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			start = clock()
+			try:
+				return function(*args, **kwargs)
+			finally:
+				hist.add(clock() - start)
+		return wrapper
+
+	return decorator
+
+
+def timer(name):
+	'''
+	Returns a context manager which adds the duration of a block of code to
+	the histogram of a hook.
+	'''
+
+	if not enabled:
+		return NULL_TIMER
+	return blockTimer(histogram(name))
+
+
+def dump(title, output=sys.stdout):
+	'''
+	Print the percentiles of every hook which has been called, in
+	milliseconds, and reset the histograms for the next session.
+	'''
+
+	if not enabled:
+		return
+
+	rows = [(name, hist.summary()) for name, hist in histograms.items() if hist.count > 0]
+	if len(rows) == 0:
+		return
+
+	columns = list(rows[0][1].keys())
+	width = max(len(name) for name, summary in rows)
+	output.write("\nTimings of " + title + " (ms):\n")
+	output.write("	" + "Hook".ljust(width) + "".join(column.rjust(10) for column in columns) + "\n")
+	for name, summary in rows:
+		cells = [str(summary["count"]).rjust(10)]
+		cells += ["%10.3f" % (summary[column]*1000) for column in columns[1:]]
+		output.write("	" + name.ljust(width) + "".join(cells) + "\n")
+	output.write("\n")
+
+	for hist in histograms.values():
+		hist.reset()
@@ -12,6 +12,7 @@ import picamera
 from multiprocessing import Process
 import time
 import sys
+import socket
 import subprocess
 
 # Initialise the camera module client
@@ -27,7 +28,19 @@ try:
 			#try:
 			# Process and perform command from network
 			command = camCommand.receiveCommand()
-			camCommand.performCommand(command)
+
+			# Wait for the computer to reconnect if the connection is lost
+			if command == None:
+				camCommand.closeNetwork()
+				continue
+
+			try:
+				camCommand.performCommand(command)
+			except socket.error as e:
+				print("Command abandoned: %s" % e)
+				camCommand.running = None
+				camCommand.closeNetwork()
+				continue
 			
 			# Close network if quit command called
 			if command == "Q":